@@ -1,8 +1,6 @@
 # Import essential libraries
-import requests
 import cv2
 import numpy as np
-import imutils
 import mediapipe as mp
 import threading
 import pygame.mixer
@@ -11,42 +9,150 @@ import time
 import os
 import sys
 import multiprocessing
+import collections
+import json
+from frame_source import frameGrabber, open_source
+from sample_bank import sampleBank
+from press_detector import detect_presses, normalized_distances, threshold_vector, pressed_positions
+from audio_engine import audioEngine, mixingEngine, run_engine
+from event_ring import eventRing
+from note_tracker import noteTracker
+from instrumentation import metricsRecorder
+from pipeline import framePipeline, end_of_stream
+from landmark_filter import landmarkFilter, press_velocity
+from keyboard_layout import keyboardLayout, note_names
+from session_log import sessionRecorder
 
 #Global variables definition
-landmarks= {'thumb': [1,2,3,4], 'index': [5,6,7,8], 'middle': [9,10,11,12], 'ring': [13,14,15,16], 'little': [17,18,19,20]} #Position landmarks index corresponding to each finger. Refer to mediapipe github repo for more details
 
 tip_landmarks = [4,8,12,16,20] #index of tip position of all fingers
 dist_threshold_param= {'thumb': 8.6, 'index': 6, 'middle': 6, 'ring': 6, 'little': 5} #customized dist threshold values for calibration of finger_detect_and_compute module
-left_detect=np.zeros(5);right_detect=np.zeros(5) #arrays representing detected finger presses for each hand
-left_coordinates=np.zeros((5,2));right_coordinates=np.zeros((5,2)) #arrays representing pixel coordinates of each detected finger press (tip landmark)
+calibration_file="calibration.json" #threshold profile written by calibrate.py, replaces dist_threshold_param at startup if the file exists
+threshold_units='pixels' #units of the thresholds: 'pixels' (10 pixel units of a 640 wide frame) or 'palm' (relative to the palm size), set by the profile
+hand_threshold_param=None #optional per hand thresholds from the profile, {'left': {...}, 'right': {...}}
+frame_width=640 #frames are resized to this width before hand detection
+hand_colors=[(10,50,50),(50,50,100),(50,100,50),(100,50,50)] #circle colors of detected presses, one per hand
 bboxes_white=np.zeros((52,4)) #initializing bboxes for all white keys in standard 88key piano
 bboxes_black=np.zeros((36,4)) #initializing bboxes for all black keys in standard 88key piano
 start_x=40; start_y=250; #starting pixel coordinates of piano
 white_key_width=10; white_key_height=80; black_key_width=5; black_key_height=40 #params related to piano visualization
+keyboard_scale=1.0 #scale applied to the key sizes above
+keyboard_keys=88 #keyboard size: 25, 49, 61, 76 or 88 keys
+keyboard_layout=None #keyboardLayout generating the keys, their geometry, lookup table and overlay from the settings above
 white_key_reference=[]#list containing reference key values for all white keys.
 black_key_reference=[]#list containing reference key values for all black keys.
+key_reference=[]#note names of all 88 keys in pitch order. The position of a note in this list is its note id (MIDI number - 21), for any keyboard size
+white_key_ids=[];black_key_ids=[]#note ids of the white and black keys, same order as white_key_reference and black_key_reference
 key_index_array=[]#stores indexes and colors for all detected key presses
-play_music_status=1
+key_lookup=None#keyLookup table mapping pixel coordinates to piano keys, built by initialize_key_bboxes()
+keyboard_renderer=None#keyboardRenderer holding the pre-rendered piano overlay, built by initialize_key_bboxes()
 visualizer_status=1
+music_dir="/home/abhinav/Piano_project/25405__tedagame__88-piano-keys-long-reverb/" #directory with the 88 piano key samples
+sample_cache_file=None #optional .npy PCM cache of the decoded samples, memory mapped by the audio process
+polyphony=10; release_ms=250; note_velocity=100 #audio engine voices, fade out time after a key is released and default loudness (1-127)
+press_debounce_frames=1; release_debounce_frames=2; min_hold_frames=0 #frames a key must stay pressed/released before its note starts/stops, and minimum note length in frames
+release_threshold_scale=1.15 #a pressing finger is released only once its distance exceeds dist_threshold_param*release_threshold_scale (hysteresis)
+event_ring_capacity=4096 #note events buffered between the vision and audio processes
+roi_tracking=False #run hand inference on a crop around the previous hands and the piano instead of the full frame
+instrumentation_enabled=True #per stage timers and counters, near zero cost when disabled
+trace_every=0 #print the detailed per frame trace (detections, music lists) for one frame out of this many, 0 disables it
+summary_interval=5.0; metrics_file=None #seconds between metrics summaries, and optional JSON file the summary is written to
+metrics=metricsRecorder(instrumentation_enabled,trace_every=trace_every,summary_interval=summary_interval,dump_path=metrics_file)
+landmark_smoothing=True #One Euro filter on the landmarks before press detection, removes the jitter that makes presses flicker
+smoothing_min_cutoff=1.0; smoothing_beta=0.01 #filter cutoff (Hz) for a still hand, and how fast it opens up with landmark speed
+prediction_horizon=0.05 #seconds the landmarks are extrapolated ahead, a finger moving down triggers its note up to this much earlier (0 disables it)
+velocity_sensitive=True; press_speed_range=(50,800) #note loudness from the finger tip speed (pixels/s) at the press, instead of note_velocity
+session_dir=None #directory to record landmarks, presses and notes of every frame to, for replay without camera (see session_log.py)
+pipeline_queue_size=2 #frames buffered between two pipeline stages, the oldest is dropped when a stage falls behind
+camera_url="http://192.168.29.189:8080/shot.jpg" #IP Webcam url: /shot.jpg for snapshots, /video for the MJPEG stream. A webcam index, video file or image directory also works
+player_sources=[] #several camera urls (one player and keyboard each) served at once by multi_player.py instead of camera_url, e.g. ["http://<phone1>:8080/video", "http://<phone2>:8080/video"]
+inference_workers=2 #hand inference processes shared by all player_sources
 
 class handDetector():
-    def __init__(self, mode=False, maxHands=4, detectionCon=0.5, trackCon=0.5):
+    def __init__(self, mode=False, maxHands=4, detectionCon=0.5, trackCon=0.5, roi=False, keyboard_band=None, roi_margin=0.3, roi_max_side=320, full_frame_every=15):
         self.mode = mode
         self.maxHands = maxHands #Max no of hands to be detected in one frame. 
         self.detectionCon = detectionCon #detection confidence
         self.trackCon = trackCon #tracking confidence--enables tracking rather than detection on every frame if tracking confidence is good (improves fps)
+        self.roi = roi #if True, inference runs on a crop around the previous hands (plus the keyboard band) instead of the full frame
+        self.keyboard_band = keyboard_band #(ymin,ymax) pixel rows of the piano, always kept inside the crop
+        self.roi_margin = roi_margin #crop margin around the previous hands, relative to their size
+        self.roi_max_side = roi_max_side #crops are downscaled so their longest side is at most this many pixels
+        self.full_frame_every = full_frame_every #run a full frame detection every n frames to pick up hands entering the view
+        self.prev_box = None #xmin,ymin,xmax,ymax pixel box around the hands of the previous frame
+        self.frames_since_full = 0
+        self.inference_times = collections.deque(maxlen=300) #(seconds, used roi) of the recent findHands() calls
         self.mpHands = mp.solutions.hands
-        self.hands = self.mpHands.Hands()
+        self.hands = self.mpHands.Hands(static_image_mode=mode, max_num_hands=maxHands, min_detection_confidence=detectionCon, min_tracking_confidence=trackCon)
+        #crops get their own graph: in tracking mode MediaPipe carries the hand rectangle over from the previous image, which is in
+        #crop coordinates for a crop and in frame coordinates for a full frame, so one graph fed both would start from the wrong place
+        self.roi_hands = self.mpHands.Hands(static_image_mode=mode, max_num_hands=maxHands, min_detection_confidence=detectionCon, min_tracking_confidence=trackCon) if roi else None
         self.mpDraw = mp.solutions.drawing_utils #drawing object used for drawing later on the image
 
-    def findHands(self, img, draw=True):
+    def roiRect(self, w, h):
+
+        """ Function: Region to run inference on, from the previous frame's hands and the keyboard band
+            Arguments:  self, w, h: frame size
+            returns: x0,y0,x1,y1 pixel rectangle, or None if a full frame detection is needed """
+        if not self.roi or self.prev_box is None or self.frames_since_full >= self.full_frame_every:
+            return None
+        xmin, ymin, xmax, ymax = self.prev_box
+        mx = max(40, (xmax - xmin) * self.roi_margin); my = max(40, (ymax - ymin) * self.roi_margin)
+        x0 = xmin - mx; x1 = xmax + mx; y0 = ymin - my; y1 = ymax + my
+        if self.keyboard_band is not None:
+            y0 = min(y0, self.keyboard_band[0]); y1 = max(y1, self.keyboard_band[1])
+        x0 = int(max(0, x0)); y0 = int(max(0, y0)); x1 = int(min(w, x1)); y1 = int(min(h, y1))
+        if x1 - x0 < 32 or y1 - y0 < 32 or (x1 - x0) * (y1 - y0) > 0.8 * w * h:
+            return None #crop too small to be useful or too large to save anything
+        return x0, y0, x1, y1
+
+    def processRegion(self, img, rect, imgRGB=None):
+
+        """ Function: Run the hand model on a downscaled crop and map the landmarks back to full frame coordinates
+            Arguments:  self, img: full frame, rect: x0,y0,x1,y1 crop
+                        imgRGB: RGB copy of the frame if already converted
+            returns: mediapipe results with landmarks normalized to the full frame """
+        h, w = img.shape[:2]
+        x0, y0, x1, y1 = rect
+        crop = (img if imgRGB is None else imgRGB)[y0:y1, x0:x1]
+        scale = min(1.0, self.roi_max_side / float(max(x1 - x0, y1 - y0)))
+        if scale < 1.0:
+            crop = cv2.resize(crop, (max(1, int((x1 - x0) * scale)), max(1, int((y1 - y0) * scale))), interpolation=cv2.INTER_AREA)
+        results = self.roi_hands.process(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB) if imgRGB is None else np.ascontiguousarray(crop))
+        if results.multi_hand_landmarks:
+            for handLms in results.multi_hand_landmarks:
+                for lm in handLms.landmark: #landmarks are normalized to the crop, whatever its scale
+                    lm.x = (lm.x * (x1 - x0) + x0) / w
+                    lm.y = (lm.y * (y1 - y0) + y0) / h
+        return results
+
+    def findHands(self, img, draw=True, imgRGB=None):
 
         """ Function: Get results and Draw landmarks on the read image for all hands detected in the frame
             Arguments:  self, img: image to draw landmarks on, 
                         draw: if True, draws landmarks on the image frame
+                        imgRGB: RGB version of img if it was already converted (for example by the preprocess stage)
             returns: img: final image with the landmarks """
-        imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        self.results = self.hands.process(imgRGB)
+        t0 = time.perf_counter()
+        h, w = img.shape[:2]
+        rect = self.roiRect(w, h)
+        if rect is not None:
+            self.results = self.processRegion(img, rect, imgRGB)
+            if not self.results.multi_hand_landmarks:
+                rect = None #tracking lost, fall back to a full frame detection
+        if rect is None:
+            if imgRGB is None:
+                imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            self.results = self.hands.process(imgRGB)
+            self.frames_since_full = 0
+        else:
+            self.frames_since_full += 1
+        self.inference_times.append((time.perf_counter() - t0, rect is not None))
+        if self.results.multi_hand_landmarks:
+            pts = np.array([(lm.x, lm.y) for handLms in self.results.multi_hand_landmarks for lm in handLms.landmark]) * [w, h]
+            self.prev_box = (pts[:,0].min(), pts[:,1].min(), pts[:,0].max(), pts[:,1].max())
+        else:
+            self.prev_box = None
         # print(results.multi_hand_landmarks)
         if self.results.multi_hand_landmarks:
             for handLms in self.results.multi_hand_landmarks:
@@ -74,34 +180,38 @@ class handDetector():
         List=np.array(List)
         return List
 
+    def handedness(self):
 
-    def handsCount(self):
+        """ Function: Left/right classification of the detected hands
+            Arguments:  self
+            returns: list with 0 (left) or 1 (right) per hand, same order as findPositions() """
+        if not self.results.multi_hand_landmarks or not self.results.multi_handedness:
+            return []
+        return [0 if hand.classification[0].label == 'Left' else 1 for hand in self.results.multi_handedness]
 
-        """ Function: calculates the total no of hands detected in an image frame
-            Arguments: self
-            returns: total no of hands detected in a frame """
-        # Returns the no of hand detected in the image frame
+    def findPositions(self, img):
 
-        dim=np.shape(np.array(self.results.multi_hand_landmarks))
-        if(dim):
-            return dim[0]
-        else:
-            return 0
+        """ Function: Store positions of all landmarks of all detected hands in one array
+            Arguments:  self, img: image the landmarks were detected on (for its size)
+            returns: (hands,21,2) int array of landmark image coordinates """
+        if not self.results.multi_hand_landmarks:
+            return np.zeros((0,21,2),dtype=int)
+        h, w = img.shape[:2]
+        hands=np.array([[(lm.x, lm.y) for lm in handLms.landmark] for handLms in self.results.multi_hand_landmarks])
+        return (hands*[w,h]).astype(int) #same truncation as int() in findPosition
 
 
-def check_threshold(p1,p2,p3,finger):
+    def roiStats(self):
 
-    """ Function: Checks whether a key press is detected for a finger based on a mathematical condition
-            Arguments: p1,p2,p3: positions of landmarks of a finger
-                       finger: string name of the finger pressed (not required)
-            returns: boolean value of whether key press is detected or not """
-    global dist_threshold_param
-    p1=p1/10
-    p2=p2/10
-    p3=p3/10
+        """ Function: Inference time with and without the region of interest over the recent frames
+            Arguments: self
+            returns: dict with the fraction of frames run on a crop, mean roi/full frame inference ms and estimated time saved per frame """
+        times = np.array([t for t, r in self.inference_times]); used = np.array([r for t, r in self.inference_times], dtype=bool)
+        roi_ms = float(times[used].mean() * 1000) if used.any() else 0.0
+        full_ms = float(times[~used].mean() * 1000) if (~used).any() else 0.0
+        return {'frames': len(times), 'roi_fraction': float(used.mean()) if len(times) else 0.0, 'roi_ms': roi_ms, 'full_ms': full_ms,
+                'saved_ms_per_frame': (full_ms - roi_ms) * float(used.mean()) if used.any() and full_ms else 0.0}
 
-    dist = np.linalg.norm(p1 - p2) +  np.linalg.norm(p3 - p2) + np.linalg.norm(p1 - p3) #Calculating sum of absolute distances b/w three landmark points of a finger. This is a noobie algo. Can be improved!
-    return (dist<dist_threshold_param[finger]) #return True if this is smaller than a prespecified threshold during calibration
 
 def finger_detect_and_compute(list):
 
@@ -109,63 +219,50 @@ def finger_detect_and_compute(list):
             Arguments: list: a list containing all position landmarks of a hand
             returns: detected_array: boolean array representing corresponding key presses
                      coordinates: pixel coordinates of the tip landmakrs of the pressed keys """
-    
-    detect_array=np.array([(int)(check_threshold(list[2][1:3],list[3][1:3],list[4][1:3],'thumb')),(int)(check_threshold(list[6][1:3],list[7][1:3],list[8][1:3],'index')),(int)(check_threshold(list[10][1:3],list[11][1:3],list[12][1:3],'middle')),(int)(check_threshold(list[14][1:3],list[15][1:3],list[16][1:3],'ring')),(int)(check_threshold(list[18][1:3],list[19][1:3],list[20][1:3],'little'))])
-    coordinates=np.zeros((5,2))
-    for i in range(5):
-        if(detect_array[i]!=0):
-            coordinates[i]=list[tip_landmarks][i,1:3]
-    
-    return detect_array,coordinates
-
-def initialize_visualizer(img1):
-
-    """ Function: Initialize all variables important to piano visualization on image
-            Arguments: img1: Image to display piano image
-            returns: img_background: updated background image to display piano image """
-    global bboxes_white, bboxes_black, start_x, start_y, white_key_width, white_key_height, black_key_width, black_key_height
-    curr_x=start_x; curr_y=start_y
-    img_background=img1.copy()
-    for i in range(52):#Initializing 52 white piano keys
-        img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+white_key_width,curr_y+white_key_height), [255,255,255], 2)
-        bboxes_white[i]=[curr_x,curr_y,curr_x+white_key_width,curr_y+white_key_height]
-        curr_x=curr_x + white_key_width
-
-    #Overlaying the first odd black key
-    curr_x= (int)(start_x + white_key_width-black_key_width/2.0)
-    img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+black_key_width,curr_y+black_key_height), [0,0,0], -1)
-    bboxes_black[0]=[curr_x,curr_y,curr_x+black_key_width,curr_y+black_key_height]
-    curr_x=curr_x + 2*white_key_width
-
-    for i in range(7): #initializing the remaining black keys
-        img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+black_key_width,curr_y+black_key_height), [0,0,0], -1)
-        bboxes_black[i*5+1]=[curr_x,curr_y,curr_x+black_key_width,curr_y+black_key_height]
-
-        curr_x=curr_x + white_key_width
 
-        img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+black_key_width,curr_y+black_key_height), [0,0,0], -1)
-        bboxes_black[i*5+2]=[curr_x,curr_y,curr_x+black_key_width,curr_y+black_key_height]
+    detect_array,coordinates=detect_presses(np.asarray(list)[:,1:3],threshold_vector(dist_threshold_param),threshold_units,frame_width) #single hand case of the batched detector
+    return detect_array[0],coordinates[0]
 
-        curr_x=curr_x + 2*white_key_width
+def initialize_key_bboxes():
 
-        img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+black_key_width,curr_y+black_key_height), [0,0,0], -1)
-        bboxes_black[i*5+3]=[curr_x,curr_y,curr_x+black_key_width,curr_y+black_key_height]
-
-        curr_x=curr_x + white_key_width
-
-        img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+black_key_width,curr_y+black_key_height), [0,0,0], -1)
-        bboxes_black[i*5+4]=[curr_x,curr_y,curr_x+black_key_width,curr_y+black_key_height]
-
-        curr_x=curr_x + white_key_width
-
-        img_background = cv2.rectangle(img_background, (curr_x,curr_y), (curr_x+black_key_width,curr_y+black_key_height), [0,0,0], -1)
-        bboxes_black[i*5+5]=[curr_x,curr_y,curr_x+black_key_width,curr_y+black_key_height]
+    """ Function: Place the keyboard layout at start_x, start_y, keyboard_scale and publish its bboxes, key lookup table
+                  and pre-rendered overlay. Only the caches affected by a change are rebuilt (see keyboardLayout.place)
+            Arguments: none
+            returns: none """
+    global bboxes_white, bboxes_black, key_lookup, keyboard_renderer
+    if keyboard_layout is None:
+        piano_key_initializer()
+    keyboard_layout.place(start_x, start_y, keyboard_scale)
+    bboxes_white = keyboard_layout.bboxes(black=False)
+    bboxes_black = keyboard_layout.bboxes(black=True)
+    key_lookup = keyboard_layout.lookup
+    keyboard_renderer = keyboard_layout.renderer
+
+def place_keyboard(x=None, y=None, scale=None, keys=None):
+
+    """ Function: Move, scale or resize the virtual piano between runs, e.g. from a script, a tool or a session replay.
+                  The live piano places its keyboard once at startup: the hand detector of a running pipeline keeps
+                  the keyboard band it was created with. Note ids do not depend on the range, so note trackers and
+                  the audio process stay valid across a change
+            Arguments: x, y: new top left pixel coordinates of the piano, scale: size relative to the default key sizes
+                       keys: new keyboard size (25, 49, 61, 76 or 88 keys)
+            returns: none """
+    global start_x, start_y, keyboard_scale, keyboard_keys
+    if x is not None: start_x=int(x)
+    if y is not None: start_y=int(y)
+    if scale is not None: keyboard_scale=float(scale)
+    if keys is not None and keys!=keyboard_keys:
+        keyboard_keys=keys
+        keyboard_layout.setRange(keyboard_keys)
+        update_key_tables()
+    initialize_key_bboxes()
 
-        curr_x=curr_x + 2*white_key_width
+def initialize_visualizer(img1):
 
-    print("White_bboxes=",bboxes_white)
-    print("Black_bboxes=",bboxes_white)
-    return img_background
+    """ Function: Paste the pre-rendered piano keys on the image (in place, no per key drawing)
+            Arguments: img1: Image to display piano image
+            returns: img_background: updated background image to display piano image """
+    return keyboard_renderer.compose(img1)
    
     
 
@@ -175,29 +272,12 @@ def visualizer(img_background):
             Arguments: img_background:updated image to display piano image
             returns: None """
 
-    global key_index_array,bboxes_white,bboxes_black
+    global key_index_array
 
     if(visualizer_status): 
-        print("In thread1")
         try:
-            if(len(key_index_array)!=0): #Makes the pressed piano keys in different color for better visualization
-                for key_index,color in key_index_array:
-                    if(color=='white'):
-                        xmin,ymin,xmax,ymax = bboxes_white[key_index]
-                        start=(int(xmin),int(ymin))
-                        end=(int(xmax),int(ymax))
-                        print("start and end=",(start,end))
-                        img_background_new=cv2.rectangle(img_background,start,end,(255,182,193),-1)
-                        print('Printing key pressed-----------------------------',(key_index,color))
-                    if(color=='black'):
-                        xmin,ymin,xmax,ymax = bboxes_black[key_index]
-                        start=(int(xmin),int(ymin))
-                        end=(int(xmax),int(ymax))
-                        print("start and end=",(start,end))
-                        img_background_new=cv2.rectangle(img_background,start,end,(144,238,144),-1)
-                        print('Printing key pressed-----------------------------',(key_index,color))
-            
-            print("key_index_array=",key_index_array)
+            keyboard_renderer.highlight(img_background,key_index_array) #Makes the pressed piano keys in different color for better visualization, only those keys are redrawn
+            metrics.trace("key_index_array=",key_index_array)
             key_index_array=[]
         except KeyboardInterrupt:
             print("Exiting visualizer thread")
@@ -206,47 +286,25 @@ def visualizer(img_background):
 
 def piano_key_initializer():
 
-    """ Function: Initialize piano keys for music. Used global variables white_key_reference and black_key_reference
+    """ Function: Generate the keyboard layout and fill the note tables (key_reference, white/black_key_reference and ids)
             Arguments: None
             returns: None """
-
-    
-    global white_key_reference, black_key_reference
-    white_key_reference.append('a0')
-    white_key_reference.append('b0')
-    black_key_reference.append('a-0')
-
-    for i in range(7):
-        white_key_reference.append('c'+str(i+1))
-        white_key_reference.append('d'+str(i+1))
-        white_key_reference.append('e'+str(i+1))
-        white_key_reference.append('f'+str(i+1))
-        white_key_reference.append('g'+str(i+1))
-        white_key_reference.append('a'+str(i+1))
-        white_key_reference.append('b'+str(i+1))
-
-        black_key_reference.append('c-'+str(i+1))
-        black_key_reference.append('d-'+str(i+1))
-        black_key_reference.append('f-'+str(i+1))
-        black_key_reference.append('g-'+str(i+1))
-        black_key_reference.append('a-'+str(i+1))
-    white_key_reference.append('c8')
-
+    global keyboard_layout
+    keyboard_layout = keyboardLayout(keyboard_keys, start_x, start_y, keyboard_scale, (white_key_width, white_key_height), (black_key_width, black_key_height))
+    update_key_tables()
     print("Piano Keys Initialized Succesfully!")
 
 
-def within_threshold(pos,item):
+def update_key_tables():
 
-    """ Function: check if the tip of pressed is within the threshold of piano key boundaries
-            Arguments: pos: x,y pixel coordinates of the tip of finger
-                       item: boundaries of bbox of a particular key of a piano
-            returns: boolean value"""
-
-    if(pos[0]>item[0] and pos[0]<item[2] and pos[1]>item[1] and pos[1]<item[3]):
-        return True
-    else:
-        return False
-    
+    """ Function: Refresh the note name and id lists from the keyboard layout, in place so imported references stay valid
+            Arguments: None
+            returns: None """
+    key_reference[:] = note_names()
+    white_key_reference[:] = keyboard_layout.names(black=False)
+    black_key_reference[:] = keyboard_layout.names(black=True)
+    white_key_ids[:] = keyboard_layout.white_ids.tolist()
+    black_key_ids[:] = keyboard_layout.black_ids.tolist()
 
 
 def find_note(pos):
@@ -256,24 +314,9 @@ def find_note(pos):
             returns: note: ogg file address
                      index: index of the pressed key
                      color: color of the pressed key: 'black or 'white """
-                     
-    x,y=pos
-    index=0
-    global bboxes_white,bboxes_black,white_key_reference,black_key_reference
-
-    for id, items in enumerate(bboxes_black):
-        if(within_threshold(pos,items)):
-            index=id
-            note=black_key_reference[id]
-            return note,index,'black'
-
-    for id, items in enumerate(bboxes_white):
-        if(within_threshold(pos,items)):
-            index=id
-            note=white_key_reference[id]
-            return note,index,'white'
-    
-    return 'Wrong Press',100,'None'
+
+    global key_lookup
+    return key_lookup.find(pos) #single read from the precomputed label map, black keys take priority over white ones
 
 
 
@@ -282,168 +325,251 @@ def find_music_list(pos,num):
     """ Function: Prepares the music list of piano keys to be played given the positions of all pressed piano keys and the no of keys pressed
             Arguments: pos: positions of all finger tips corresponding to which a key press is detected
                        num: no of keys pressed at a time 
-            returns: music_list: list of all piano music files to be played"""
+            returns: music_list: list of note ids of all piano keys to be played"""
 
     music_list=[]; global key_index_array
-    for i in range(num):
-        note,key_index,color=find_note(pos[i])
+    for note,key_index,color in key_lookup.findAll(np.array(pos[:num])): #all finger tips resolved in one lookup
         if(note!='Wrong Press'):
             key_index_array.append([key_index,color])
-            for fname in os.listdir('/home/abhinav/Piano_project/25405__tedagame__88-piano-keys-long-reverb/'):
-                if note in fname:
-                    note=fname
-                    break
-            music_list.append('/home/abhinav/Piano_project/25405__tedagame__88-piano-keys-long-reverb/'+ note)
+            music_list.append(white_key_ids[key_index] if color=='white' else black_key_ids[key_index])
 
     return music_list      
 
-def build_music_list():
-
-    """ Function: Builds the list of piano keys to play music
-            Arguments: none
-            returns: music_list: list of all piano music files to be played"""
-
-    global left_detect,left_coordinates,right_detect,right_coordinates
-    positions=[];music_list=[]
-    if(play_music_status):
-        try:
-            for i in range(5):
-                if(left_detect[i]!=0):
-                    positions.append(left_coordinates[i])
-                if(right_detect[i]!=0):
-                    positions.append(right_coordinates[i])
-            num=len(positions)
-            print('num=',num)
-            if(num!=0):
-                music_list=find_music_list(positions,num)
-                print("Printing Music list in play_music:",music_list)
-            return music_list
-        except KeyboardInterrupt:
-            print("Exiting play music thread")
-            sys.exit()
-
-def play_music(q,status):
+def play_music(ring, players=None):
 
     """ Function: Plays piano music in a separate python process
-            Arguments: q: queue to pass music_list data among different python processes
-                       status: can be used to switch off this process (not required)
+            Arguments: ring: shared memory eventRing delivering note-on/note-off events from the processor process
+                       players: names of the players when several share this process (ring of player_event_dtype records)
             returns: None"""
 
     print("Processing play_music process")
-    while True:
-        try:
-            print("In the play_music function--Checking condition")
-            mixer.init()
-            pygame.mixer.set_num_channels(10)  # default is 8
-            music_list=q.get()
-            if(len(music_list)!=0):
-                for id,items in enumerate(music_list):
-                    pygame.mixer.Channel(id).play(pygame.mixer.Sound(music_list[id]))
-                import time
-                time.sleep(2)
-        except KeyboardInterrupt:
-            print("Play_music process stopped forcefully")
-            sys.exit()
+    mixer.init()
+    pygame.mixer.set_num_channels(polyphony * (len(players) if players else 1))  # default is 8
+    bank = sampleBank(music_dir, key_reference, cache_file=sample_cache_file) #all samples decoded once, before the first key press
+    print("Sample bank loaded:", bank.stats())
+    if players:
+        engine = mixingEngine(bank, players, polyphony=polyphony, release_ms=release_ms) #one voice pool per player, one output
+    else:
+        engine = audioEngine(bank, polyphony=polyphony, release_ms=release_ms)
+    try:
+        run_engine(ring, engine) #applies events as they arrive, never sleeps between notes
+    except KeyboardInterrupt:
+        print("Play_music process stopped forcefully")
+        print("Audio engine stats (latency = frame capture to voice start):", engine.stats())
+        print("Event ring stats:", ring.stats())
+        sys.exit()
 
 
-def reinitialize():
+def make_landmark_filter():
 
-    """ Function: Reinitialize suitable global variables after every iteration
+    """ Function: Landmark filter configured from the smoothing globals
             Arguments: none
-            returns: none"""
-
-    global right_detect,right_coordinates,left_detect,left_coordinates,key_index_array
-
-    left_detect=np.zeros(5);right_detect=np.zeros(5)
-    left_coordinates=np.zeros((5,2));right_coordinates=np.zeros((5,2))
-    key_index_array=[]
-
-def processor(q,status):
-
-    """ Function: Primary process to read image frames from server->detect finger landmarks->find finger tip positions and build music lists
+            returns: landmarkFilter, or None when landmark_smoothing is off """
+    if not landmark_smoothing:
+        return None
+    return landmarkFilter(smoothing_min_cutoff, smoothing_beta, prediction=prediction_horizon)
+
+def apply_calibration(profile):
+
+    """ Function: Use the thresholds of a calibration profile, and the release scale they were tuned with. Thresholds
+                  tuned on smoothed landmarks do not fit raw ones (and the other way round), so a profile calibrated
+                  with a different landmark_smoothing than the current one is reported
+            Arguments: profile: dict with 'thresholds' (finger -> value), optional 'units', 'per_hand' ({'left': {...}, 'right': {...}}),
+                       'release_threshold_scale' and 'smoothing'
+            returns: None """
+    global dist_threshold_param, threshold_units, hand_threshold_param, release_threshold_scale
+    dist_threshold_param = dict(profile['thresholds'])
+    threshold_units = profile.get('units', 'pixels')
+    hand_threshold_param = profile.get('per_hand') or None
+    if profile.get('release_threshold_scale') is not None:
+        release_threshold_scale = profile['release_threshold_scale']
+    if profile.get('smoothing') is not None and bool(profile['smoothing']) != bool(landmark_smoothing):
+        print("Warning: the thresholds were calibrated with landmark smoothing %s but landmark_smoothing is %s, recalibrate with %s" %
+              ("on" if profile['smoothing'] else "off", landmark_smoothing, "--smoothing" if landmark_smoothing else "--no-smoothing"))
+
+def load_calibration(path=None):
+
+    """ Function: Load the calibration profile written by calibrate.py, if there is one
+            Arguments: path: profile file (default: calibration_file)
+            returns: profile dict, or None when the file does not exist (the built in thresholds stay) """
+    path = path or calibration_file
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    apply_calibration(profile)
+    print("Loaded threshold calibration from", path)
+    return profile
+
+def hand_thresholds(handedness, hands, thresholds):
+
+    """ Function: Per hand thresholds from hand_threshold_param and the left/right classification of the hands
+            Arguments: handedness: list of 0 (left) / 1 (right) per hand, hands: number of hands
+                       thresholds: (5,) thresholds used for hands without a classification
+            returns: (hands,5) array """
+    out = np.tile(thresholds, (hands, 1))
+    for hand, side in enumerate(list(handedness)[:hands]):
+        param = hand_threshold_param.get('left' if side == 0 else 'right')
+        if param:
+            out[hand] = threshold_vector(param)
+    return out
+
+def detect_notes(hand_landmarks, timestamp, tracker, thresholds, smoother=None, handedness=None, layout=None):
+
+    """ Function: One frame of landmarks -> finger presses, pressed keys and note events
+            Arguments: hand_landmarks: (hands,21,2) landmarks from handDetector.findPositions()
+                       timestamp: capture time of the frame, tracker: noteTracker, thresholds: per finger press thresholds
+                       smoother: optional landmarkFilter; a finger also counts as pressing when its predicted landmarks are
+                                 below the threshold, and the finger tip speed sets the note velocity
+                       handedness: left/right of every hand (handDetector.handedness()), selects per hand thresholds if calibrated
+                       layout: keyboardLayout of the player when several keyboards are served (default: the global keyboard)
+            returns: detect: (hands,5) press mask, coordinates: (hands,5,2) pressing finger tips,
+                     keys: list of [key_index,color] of the pressed keys, events: note-on/note-off events """
+    velocity = note_velocity
+    if smoother is not None:
+        hand_landmarks = smoother.filter(hand_landmarks, timestamp)
+        distances = np.minimum(normalized_distances(hand_landmarks, threshold_units, frame_width), normalized_distances(smoother.predict(), threshold_units, frame_width))
+    else:
+        distances = normalized_distances(hand_landmarks, threshold_units, frame_width)
+    if hand_threshold_param and handedness is not None and len(hand_landmarks):
+        thresholds = hand_thresholds(handedness, len(hand_landmarks), thresholds)
+    detect = tracker.fingerMask(distances, thresholds) #press/release hysteresis on all fingers of all hands
+    coordinates = np.where(detect[:,:,None]!=0,hand_landmarks[:,tip_landmarks],0).astype(float) if len(hand_landmarks) else np.zeros((0,5,2))
+    lookup = key_lookup if layout is None else layout.lookup
+    keys = lookup.findAll(pressed_positions(detect,coordinates)) if detect.any() else []
+    valid = [note!='Wrong Press' for note,index,color in keys]
+    keys = [[index,color] for (note,index,color),ok in zip(keys,valid) if ok]
+    white_ids, black_ids = (white_key_ids, black_key_ids) if layout is None else (layout.white_ids, layout.black_ids)
+    notes = [int(white_ids[index]) if color=='white' else int(black_ids[index]) for index,color in keys]
+    if smoother is not None and velocity_sensitive and len(notes):
+        speeds = smoother.tipSpeed().T[detect.T!=0] #same finger order as pressed_positions()
+        velocity = press_velocity(speeds[np.array(valid)], *press_speed_range)
+    events = tracker.update(notes,timestamp,velocity) #only the edges, stamped with the frame capture time
+    return detect, coordinates, keys, events
+
+def session_meta():
+
+    """ Function: Settings stored with a recorded session, so a replay maps presses to the same keys with the same
+                  smoothing, prediction and note velocities
             Arguments: none
-            returns: music_list: list of all piano music files to be played"""
-
-    # Declare useful variables
-    pTime = 0; cTime = 0; right_hand=1; left_hand=0
-    lmList=[]; rmList=[]
-    detector = handDetector()
-    global right_detect,right_coordinates,left_detect,left_coordinates,play_music_status,key_index_array
-    music_list_curr=[]
-    music_list_prev=[]
-
-    url = "http://192.168.29.189:8080/shot.jpg"
-    status.put(1)
- 
-    # While loop to continuously fetching data from the Url
-    while True:
-        try:
-            print("Queue Size=",q.qsize())
-
-            # Read image data from server and preprocess
-            img_resp = requests.get(url)
-            img_arr = np.array(bytearray(img_resp.content), dtype=np.uint8)
-            img = cv2.imdecode(img_arr, -1)
-            img = imutils.resize(img, width=640, height=480)
-            
-
-            # Detect finger landmarks in left (or/and right hand)
-            hands=1
-            img = detector.findHands(img) #draw hand landmarks on image
-            lmList = detector.findPosition(img,left_hand) #storing position of landmarks in an array
-            hands=detector.handsCount() #find total no of hands in image frame
-            print("No of hands are",hands)
-
-            if(hands>1):
-                rmList = detector.findPosition(img,right_hand)
-
-            if len(lmList) != 0:
-                left_detect,left_coordinates = finger_detect_and_compute(lmList) 
-                print("Left Hand Detection Array=", left_detect)
-                print("left coordinates are", left_coordinates)
-                for i in range(5):
-                    if(left_detect[i]!=0):
-                        x,y=left_coordinates[i]
-                        img=cv2.circle(img, (int(x),int(y)), 10, (10,50,50), 5)
-
-            if len(rmList) != 0 and hands>1:
-                right_detect,right_coordinates = finger_detect_and_compute(rmList)
-                print("Right Hand Detection Array=", right_detect)
-                print("Right coordinates are", right_coordinates)
-                for i in range(5):
-                    if(right_detect[i]!=0):
-                        x,y=right_coordinates[i]
-                        img=cv2.circle(img, (int(x),int(y)), 10, (50,50,100), 5)
-                        
-            music_list_curr=build_music_list() # Build music list
-
-            if(len(music_list_curr)!=0) and music_list_curr!=music_list_prev:
-                q.put(music_list_curr) #Pass curr_music_list to another python process running play_music() function
-                music_list_prev=music_list_curr
-
-            if(len(music_list_curr)==0 and music_list_curr!=music_list_prev and status.qsize()<=1): # Empty queue if curr_music_list is empty--stop music
-                while not q.empty():
-                    q.get()
-            img_background = initialize_visualizer(img)
-            visualizer(img_background) #Visualize virtual piano onscreen
-
-            cTime = time.time()
-            fps = 1 / (cTime - pTime)
-            pTime = cTime
-            lmList=[]
-            rmList=[]
-            reinitialize() # Reinitiaizing variables to initial values!
-            cv2.putText(img_background, str(int(fps)), (10, 70), cv2.FONT_HERSHEY_PLAIN, 3,
-                        (255, 0, 255), 3)
-            cv2.imshow("Image", img_background)
-            cv2.waitKey(100)
-            time.sleep(0.1)
-    
-        except KeyboardInterrupt:
-            print("Program Execution stopped forcefully! Killing all processes!")
-            play_music_status=0
-            visualizer_status=0
-            sys.exit()
+            returns: dict """
+    return {'dist_threshold_param': dict(dist_threshold_param), 'release_threshold_scale': release_threshold_scale,
+            'press_debounce_frames': press_debounce_frames, 'release_debounce_frames': release_debounce_frames, 'min_hold_frames': min_hold_frames,
+            'landmark_smoothing': landmark_smoothing, 'smoothing_min_cutoff': smoothing_min_cutoff, 'smoothing_beta': smoothing_beta,
+            'prediction_horizon': prediction_horizon, 'velocity_sensitive': velocity_sensitive, 'press_speed_range': list(press_speed_range),
+            'note_velocity': note_velocity, 'keyboard': {'x': start_x, 'y': start_y, 'scale': keyboard_scale, 'keys': keyboard_keys},
+            'threshold_units': threshold_units, 'hand_threshold_param': hand_threshold_param, 'frame_width': frame_width,
+            'source': str(camera_url)}
+
+def build_pipeline(grabber, detector, tracker, ring, lossless=False, smoother=None, recorder=None):
+
+    """ Function: Split the per frame work into stages running in their own threads with bounded queues in between:
+                  source -> preprocess -> inference -> detection (note mapping and events) -> render
+            Arguments: grabber: started frameGrabber, detector: handDetector, tracker: noteTracker
+                       ring: eventRing the note events are pushed to
+                       lossless: process every frame instead of dropping the oldest ones (batch runs)
+                       smoother: optional landmarkFilter applied before press detection
+                       recorder: optional sessionRecorder every processed frame is appended to
+            returns: framePipeline, not started yet """
+    thresholds = threshold_vector(dist_threshold_param)
+    fps_clock = {'last': time.monotonic(), 'fps': 0.0}
+
+    def source():
+        img, frame_info = grabber.read(timeout=0.5)
+        if img is None:
+            return end_of_stream if not grabber.running else None
+        metrics.record('fetch',frame_info['fetch_ms']/1000.0); metrics.record('decode',frame_info['decode_ms']/1000.0)
+        # the grabber reuses its ring slot on the next read, so the frame is copied before it moves on
+        return {'seq': frame_info['seq'], 'timestamp': frame_info['timestamp'], 'info': frame_info, 'img': img.copy()}
+
+    def preprocess(packet):
+        packet['rgb'] = cv2.cvtColor(packet['img'], cv2.COLOR_BGR2RGB)
+        return packet
+
+    def inference(packet):
+        packet['img'] = detector.findHands(packet['img'], imgRGB=packet.pop('rgb')) #draw hand landmarks on image
+        packet['landmarks'] = detector.findPositions(packet['img']) #(hands,21,2) positions of landmarks of every hand
+        packet['handedness'] = detector.handedness()
+        return packet
+
+    def detection(packet):
+        hand_landmarks = packet['landmarks']; img = packet['img']
+        detect, coordinates, packet['keys'], events = detect_notes(hand_landmarks,packet['timestamp'],tracker,thresholds,smoother,packet['handedness'])
+        for hand,finger in zip(*np.nonzero(detect)):
+            x,y=coordinates[hand,finger]
+            cv2.circle(img, (int(x),int(y)), 10, hand_colors[hand%len(hand_colors)], 5)
+        if len(events)!=0:
+            ring.put(events)
+        if recorder is not None:
+            recorder.write(packet['seq'],packet['timestamp'],hand_landmarks,packet['handedness'],detect,events)
+        ring.frameDone()
+        metrics.count('hands',len(hand_landmarks)); metrics.count('presses',int(detect.sum())); metrics.count('note_events',len(events))
+        metrics.trace("Hand Detection Array=", detect)
+        return packet
+
+    def render(packet):
+        img = keyboard_renderer.render(packet['img'],packet['keys'])
+        now = time.monotonic()
+        fps_clock['fps'] = 1.0 / max(now - fps_clock['last'], 1e-6); fps_clock['last'] = now
+        cv2.putText(img, str(int(fps_clock['fps'])), (10, 70), cv2.FONT_HERSHEY_PLAIN, 3, (255, 0, 255), 3)
+        cv2.putText(img, "render %.1f ms" % keyboard_renderer.renderTime(), (10, 100), cv2.FONT_HERSHEY_PLAIN, 1, (255, 0, 255), 1)
+        return packet
+
+    return framePipeline(source, [('preprocess',preprocess),('inference',inference),('detection',detection),('render',render)],
+                         queue_size=pipeline_queue_size, metrics=metrics, lossless=lossless)
+
+def processor(ring, headless=False, max_frames=None):
+
+    """ Function: Primary process to read image frames from server->detect finger landmarks->find finger tip positions and build music lists.
+                  The stages run concurrently in a pipeline; this thread only displays the finished frames
+            Arguments: ring: shared memory eventRing the note events are pushed to
+                       headless: don't open a window (tests and benchmarks)
+                       max_frames: stop after this many displayed frames (None runs until interrupted or the source ends)
+            returns: pipeline stats: per stage utilization, throughput, dropped frames and backlog
+                     (raises RuntimeError after cleaning up when a stage stopped on an exception)"""
+
+    initialize_key_bboxes()
+    detector = handDetector(roi=roi_tracking, keyboard_band=(bboxes_white[:,1].min(),bboxes_white[:,3].max())) #keyboard rows stay inside the inference crop
+    tracker = noteTracker(len(key_reference), press_debounce_frames, release_debounce_frames, min_hold_frames, release_threshold_scale) #per key state, turns presses into note-on/note-off edges
+    grabber = frameGrabber(open_source(camera_url), frame_width).start() #fetches and decodes frames in the background, always handing us the latest one
+    recorder = sessionRecorder(session_dir, meta=session_meta()) if session_dir else None
+    pipeline = build_pipeline(grabber, detector, tracker, ring, smoother=make_landmark_filter(), recorder=recorder).start()
+    frames = 0
+
+    try:
+        while max_frames is None or frames < max_frames:
+            packet = pipeline.get(timeout=5)
+            if packet is None:
+                if pipeline.finished():
+                    break
+                print("No frame received from", camera_url)
+                continue
+            frames += 1
+            for stage in pipeline.stages:
+                metrics.gauge('backlog_'+stage.name, stage.outbox.qsize())
+            metrics.gauge('queue_depth',ring.qsize()); metrics.gauge('dropped_frames',grabber.dropped)
+            if not headless:
+                with metrics.stage('display'):
+                    cv2.imshow("Image", packet['img'])
+                    cv2.waitKey(1)
+            metrics.frameDone() #prints/dumps a summary every summary_interval seconds
+
+    except KeyboardInterrupt:
+        print("Program Execution stopped forcefully! Killing all processes!")
+    pipeline.stop()
+    grabber.stop()
+    if recorder is not None:
+        recorder.close()
+        print("Recorded", recorder.count, "frames to", session_dir)
+    stats = pipeline.stats()
+    print(metrics.formatSummary(metrics.summary()))
+    print("Pipeline stats:", stats)
+    print("Hand inference stats:", detector.roiStats())
+    print("Event ring stats:", ring.stats())
+    failure = pipeline.failure()
+    if failure is not None: #a failed stage closes the pipeline, which would otherwise look like the end of the input
+        raise RuntimeError("pipeline stage '%s' failed: %r" % failure) from failure[1]
+    return stats
             
 
 
@@ -452,16 +578,26 @@ def processor(q,status):
 def main():
     
     piano_key_initializer() 
+    load_calibration() #thresholds tuned by calibrate.py, inherited by the processor process
+    if player_sources: #several cameras and players sharing the hand inference processes and the audio process
+        from multi_player import run_players
+        run_players(player_sources, inference_workers)
+        return
    
-    q = multiprocessing.Queue()
-    status= multiprocessing.Queue()
+    ring = eventRing(capacity=event_ring_capacity) #shared memory ring carrying note events from processor to play_music
     # creating new processes
-    p1 = multiprocessing.Process(target=processor, args=(q,status,))
-    p2 = multiprocessing.Process(target=play_music, args=(q,status,))
+    p1 = multiprocessing.Process(target=processor, args=(ring,))
+    p2 = multiprocessing.Process(target=play_music, args=(ring,))
   
     p1.start()
     p2.start()
-    
+    try:
+        p1.join()
+        p2.join()
+    except KeyboardInterrupt:
+        p1.join()
+        p2.join()
+    ring.close() #the creator removes the shared memory segment once both processes are gone
     print("Exiting main")
 
 
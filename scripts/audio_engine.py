@@ -0,0 +1,328 @@
+# Real-time / offline polyphonic audio engine driven by note-on/note-off events
+import pygame
+import pygame.mixer
+import numpy as np
+import collections
+import queue
+import wave
+import time
+import os
+import sys
+import argparse
+
+NOTE_ON = 1; NOTE_OFF = 2; SUSTAIN_ON = 3; SUSTAIN_OFF = 4 #event kinds
+note_event_dtype = np.dtype([('kind', np.uint8), ('note', np.uint8), ('velocity', np.uint8), ('time', np.float64)]) #packed binary form of an event (11 bytes)
+player_event_dtype = np.dtype(note_event_dtype.descr + [('player', np.uint8)]) #event of one of several players sharing an audio process (see mixingEngine)
+
+
+def note_on(note, velocity=100, timestamp=None):
+
+    """ Function: Build a note-on event
+            Arguments: note: note id (position in key_reference), velocity: 1-127, timestamp: time.monotonic() of the press (capture time of the frame)
+            returns: event tuple (kind, note, velocity, timestamp) """
+    return (NOTE_ON, int(note), int(velocity), time.monotonic() if timestamp is None else timestamp)
+
+
+def note_off(note, timestamp=None):
+    return (NOTE_OFF, int(note), 0, time.monotonic() if timestamp is None else timestamp)
+
+
+def pack_events(events):
+
+    """ Function: Pack events into bytes (11 bytes per event) for sending to the audio process
+            Arguments: events: list of (kind, note, velocity, timestamp) tuples
+            returns: bytes """
+    return np.array([tuple(e) for e in events], dtype=note_event_dtype).tobytes()
+
+
+def unpack_events(data):
+
+    """ Function: Inverse of pack_events()
+            Arguments: data: bytes from pack_events()
+            returns: note_event_dtype array, its records can be passed to audioEngine.handle() """
+    return np.frombuffer(data, dtype=note_event_dtype)
+
+
+class audioEngine():
+    def __init__(self, bank, polyphony=10, release_ms=250, offline=False, first_channel=0, gain=1.0):
+
+        """ Function: Voice pool playing samples from a sampleBank
+            Arguments: bank: sampleBank with the decoded piano samples
+                       polyphony: max number of voices sounding at once, the oldest voice is stolen beyond that
+                       release_ms: fade out time after a note-off
+                       offline: if True nothing is sent to the sound card, audio is mixed by render() instead
+                       first_channel: first pygame mixer channel of the voices, so several engines can share the mixer
+                       gain: volume of this engine (0-1), applied on top of the note velocity
+            returns: None """
+        self.bank = bank
+        self.polyphony = polyphony
+        self.release_ms = release_ms
+        self.offline = offline
+        self.gain = gain
+        self.frequency = bank.frequency
+        self.channels = bank.channels
+        self.voice_note = np.full(polyphony, -1, dtype=np.int64) #note id per voice, -1 if the voice is free
+        self.voice_start = np.zeros(polyphony) #time the voice started, used to steal the oldest voice
+        self.voice_gain = np.zeros(polyphony)
+        self.voice_released = np.zeros(polyphony, dtype=bool) #True once fading out
+        self.voice_held = np.zeros(polyphony, dtype=bool) #note-off received while the sustain pedal is down
+        self.voice_pos = np.zeros(polyphony, dtype=np.int64) #next sample frame to mix (offline mode)
+        self.voice_release_pos = np.zeros(polyphony, dtype=np.int64) #frames of release fade already applied (offline mode)
+        self.sustain = False
+        self.clock = 0.0 #current engine time in seconds (offline mode)
+        self.stolen = 0 #voices stolen because the pool was full
+        self.latencies = collections.deque(maxlen=1000) #seconds from the event timestamp to the voice starting
+        if not offline:
+            if pygame.mixer.get_num_channels() < first_channel + polyphony:
+                pygame.mixer.set_num_channels(first_channel + polyphony)
+            self.mixer_channels = [pygame.mixer.Channel(first_channel + i) for i in range(polyphony)]
+
+    def now(self):
+        return self.clock if self.offline else time.monotonic() #monotonic clock is shared by all processes, so event timestamps compare directly
+
+    def handle(self, event):
+
+        """ Function: Apply one event to the voice pool. Never blocks
+            Arguments: self, event: (kind, note, velocity, timestamp) tuple or note_event_dtype record
+            returns: None """
+        kind, note, velocity, timestamp = event
+        if kind == NOTE_ON:
+            self.noteOn(int(note), int(velocity), timestamp)
+        elif kind == NOTE_OFF:
+            self.noteOff(int(note))
+        elif kind == SUSTAIN_ON:
+            self.sustain = True
+        elif kind == SUSTAIN_OFF:
+            self.sustain = False
+            for voice in np.flatnonzero(self.voice_held):
+                self.release(voice)
+
+    def allocate(self, note):
+
+        """ Function: Pick the voice for a new note: the voice already playing this note, else a free voice,
+                      else the oldest releasing voice, else the oldest voice
+            Arguments: self, note: note id
+            returns: voice index """
+        same = np.flatnonzero(self.voice_note == note)
+        if len(same):
+            return same[0]
+        free = np.flatnonzero(self.voice_note < 0)
+        if len(free):
+            return free[0]
+        self.stolen += 1
+        released = np.flatnonzero(self.voice_released)
+        if len(released):
+            return released[np.argmin(self.voice_start[released])]
+        return int(np.argmin(self.voice_start))
+
+    def noteOn(self, note, velocity=100, timestamp=None):
+        if self.bank.paths[note] is None:
+            return
+        voice = self.allocate(note)
+        self.voice_note[voice] = note
+        self.voice_start[voice] = self.now()
+        self.voice_gain[voice] = velocity / 127.0 * self.gain
+        self.voice_released[voice] = False
+        self.voice_held[voice] = False
+        self.voice_pos[voice] = 0
+        self.voice_release_pos[voice] = 0
+        if not self.offline:
+            chan = self.mixer_channels[voice]
+            chan.play(self.bank.sound(note))
+            chan.set_volume(self.voice_gain[voice])
+        if timestamp is not None:
+            self.latencies.append(self.now() - timestamp)
+
+    def noteOff(self, note):
+        for voice in np.flatnonzero((self.voice_note == note) & ~self.voice_released):
+            if self.sustain:
+                self.voice_held[voice] = True
+            else:
+                self.release(voice)
+
+    def release(self, voice):
+        self.voice_released[voice] = True
+        self.voice_held[voice] = False
+        if not self.offline:
+            self.mixer_channels[voice].fadeout(int(self.release_ms))
+
+    def update(self):
+
+        """ Function: Free voices whose sample or release fade has finished (real-time mode)
+            Arguments: self
+            returns: number of active voices """
+        if not self.offline:
+            for voice in np.flatnonzero(self.voice_note >= 0):
+                if not self.mixer_channels[voice].get_busy():
+                    self.voice_note[voice] = -1
+        return int(np.count_nonzero(self.voice_note >= 0))
+
+    def mix(self, out):
+
+        """ Function: Mix all active voices into an output block and advance them (offline mode)
+            Arguments: self, out: (frames, channels) float32 block to add into
+            returns: None """
+        frames = len(out)
+        release_frames = max(1, int(self.release_ms * self.frequency / 1000))
+        for voice in np.flatnonzero(self.voice_note >= 0):
+            pcm = self.bank.samples(self.voice_note[voice])
+            pos = self.voice_pos[voice]
+            n = min(frames, len(pcm) - pos)
+            gain = np.full(n, self.voice_gain[voice], dtype=np.float32)
+            if self.voice_released[voice]:
+                done = self.voice_release_pos[voice]
+                n = min(n, release_frames - done)
+                gain = gain[:n] * (1.0 - (done + np.arange(n, dtype=np.float32)) / release_frames)
+                self.voice_release_pos[voice] += n
+            if n > 0:
+                out[:n] += pcm[pos:pos + n] * gain[:, None]
+            self.voice_pos[voice] += max(n, 0)
+            if n < frames:
+                self.voice_note[voice] = -1 #sample or release fade ended within this block
+
+    def render(self, events, duration=None, tail=1.0):
+
+        """ Function: Offline render of an event stream, sample accurate, without a sound card
+            Arguments: self, events: iterable of (kind, note, velocity, timestamp) with timestamps in seconds from the start
+                       duration: length of the output in seconds (default: last event + tail)
+                       tail: seconds rendered after the last event when duration is None
+            returns: pcm: (frames, channels) int16 array at the bank frequency """
+        events = sorted(events, key=lambda e: e[3])
+        end = duration if duration is not None else (events[-1][3] + tail if events else tail)
+        return np.clip(self.mixEvents(events, int(end * self.frequency)), -32768, 32767).astype(np.int16)
+
+    def mixEvents(self, events, total):
+
+        """ Function: Offline mix of time sorted events into a new block, render() without the final clipping
+            Arguments: self, events: (kind, note, velocity, seconds) sorted by time, total: length of the block in sample frames
+            returns: (total, channels) float32 array """
+        out = np.zeros((total, self.channels), dtype=np.float32)
+        pos = 0
+        for event in events:
+            target = min(total, max(pos, int(event[3] * self.frequency)))
+            if target > pos:
+                self.mix(out[pos:target])
+                pos = target
+            self.clock = pos / float(self.frequency)
+            self.handle((event[0], event[1], event[2], None))
+        if pos < total:
+            self.mix(out[pos:])
+        self.clock = total / float(self.frequency)
+        return out
+
+    def stats(self):
+        lat = np.array(self.latencies) * 1000
+        return {'active_voices': int(np.count_nonzero(self.voice_note >= 0)),
+                'stolen_voices': self.stolen,
+                'latency_ms_p50': float(np.percentile(lat, 50)) if len(lat) else 0.0,
+                'latency_ms_max': float(lat.max()) if len(lat) else 0.0}
+
+
+class mixingEngine():
+    def __init__(self, bank, players, polyphony=10, release_ms=250, offline=False, gains=None):
+
+        """ Function: One audio output shared by several players. Every player gets its own voice pool (a player never
+                      steals another's voices or releases their sustain pedal) and volume, all mixed into the same output
+            Arguments: bank: sampleBank shared by all players, players: player names (or their number)
+                       polyphony: voices per player, release_ms/offline: see audioEngine
+                       gains: optional volume per player (0-1)
+            returns: None """
+        self.names = ['player%d' % i for i in range(players)] if isinstance(players, int) else list(players)
+        gains = [1.0] * len(self.names) if gains is None else list(gains)
+        self.engines = [audioEngine(bank, polyphony, release_ms, offline, first_channel=i * polyphony, gain=gains[i]) for i in range(len(self.names))]
+        self.frequency = bank.frequency
+        self.channels = bank.channels
+        self.unknown = 0 #events of players without a voice pool
+
+    def handle(self, event):
+
+        """ Function: Route one event to the voice pool of its player. Never blocks
+            Arguments: self, event: (kind, note, velocity, timestamp, player) tuple or player_event_dtype record
+            returns: None """
+        kind, note, velocity, timestamp, player = event
+        if player >= len(self.engines):
+            self.unknown += 1
+            return
+        self.engines[player].handle((kind, note, velocity, timestamp))
+
+    def update(self):
+        return sum(engine.update() for engine in self.engines)
+
+    def render(self, events, duration=None, tail=1.0):
+
+        """ Function: Offline render of the events of all players into one track
+            Arguments: self, events: (kind, note, velocity, seconds, player) tuples, duration/tail: see audioEngine.render()
+            returns: pcm: (frames, channels) int16 array at the bank frequency """
+        events = sorted(events, key=lambda e: e[3])
+        end = duration if duration is not None else (events[-1][3] + tail if events else tail)
+        total = int(end * self.frequency)
+        out = np.zeros((total, self.channels), dtype=np.float32)
+        for player, engine in enumerate(self.engines):
+            out += engine.mixEvents([e[:4] for e in events if e[4] == player], total)
+        return np.clip(out, -32768, 32767).astype(np.int16)
+
+    def stats(self):
+        return dict({name: engine.stats() for name, engine in zip(self.names, self.engines)}, unknown_player_events=self.unknown)
+
+
+def write_wav(path, pcm, frequency):
+
+    """ Function: Save int16 PCM to a WAV file
+            Arguments: path: output file, pcm: (frames, channels) int16 array, frequency: sample rate
+            returns: None """
+    pcm = np.asarray(pcm, dtype=np.int16).reshape(len(pcm), -1)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(frequency)
+        f.writeframes(pcm.tobytes())
+
+
+def run_engine(q, engine, poll=0.005):
+
+    """ Function: Real-time loop of the audio process: apply events as they arrive and free finished voices
+            Arguments: q: eventRing the processor pushes note events to; get() returns the pending event records
+                          (anything with the same get(timeout) interface works, lists of events or packed bytes included)
+                       engine: audioEngine
+                       poll: max seconds to wait for events before housekeeping
+            returns: None """
+    while True:
+        try:
+            events = q.get(timeout=poll)
+        except queue.Empty:
+            events = []
+        if isinstance(events, bytes):
+            events = unpack_events(events)
+        for event in events:
+            engine.handle(event)
+        engine.update()
+
+
+if __name__ == "__main__":
+    from Virtual_Piano import key_reference, piano_key_initializer, music_dir
+    from sample_bank import sampleBank
+    parser = argparse.ArgumentParser(description='Offline render benchmark of the audio engine')
+    parser.add_argument('--dir', default=music_dir, help='directory with the 88 piano key samples')
+    parser.add_argument('--events', type=int, default=2000, help='number of random notes to render')
+    parser.add_argument('--rate', type=float, default=20.0, help='notes per second')
+    parser.add_argument('--polyphony', type=int, default=10)
+    parser.add_argument('--wav', default=None, help='save the rendered audio to this file')
+    args = parser.parse_args()
+    piano_key_initializer()
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy') #offline render, no sound card needed
+    pygame.mixer.init()
+    bank = sampleBank(args.dir, key_reference)
+    engine = audioEngine(bank, polyphony=args.polyphony, offline=True)
+    rng = np.random.default_rng(0)
+    starts = np.cumsum(rng.exponential(1.0 / args.rate, args.events))
+    notes = rng.integers(0, len(key_reference), args.events)
+    events = [note_on(n, 100, t) for n, t in zip(notes, starts)] + [note_off(n, t + 0.3) for n, t in zip(notes, starts)]
+    t0 = time.perf_counter()
+    pcm = engine.render(events)
+    elapsed = time.perf_counter() - t0
+    audio_s = len(pcm) / float(bank.frequency)
+    print("Rendered", audio_s, "s of audio from", len(events), "events in", elapsed, "s (", audio_s / elapsed, "x real time,", len(events) / elapsed, "events/s )")
+    print(engine.stats())
+    if args.wav:
+        write_wav(args.wav, pcm, bank.frequency)
+    sys.exit()
@@ -0,0 +1,459 @@
+# Offline benchmark of every stage of Virtual_Piano.py using recorded frame and landmark fixtures
+import cv2
+import numpy as np
+import contextlib
+import tracemalloc
+import resource
+import argparse
+import queue
+import json
+import time
+import os
+import sys
+import Virtual_Piano as vp
+from frame_source import frameGrabber, open_source, image_extensions
+from press_detector import detect_presses, threshold_vector, pressed_positions, normalized_distances, press_landmarks
+from landmark_filter import landmarkFilter
+from audio_engine import note_on, note_off
+from event_ring import eventRing
+from note_tracker import noteTracker
+
+
+def save_landmark_fixture(path, landmarks, timestamps, frame_size):
+
+    """ Function: Save a landmark sequence recorded from handDetector.findPositions()
+            Arguments: path: output .npz file
+                       landmarks: list with one (hands,21,2) array per frame
+                       timestamps: capture time of every frame
+                       frame_size: (width, height) of the frames the landmarks refer to
+            returns: None """
+    counts = np.array([len(l) for l in landmarks], dtype=np.int64)
+    stacked = np.concatenate([np.asarray(l).reshape(-1, 21, 2) for l in landmarks]) if len(landmarks) else np.zeros((0, 21, 2))
+    np.savez_compressed(path, landmarks=stacked.astype(np.int32), hand_counts=counts, timestamps=np.asarray(timestamps, dtype=np.float64), frame_size=np.array(frame_size))
+
+
+def load_landmark_fixture(path):
+
+    """ Function: Load a landmark sequence saved by save_landmark_fixture()
+            Arguments: path: .npz file
+            returns: list with one (hands,21,2) array per frame, timestamps, frame_size """
+    data = np.load(path)
+    offsets = np.concatenate([[0], np.cumsum(data['hand_counts'])])
+    frames = [data['landmarks'][offsets[i]:offsets[i + 1]] for i in range(len(data['hand_counts']))]
+    return frames, data['timestamps'], tuple(data['frame_size'])
+
+
+def synthetic_landmarks(frames, hands=2, seed=0):
+
+    """ Function: Generate hands hovering over the keyboard band, for running the benchmark without any recording
+            Arguments: frames: number of frames, hands: hands per frame, seed: random seed
+            returns: list with one (hands,21,2) array per frame """
+    rng = np.random.default_rng(seed)
+    centres = np.array([vp.start_x + 26 * vp.white_key_width, vp.start_y + vp.white_key_height // 2])
+    out = []
+    for i in range(frames):
+        base = centres + rng.integers(-200, 200, (hands, 1, 2)) * [1, 0.2]
+        out.append((base + rng.integers(-30, 30, (hands, 21, 2))).astype(np.int32))
+    return out
+
+
+def synthetic_presses(frames, fps=30.0, noise=2.0, seed=0):
+
+    """ Function: One hand pressing keys with its index finger, with landmark jitter and a known ground truth
+            Arguments: frames: number of frames, fps: frame rate of the timestamps
+                       noise: standard deviation of the landmark jitter in pixels, seed: random seed
+            returns: landmarks: list with one (1,21,2) array per frame, timestamps,
+                     truth: (frames,1,5) bool, True where the noise free finger is below its press threshold """
+    rng = np.random.default_rng(seed)
+    depth = np.zeros(frames) #0 = finger raised, 1 = fully pressed
+    i = 10
+    while i < frames:
+        ramp = rng.integers(3, 7); hold = rng.integers(3, 12)
+        shape = np.concatenate([np.linspace(0, 1, ramp, endpoint=False), np.ones(hold), np.linspace(1, 0, ramp)])
+        depth[i:i + len(shape)] = shape[:max(0, frames - i)]
+        i += len(shape) + rng.integers(5, 20)
+    thresholds = threshold_vector(vp.dist_threshold_param)
+    base = np.array([vp.start_x + 26 * vp.white_key_width, vp.start_y - 20], dtype=np.float64) #pressing finger tips land on a white key
+    landmarks = []; truth = np.zeros((frames, 1, 5), dtype=bool)
+    for f in range(frames):
+        hand = np.tile(base, (21, 1))
+        hand[0] = base + [0, -80] #wrist, above the knuckles so the palm has its usual size
+        for finger, (p1, p2, p3) in enumerate(press_landmarks):
+            a = 30 * (1 - 0.65 * depth[f]) if finger == 1 else 30.0 #segment length shrinks as the finger bends onto the key
+            x = base[0] + (finger - 2) * 20
+            hand[p1 - 1] = (x, base[1] - 10) #knuckle
+            hand[p1] = (x, base[1]); hand[p2] = (x, base[1] + a); hand[p3] = (x + 4, base[1] + 2 * a)
+        truth[f, 0] = normalized_distances(hand[None], vp.threshold_units, vp.frame_width)[0] < thresholds
+        landmarks.append((hand + rng.normal(0, noise, hand.shape))[None].round().astype(np.int32))
+    return landmarks, np.arange(frames) / float(fps), truth
+
+
+def press_episodes(mask):
+
+    """ Function: Press intervals of every finger in a sequence of press masks
+            Arguments: mask: (frames,hands,5) bool
+            returns: list of (hand, finger, first frame, length) """
+    episodes = []
+    padded = np.concatenate([np.zeros((1,) + mask.shape[1:], bool), mask, np.zeros((1,) + mask.shape[1:], bool)]).astype(np.int8)
+    edges = np.diff(padded, axis=0)
+    for hand, finger in zip(*np.nonzero(edges.any(0))):
+        starts = np.flatnonzero(edges[:, hand, finger] == 1); stops = np.flatnonzero(edges[:, hand, finger] == -1)
+        episodes += [(hand, finger, a, b - a) for a, b in zip(starts, stops)]
+    return episodes
+
+
+def filter_eval(landmarks, timestamps, truth=None, min_frames=2, window=4):
+
+    """ Function: Compare press detection on raw landmarks with the smoothed and predicted landmarks
+            Arguments: landmarks: per frame (hands,21,2) arrays, timestamps: capture times
+                       truth: optional (frames,hands,5) ground truth press mask (synthetic_presses()); without it the raw
+                              presses lasting at least min_frames frames are the reference
+                       min_frames: presses shorter than this count as flicker
+                       window: frames a detected press may be away from a reference press to be matched
+            returns: dict per variant (raw, smoothed, smoothed+predicted) with false press rate and trigger latency,
+                     plus the filter cost per frame """
+    hands = max([len(l) for l in landmarks] + [1])
+    thresholds = threshold_vector(vp.dist_threshold_param)
+    variants = {'raw': None,
+                'smoothed': landmarkFilter(vp.smoothing_min_cutoff, vp.smoothing_beta, prediction=0.0),
+                'smoothed+predicted': landmarkFilter(vp.smoothing_min_cutoff, vp.smoothing_beta, prediction=vp.prediction_horizon)}
+    masks = {}; cost = {}
+    for name, smoother in variants.items():
+        tracker = noteTracker(len(vp.key_reference), release_scale=vp.release_threshold_scale)
+        mask = np.zeros((len(landmarks), hands, 5), dtype=bool); spent = 0.0
+        for i, (l, t) in enumerate(zip(landmarks, timestamps)):
+            t0 = time.perf_counter()
+            if smoother is None:
+                distances = normalized_distances(l, vp.threshold_units, vp.frame_width)
+            else:
+                filtered = smoother.filter(l, t)
+                distances = np.minimum(normalized_distances(filtered, vp.threshold_units, vp.frame_width),
+                                       normalized_distances(smoother.predict(), vp.threshold_units, vp.frame_width))
+            spent += time.perf_counter() - t0
+            mask[i, :len(l)] = tracker.fingerMask(distances, thresholds) != 0
+        masks[name] = mask; cost[name] = spent / max(1, len(landmarks)) * 1000
+    if truth is None:
+        reference = [e for e in press_episodes(masks['raw']) if e[3] >= min_frames]
+    else:
+        reference = press_episodes(np.asarray(truth, dtype=bool))
+    frame_time = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 1 / 30.0
+    results = {}
+    for name, mask in masks.items():
+        detected = press_episodes(mask)
+        latencies = []; false_presses = 0
+        for hand, finger, start, length in detected:
+            match = [r for r in reference if r[0] == hand and r[1] == finger and r[2] - window <= start < r[2] + r[3]]
+            if match:
+                latencies.append((start - match[0][2]) * frame_time * 1000)
+            else:
+                false_presses += 1
+        results[name] = {'presses': len(detected), 'reference_presses': len(reference),
+                         'false_presses': false_presses, 'false_press_rate': false_presses / float(max(1, len(detected))),
+                         'flicker_presses': sum(1 for e in detected if e[3] < min_frames),
+                         'matched': len(latencies), 'trigger_latency_ms': float(np.mean(latencies)) if latencies else 0.0,
+                         'filter_ms_per_frame': cost[name]}
+    return results
+
+
+def load_frames(path, limit=None):
+
+    """ Function: Read encoded frames of a fixture (image directory or video file) into memory
+            Arguments: path: image directory or video file, limit: max number of frames
+            returns: list of encoded JPEG buffers """
+    frames = []
+    if os.path.isdir(path):
+        for f in sorted(os.listdir(path)):
+            if f.lower().endswith(image_extensions):
+                frames.append(np.fromfile(os.path.join(path, f), dtype=np.uint8))
+            if limit and len(frames) >= limit:
+                break
+    else:
+        cap = cv2.VideoCapture(path)
+        while not limit or len(frames) < limit:
+            ok, img = cap.read()
+            if not ok:
+                break
+            frames.append(cv2.imencode('.jpg', img)[1])
+        cap.release()
+    return frames
+
+
+def summarize(times, memory):
+
+    """ Function: Latency percentiles and throughput of a stage
+            Arguments: times: per call durations in seconds, memory: peak python allocations of the stage in bytes
+            returns: dict of statistics """
+    ms = np.asarray(times) * 1000
+    return {'calls': len(ms),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'mean_ms': float(ms.mean()),
+            'throughput_per_s': float(len(ms) / max(ms.sum() / 1000, 1e-12)),
+            'peak_alloc_kb': memory / 1024.0}
+
+
+def run_stage(fn, items, iterations, warmup=5):
+
+    """ Function: Time a stage over the fixture items, then measure its python allocations on a short second pass
+            Arguments: fn: stage function taking one fixture item, items: fixture items (cycled)
+                       iterations: number of timed calls, warmup: untimed calls first
+            returns: dict of statistics """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): #stages still print, keep the terminal clean
+        for i in range(min(warmup, iterations)):
+            fn(items[i % len(items)])
+        times = np.empty(iterations)
+        for i in range(iterations):
+            item = items[i % len(items)]
+            t0 = time.perf_counter()
+            fn(item)
+            times[i] = time.perf_counter() - t0
+        tracemalloc.start()
+        for i in range(min(20, iterations)):
+            fn(items[i % len(items)])
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(times, memory)
+
+
+def benchmark(frames, landmarks, frame_size, iterations, inference=True, samples=None):
+
+    """ Function: Run every stage of the pipeline on the fixtures
+            Arguments: frames: encoded frames (may be empty), landmarks: per frame (hands,21,2) arrays
+                       frame_size: (width, height) of the landmark frames, iterations: timed calls per stage
+                       inference: run the MediaPipe stages (needs frames)
+                       samples: sample directory, enables the audio engine stage
+            returns: dict stage name -> statistics """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        vp.piano_key_initializer()
+        vp.initialize_key_bboxes()
+    results = {}
+    thresholds = threshold_vector(vp.dist_threshold_param)
+    canvas = np.zeros((frame_size[1], frame_size[0], 3), dtype=np.uint8)
+    presses = [detect_presses(l, thresholds, vp.threshold_units, vp.frame_width) for l in landmarks]
+    positions = [pressed_positions(d, c) for d, c in presses]
+    notes = []; pressed_keys = []
+    for pos in positions:
+        vp.key_index_array = []
+        notes.append(vp.find_music_list(pos, len(pos)) if len(pos) else [])
+        pressed_keys.append(list(vp.key_index_array))
+
+    if frames:
+        def decode(buf):
+            img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+            return cv2.resize(img, (640, int(img.shape[0] * 640.0 / img.shape[1])), interpolation=cv2.INTER_AREA)
+        results['decode_resize'] = run_stage(decode, frames, iterations)
+        if inference:
+            detector = vp.handDetector()
+            decoded = [decode(f) for f in frames[:50]]
+            results['findHands'] = run_stage(lambda img: detector.findHands(img.copy()), decoded, iterations)
+            results['findPosition'] = run_stage(lambda img: detector.findPosition(img, 0), decoded[-1:], iterations)
+            results['findPositions'] = run_stage(lambda img: detector.findPositions(img), decoded[-1:], iterations)
+
+    hand_lists = [np.concatenate([np.arange(21)[:, None], l[0]], 1) for l in landmarks if len(l)]
+    if hand_lists:
+        results['finger_detect_and_compute'] = run_stage(vp.finger_detect_and_compute, hand_lists, iterations)
+    results['detect_presses'] = run_stage(lambda l: detect_presses(l, thresholds, vp.threshold_units, vp.frame_width), landmarks, iterations)
+    smoother = landmarkFilter(vp.smoothing_min_cutoff, vp.smoothing_beta, prediction=vp.prediction_horizon)
+
+    def smooth(i):
+        filtered = smoother.filter(landmarks[i], i / 30.0)
+        return np.minimum(normalized_distances(filtered, vp.threshold_units, vp.frame_width),
+                          normalized_distances(smoother.predict(), vp.threshold_units, vp.frame_width)), smoother.tipSpeed()
+    results['landmark_filter'] = run_stage(smooth, list(range(len(landmarks))), iterations)
+    results['find_note'] = run_stage(vp.find_note, [p for pos in positions for p in pos] or [(0, 0)], iterations)
+
+    def music_list(pos):
+        vp.key_index_array = []
+        return vp.find_music_list(pos, len(pos))
+    results['find_music_list'] = run_stage(music_list, positions, iterations)
+
+    def render(i):
+        vp.key_index_array = list(pressed_keys[i])
+        vp.visualizer(vp.initialize_visualizer(canvas))
+    results['initialize_visualizer+visualizer'] = run_stage(render, list(range(len(positions))), iterations)
+
+    tracker = noteTracker(len(vp.key_reference), vp.press_debounce_frames, vp.release_debounce_frames, vp.min_hold_frames, vp.release_threshold_scale)
+
+    ring = eventRing(capacity=vp.event_ring_capacity)
+
+    def dispatch(i):
+        ring.put(tracker.update(notes[i], time.monotonic())) #processor side, as in the detection stage
+        ring.frameDone()
+        try:
+            ring.get(timeout=0) #audio side, as in run_engine()
+        except queue.Empty:
+            pass
+    try:
+        results['audio_dispatch'] = run_stage(dispatch, list(range(len(notes))), iterations)
+    finally:
+        ring.close()
+
+    if samples:
+        import pygame
+        from sample_bank import sampleBank
+        from audio_engine import audioEngine
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        pygame.mixer.init()
+        engine = audioEngine(sampleBank(samples, vp.key_reference), polyphony=vp.polyphony, offline=True)
+        block = np.zeros((int(engine.frequency / 30), engine.channels), dtype=np.float32) #one frame worth of audio at 30fps
+
+        def engine_step(i):
+            prev = set(notes[i - 1]); curr = set(notes[i])
+            for n in sorted(curr - prev):
+                engine.handle(note_on(n, 100, None))
+            for n in sorted(prev - curr):
+                engine.handle(note_off(n, None))
+            block[:] = 0
+            engine.mix(block)
+        results['audio_engine'] = run_stage(engine_step, list(range(len(notes))), iterations)
+    return results
+
+
+def compare(results, baseline, tolerance):
+
+    """ Function: Compare p50/p95 latencies against a previous run
+            Arguments: results, baseline: benchmark dicts, tolerance: allowed relative slowdown (0.2 = 20%)
+            returns: list of (stage, metric, old, new) regressions """
+    regressions = []
+    for stage, stats in results['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms'):
+            if stats[metric] > old[metric] * (1 + tolerance) and stats[metric] - old[metric] > 0.01:
+                regressions.append((stage, metric, old[metric], stats[metric]))
+    return regressions
+
+
+def roi_eval(frames):
+
+    """ Function: Compare region of interest inference against full frame inference on recorded frames
+            Arguments: frames: encoded frames of a fixture, in recording order
+            returns: dict with inference times, time saved and landmark/press agreement with the full frame results """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        vp.piano_key_initializer()
+        vp.initialize_key_bboxes()
+    band = (vp.bboxes_white[:, 1].min(), vp.bboxes_white[:, 3].max())
+    full = vp.handDetector()
+    roi = vp.handDetector(roi=True, keyboard_band=band)
+    thresholds = threshold_vector(vp.dist_threshold_param)
+    full_times = []; roi_times = []; errors = []; count_match = 0; press_match = 0; press_total = 0
+    for buf in frames:
+        img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        img = cv2.resize(img, (640, int(img.shape[0] * 640.0 / img.shape[1])), interpolation=cv2.INTER_AREA)
+        t0 = time.perf_counter(); full.findHands(img, draw=False); full_times.append(time.perf_counter() - t0)
+        t0 = time.perf_counter(); roi.findHands(img, draw=False); roi_times.append(time.perf_counter() - t0)
+        a = full.findPositions(img); b = roi.findPositions(img)
+        count_match += len(a) == len(b)
+        if len(a) and len(b):
+            ca = a.mean(1); cb = b.mean(1) #match every full frame hand to the nearest roi hand
+            nearest = np.argmin(np.linalg.norm(ca[:, None] - cb[None], axis=-1), axis=1)
+            errors.append(float(np.linalg.norm(a - b[nearest], axis=-1).mean()))
+            press_match += int(np.count_nonzero(detect_presses(a, thresholds, vp.threshold_units, 640)[0] == detect_presses(b[nearest], thresholds, vp.threshold_units, 640)[0]))
+            press_total += a.shape[0] * 5
+    full_ms = float(np.mean(full_times) * 1000) if full_times else 0.0
+    roi_ms = float(np.mean(roi_times) * 1000) if roi_times else 0.0
+    return {'frames': len(frames), 'full_ms': full_ms, 'roi_ms': roi_ms, 'saved_ms_per_frame': full_ms - roi_ms,
+            'roi_fraction': roi.roiStats()['roi_fraction'],
+            'hand_count_agreement': count_match / float(max(1, len(frames))),
+            'landmark_error_px': float(np.mean(errors)) if errors else 0.0,
+            'press_agreement': press_match / float(max(1, press_total))}
+
+
+def record(source, out_dir, count, fps=None):
+
+    """ Function: Record a fixture from any frame source: JPEG frames plus the landmarks found in them
+            Arguments: source: frame source spec (url, webcam index, video file, image directory)
+                       out_dir: output directory (frames/ and landmarks.npz are written there)
+                       count: number of frames to record, fps: optional capture rate limit
+            returns: None """
+    os.makedirs(os.path.join(out_dir, 'frames'), exist_ok=True)
+    grabber = frameGrabber(open_source(source)).start()
+    detector = vp.handDetector()
+    landmarks = []; timestamps = []; size = None
+    try:
+        while len(landmarks) < count:
+            img, info = grabber.read(timeout=5)
+            if img is None:
+                break
+            img = img.copy()
+            cv2.imwrite(os.path.join(out_dir, 'frames', '%06d.jpg' % len(landmarks)), img)
+            detector.findHands(img, draw=False)
+            landmarks.append(detector.findPositions(img))
+            timestamps.append(info['timestamp'])
+            size = (img.shape[1], img.shape[0])
+            if fps:
+                time.sleep(1.0 / fps)
+    finally:
+        grabber.stop()
+    save_landmark_fixture(os.path.join(out_dir, 'landmarks.npz'), landmarks, timestamps, size or (640, 480))
+    print("Recorded", len(landmarks), "frames to", out_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the virtual piano on recorded fixtures')
+    parser.add_argument('--fixture', default=None, help='fixture directory written by --record (frames/ and landmarks.npz)')
+    parser.add_argument('--frames', default=None, help='video file or image directory to use for the frame stages')
+    parser.add_argument('--landmarks', default=None, help='landmark fixture (.npz)')
+    parser.add_argument('--synthetic', type=int, default=0, help='generate this many frames of synthetic landmarks if none are given')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--no-inference', action='store_true', help='skip the MediaPipe stages')
+    parser.add_argument('--samples', default=None, help='piano sample directory, enables the audio engine stage')
+    parser.add_argument('--output', default=None, help='write results to this JSON file')
+    parser.add_argument('--compare', default=None, help='previous JSON results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a stage counts as a regression')
+    parser.add_argument('--roi-eval', action='store_true', help='compare region of interest inference with full frame inference on the fixture frames')
+    parser.add_argument('--filter-eval', action='store_true', help='false press rate and trigger latency with and without landmark smoothing/prediction '
+                        '(on --landmarks/--fixture, else on synthetic presses with a known ground truth)')
+    parser.add_argument('--noise', type=float, default=2.0, help='landmark jitter in pixels of the synthetic presses used by --filter-eval')
+    parser.add_argument('--record', default=None, help='record a new fixture into this directory instead of benchmarking')
+    parser.add_argument('--source', default=vp.camera_url, help='frame source used by --record')
+    parser.add_argument('--count', type=int, default=300, help='frames recorded by --record')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.source, args.record, args.count)
+        sys.exit()
+
+    if args.fixture:
+        args.frames = args.frames or os.path.join(args.fixture, 'frames')
+        args.landmarks = args.landmarks or os.path.join(args.fixture, 'landmarks.npz')
+    frames = load_frames(args.frames) if args.frames else []
+    if args.roi_eval:
+        print(json.dumps(roi_eval(frames), indent=2))
+        sys.exit()
+    if args.filter_eval:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            vp.piano_key_initializer()
+        if args.landmarks:
+            landmarks, timestamps, frame_size = load_landmark_fixture(args.landmarks)
+            print(json.dumps(filter_eval(landmarks, timestamps), indent=2))
+        else:
+            landmarks, timestamps, truth = synthetic_presses(args.synthetic or 3000, noise=args.noise)
+            print(json.dumps(filter_eval(landmarks, timestamps, truth), indent=2))
+        sys.exit()
+    if args.landmarks:
+        landmarks, timestamps, frame_size = load_landmark_fixture(args.landmarks)
+    else:
+        landmarks = synthetic_landmarks(args.synthetic or 300)
+        frame_size = (640, 480)
+    stages = benchmark(frames, landmarks, frame_size, args.iterations, inference=not args.no_inference, samples=args.samples)
+    results = {'stages': stages,
+               'fixture': {'frames': len(frames), 'landmark_frames': len(landmarks), 'hands': int(sum(len(l) for l in landmarks))},
+               'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'timestamp': time.time()}
+
+    print("%-34s %8s %8s %8s %12s %10s" % ('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/s', 'alloc KB'))
+    for stage, s in stages.items():
+        print("%-34s %8.3f %8.3f %8.3f %12.1f %10.1f" % (stage, s['p50_ms'], s['p95_ms'], s['p99_ms'], s['throughput_per_s'], s['peak_alloc_kb']))
+    print("max RSS (KB):", results['max_rss_kb'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stage, metric, old, new in regressions:
+            print("REGRESSION", stage, metric, "%.3f -> %.3f ms" % (old, new))
+        sys.exit(1 if regressions else 0)
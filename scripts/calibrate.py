@@ -0,0 +1,245 @@
+# Automatic calibration of the per finger (and per hand) press thresholds from labelled session recordings
+import numpy as np
+import multiprocessing
+import json
+import time
+import os
+import tempfile
+import sys
+import argparse
+from press_detector import finger_names, palm_size, threshold_vector, hysteresis_masks
+from session_log import sessionReader, session_distances, labels_file
+
+sides = ['left', 'right', 'unknown'] #handedness codes 0, 1 and 255 (hands without a classification)
+
+
+def prepare_chunk(job):
+
+    """ Function: Finger distances, hand masks and labels of one chunk of a session, computed once and saved as .npy files
+                  that every search round memory maps (the landmark filter of --smoothing is the slow, sequential part)
+            Arguments: job: (session path, warm start, start, stop, units, smoothing, use recorded masks as labels, output file prefix)
+            returns: (output file prefix, number of warm-up frames) """
+    path, warm, start, stop, units, smoothing, recorded, prefix = job
+    reader = sessionReader(path)
+    distances, valid, side = session_distances(reader, units, warm, stop, smoothing)
+    labels = reader.frames['detect'] if recorded else reader.labels()
+    np.save(prefix + '-distances.npy', distances.astype(np.float32))
+    np.save(prefix + '-valid.npy', valid)
+    np.save(prefix + '-side.npy', side.astype(np.uint8))
+    np.save(prefix + '-labels.npy', np.asarray(labels[start:stop], dtype=bool))
+    return prefix, start - warm
+
+
+def score_chunk(job):
+
+    """ Function: Confusion counts of every candidate threshold on one prepared chunk. The press/release hysteresis runs
+                  for all candidates, hands, fingers and the frames of a block at once (see hysteresis_masks())
+            Arguments: job: (chunk from prepare_chunk(), candidates (C,5), release scale)
+            returns: (C,sides,5,3) int array of true positives, false positives and false negatives """
+    (prefix, warm), candidates, release_scale = job
+    distances = np.load(prefix + '-distances.npy', mmap_mode='r')
+    valid = np.load(prefix + '-valid.npy', mmap_mode='r')
+    side = np.load(prefix + '-side.npy', mmap_mode='r')
+    labels = np.load(prefix + '-labels.npy', mmap_mode='r')
+    press = candidates[:, None, :].astype(np.float32) #(C,1,5)
+    state = np.zeros((len(candidates),) + distances.shape[1:], dtype=bool) #(C,hands,5) masks of the last frame of the previous block
+    counts = np.zeros((len(candidates), len(sides), 5, 3), dtype=np.int64)
+    block = 2048
+    for b0 in range(0, len(distances), block):
+        b1 = min(b0 + block, len(distances))
+        masks = hysteresis_masks(distances[b0:b1, None], press, np.float32(release_scale), valid[b0:b1, None, :, None], state) #(B,C,hands,5)
+        state = masks[-1]
+        lo = max(b0, warm)
+        if lo >= b1:
+            continue #warm-up frames only settle the hysteresis state
+        m = masks[lo - b0:]
+        truth = labels[lo - warm:b1 - warm][:, None] #(B,1,hands,5)
+        onehot = ((side[lo:b1][:, :, None] == np.arange(len(sides))) & valid[lo:b1][:, :, None]).reshape(-1, len(sides)).astype(np.float32) #(B*hands,sides)
+        for k, hits in enumerate((m & truth, m & ~truth, ~m & truth & valid[lo:b1][:, None, :, None])):
+            hits = hits.transpose(1, 3, 0, 2).reshape(len(candidates), 5, -1).astype(np.float32) #(C,5,B*hands)
+            counts[..., k] += np.rint(hits @ onehot).astype(np.int64).transpose(0, 2, 1) #per side sums as one matrix product (exact below 2**24 per block)
+    return counts
+
+
+def scores(counts, beta=1.0):
+
+    """ Function: Precision, recall and F-score from confusion counts
+            Arguments: counts: (...,3) true positives, false positives, false negatives; beta: recall weight of the F-score
+            returns: precision, recall, fscore arrays """
+    tp, fp, fn = counts[..., 0].astype(np.float64), counts[..., 1].astype(np.float64), counts[..., 2].astype(np.float64)
+    precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 0.0)
+    recall = np.where(tp + fn > 0, tp / np.maximum(tp + fn, 1), 0.0)
+    b2 = beta * beta
+    fscore = np.where(precision + recall > 0, (1 + b2) * precision * recall / np.maximum(b2 * precision + recall, 1e-12), 0.0)
+    return precision, recall, fscore
+
+
+def plan_jobs(paths, chunk_frames, overlap):
+
+    """ Function: Split the sessions into chunks of about chunk_frames frames, each starting `overlap` frames early
+            Arguments: paths: session directories, chunk_frames: frames per job, overlap: warm-up frames of the hysteresis
+            returns: list of (path, warm start, start, stop) """
+    jobs = []
+    for path in paths:
+        frames = len(sessionReader(path))
+        for start in range(0, frames, chunk_frames):
+            jobs.append((path, max(0, start - overlap), start, min(frames, start + chunk_frames)))
+    return jobs
+
+
+def candidate_grid(paths, units, steps, sample=50000):
+
+    """ Function: Evenly spaced thresholds per finger between the 1st and 99th percentile of the recorded distances
+            Arguments: paths: sessions, units: threshold units, steps: candidates per finger, sample: max frames read per session
+            returns: (steps,5) array, row i is one candidate (finger thresholds move together, so the fingers are scored independently) """
+    values = []
+    for path in paths:
+        reader = sessionReader(path)
+        distances, valid, side = session_distances(reader, units, 0, min(len(reader), sample))
+        values.append(distances[valid])
+    values = np.concatenate(values) if values else np.zeros((0, 5))
+    lo = np.percentile(values, 1, axis=0) if len(values) else np.full(5, 1.0)
+    hi = np.percentile(values, 99, axis=0) if len(values) else np.full(5, 15.0)
+    return np.linspace(lo, hi, steps)
+
+
+def current_thresholds(paths, units, sample=50000):
+
+    """ Function: The thresholds in use (dist_threshold_param) in the units being calibrated. Palm units divide them by the
+                  median palm size of the sessions
+            Arguments: paths: sessions, units: threshold units, sample: max frames read per session
+            returns: (5,) array """
+    import Virtual_Piano as vp
+    current = threshold_vector(vp.dist_threshold_param)
+    if units != 'palm':
+        return current
+    sizes = []
+    for path in paths:
+        reader = sessionReader(path)
+        frames = reader.frames[:min(len(reader), sample)]
+        valid = np.arange(frames['landmarks'].shape[1])[None, :] < np.asarray(frames['hands'])[:, None]
+        sizes.append(palm_size(np.asarray(frames['landmarks'][valid], dtype=np.float64)) * 640.0 / reader.meta.get('frame_width', 640))
+    sizes = np.concatenate(sizes) if sizes else np.zeros(0)
+    return current / np.median(sizes) if len(sizes) else current
+
+
+def evaluate(pool, chunks, candidates, release_scale):
+    args = [(chunk, candidates, release_scale) for chunk in chunks]
+    results = pool.map(score_chunk, args) if pool is not None else [score_chunk(a) for a in args]
+    return np.sum(results, axis=0)
+
+
+def calibrate(paths, units='pixels', steps=48, refine=2, per_hand=True, min_support=50, beta=1.0, smoothing=None,
+              recorded=False, workers=None, chunk_frames=20000, overlap=30):
+
+    """ Function: Search the thresholds maximizing the press F-score against the labels, per finger and optionally per hand
+            Arguments: paths: labelled session directories
+                       units: 'pixels' or 'palm' (resolution and camera distance independent)
+                       steps: candidates per finger and search round, refine: extra rounds zooming in around the best values
+                       per_hand: also pick separate left/right thresholds for the fingers with min_support labelled presses on that side
+                       min_support: fewer labelled presses keep the current (or overall) threshold of a finger
+                       beta: F-score recall weight (above 1 favours catching presses, below 1 avoids false ones)
+                       smoothing: score the distances the landmark filter produces (default: landmark_smoothing, as the piano runs)
+                       recorded: use the recorded press masks as labels instead of labels.npy
+                       workers: processes (default: all cores), chunk_frames/overlap: job size and hysteresis warm-up
+            returns: calibration profile dict """
+    import Virtual_Piano as vp
+    t0 = time.perf_counter()
+    smoothing = bool(vp.landmark_smoothing if smoothing is None else smoothing)
+    workers = workers or multiprocessing.cpu_count()
+    if not recorded:
+        for path in paths:
+            if sessionReader(path).labels() is None: #checked here, a missing file would only fail inside a worker
+                raise ValueError("session %s has no %s; label it or pass --recorded to use the recorded press masks" % (path, labels_file))
+    release_scale = sessionReader(paths[0]).meta.get('release_threshold_scale', vp.release_threshold_scale)
+    jobs = plan_jobs(paths, chunk_frames, overlap)
+    frames = sum(stop - start for path, warm, start, stop in jobs)
+    grid = candidate_grid(paths, units, steps)
+    current = current_thresholds(paths, units)
+    pool = multiprocessing.Pool(min(workers, len(jobs))) if workers > 1 and len(jobs) > 1 else None
+    cache = tempfile.TemporaryDirectory(prefix='calibrate-')
+    try:
+        args = [job + (units, smoothing, recorded, os.path.join(cache.name, str(i))) for i, job in enumerate(jobs)]
+        chunks = pool.map(prepare_chunk, args) if pool is not None else [prepare_chunk(a) for a in args]
+        for search in range(refine + 1):
+            candidates = np.vstack([grid, current]) #the current thresholds are scored too, for comparison
+            counts = evaluate(pool, chunks, candidates, release_scale) #(C,sides,5,3)
+            if search == 0:
+                current_counts = counts[-1]
+            counts = counts[:len(grid)]
+            overall = scores(counts.sum(axis=1), beta)[2] #(C,5)
+            side_f = scores(counts, beta)[2] #(C,sides,5)
+            best = grid[np.argmax(overall, axis=0), np.arange(5)]
+            side_best = grid[np.argmax(side_f, axis=0), np.arange(5)[None, :]] #(sides,5)
+            step = (grid[1] - grid[0]) if len(grid) > 1 else np.ones(5)
+            supported = (counts[0, :2, :, 0] + counts[0, :2, :, 2]) >= min_support #(2,5) sides whose values the next round zooms in on too
+            lo = np.minimum(best, np.where(supported, side_best[:2], np.inf).min(0)) - step
+            hi = np.maximum(best, np.where(supported, side_best[:2], -np.inf).max(0)) + step
+            grid = np.linspace(np.maximum(lo, 1e-3), hi, steps)
+        support = counts[0, :, :, 0] + counts[0, :, :, 2] #(sides,5) labelled presses, the same for every candidate
+        best = np.where(support.sum(0) >= min_support, best, current) #fingers never pressed keep their thresholds
+        hands = {name: np.where(support[s] >= min_support, side_best[s], best) for s, name in enumerate(sides[:2])
+                 if per_hand and np.any(support[s] >= min_support)} #fingers with too few presses on a side use the overall value
+        final = evaluate(pool, chunks, np.array([best] + list(hands.values())), release_scale) #(1+hands,sides,5,3)
+    finally:
+        if pool is not None:
+            pool.close(); pool.join()
+        cache.cleanup()
+    profile = {'units': units, 'thresholds': dict(zip(finger_names, best.round(3).tolist())),
+               'per_hand': {name: dict(zip(finger_names, t.round(3).tolist())) for name, t in hands.items()},
+               'release_threshold_scale': release_scale, 'smoothing': smoothing, 'beta': beta,
+               'sessions': list(paths), 'frames': int(frames), 'created': time.time()}
+    report = {'overall': finger_report(final[0].sum(0), beta), 'current': finger_report(current_counts.sum(0), beta)}
+    for i, name in enumerate(hands):
+        report[name] = finger_report(final[1 + i, sides.index(name)], beta)
+    profile['seconds'] = time.perf_counter() - t0
+    profile['report'] = report
+    return profile
+
+
+def finger_report(counts, beta=1.0):
+
+    """ Function: Precision/recall/F-score per finger
+            Arguments: counts: (5,3) confusion counts, beta: F-score recall weight
+            returns: dict finger -> scores """
+    precision, recall, fscore = scores(counts, beta)
+    return {finger: {'precision': round(float(precision[f]), 4), 'recall': round(float(recall[f]), 4), 'f': round(float(fscore[f]), 4),
+                     'presses': int(counts[f, 0] + counts[f, 2])} for f, finger in enumerate(finger_names)}
+
+
+def print_report(profile):
+    for name, fingers in profile['report'].items():
+        print("%-8s" % name + ' '.join("%s p=%.3f r=%.3f f=%.3f" % (finger, s['precision'], s['recall'], s['f']) for finger, s in fingers.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calibrate the press thresholds from labelled session recordings (see session_log.py)')
+    parser.add_argument('sessions', nargs='+', help='session directories with labels.npy (or use --recorded)')
+    parser.add_argument('--output', default='calibration.json', help='profile file, loaded by Virtual_Piano.py at startup')
+    parser.add_argument('--units', choices=['pixels', 'palm'], default='pixels')
+    parser.add_argument('--steps', type=int, default=48, help='candidate thresholds per finger and round')
+    parser.add_argument('--refine', type=int, default=2, help='extra search rounds around the best values')
+    parser.add_argument('--no-per-hand', action='store_true', help='one set of thresholds for both hands')
+    parser.add_argument('--beta', type=float, default=1.0, help='F-score recall weight')
+    parser.add_argument('--smoothing', action='store_true', default=None, help='calibrate for the smoothed landmarks (default: as landmark_smoothing)')
+    parser.add_argument('--no-smoothing', dest='smoothing', action='store_false', help='calibrate for the raw landmarks')
+    parser.add_argument('--recorded', action='store_true', help='use the recorded press masks as labels')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--synthetic', type=int, default=0, help='first write labelled synthetic sessions of this many frames into the session directories')
+    args = parser.parse_args()
+    if args.synthetic:
+        from session_log import synthetic_session
+        for i, path in enumerate(args.sessions):
+            synthetic_session(path, args.synthetic, noise=2.0 + i, seed=i)
+    try:
+        profile = calibrate(args.sessions, args.units, args.steps, args.refine, not args.no_per_hand, beta=args.beta,
+                            smoothing=args.smoothing, recorded=args.recorded, workers=args.workers)
+    except ValueError as error:
+        sys.exit(str(error))
+    print_report(profile)
+    print("Thresholds:", profile['thresholds'], "per hand:", profile['per_hand'])
+    print("Calibrated on %d frames in %.2f s (%.0f frames/s)" % (profile['frames'], profile['seconds'], profile['frames'] / profile['seconds']))
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print("Profile written to", args.output)
+    sys.exit()
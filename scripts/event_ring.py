@@ -0,0 +1,211 @@
+# Lock-free single producer / single consumer ring of note events in shared memory
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import time
+import sys
+import argparse
+from audio_engine import note_event_dtype
+
+status_dtype = np.dtype([('frames', np.uint64),          #frames processed by the vision process (producer)
+                         ('events', np.uint64),          #events pushed (producer)
+                         ('dropped', np.uint64),         #events dropped because the ring was full (producer)
+                         ('last_event_time', np.float64),#time.monotonic() of the last pushed event (producer)
+                         ('received', np.uint64),        #events popped (consumer)
+                         ('latency_sum', np.float64),    #sum of event timestamp -> pop latencies in seconds (consumer)
+                         ('latency_max', np.float64)])   #largest event timestamp -> pop latency in seconds (consumer)
+header_size = 128 #head and tail counters live on separate 64 byte cache lines
+status_offset = header_size
+events_offset = header_size + 64
+
+
+class eventRing():
+    def __init__(self, name=None, capacity=4096, create=True, dtype=note_event_dtype):
+
+        """ Function: Create (or attach to) a ring of event records (note_event_dtype by default) in shared memory.
+                      One process may push and one other process may pop; no locks are taken. This relies on every
+                      index having a single writer (head: the producer, tail: the consumer) and on the records being
+                      written before the new head is published (and copied out before the new tail is), with those
+                      stores becoming visible to the other process in program order. x86 guarantees that ordering for
+                      plain stores; weaker memory models would need a fence before each publish
+            Arguments: name: shared memory name to attach to (create=False)
+                       capacity: number of events, rounded up to a power of two
+                       create: create a new segment (True) or attach to an existing one
+                       dtype: event record type, note_event_dtype or player_event_dtype (several players sharing the audio process)
+            returns: None """
+        self.dtype = np.dtype(dtype)
+        if create:
+            capacity = 1 << max(1, int(capacity - 1).bit_length())
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=events_offset + capacity * self.dtype.itemsize)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name) #child processes share the creator's resource tracker, only the creator unlinks
+            capacity = (self.shm.size - events_offset) // self.dtype.itemsize
+            capacity = 1 << (capacity.bit_length() - 1)
+        self.owner = create
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.head = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf, offset=0) #total events written
+        self.tail = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf, offset=64) #total events read
+        self.status = np.ndarray((), dtype=status_dtype, buffer=self.shm.buf, offset=status_offset)
+        self.events = np.ndarray((capacity,), dtype=self.dtype, buffer=self.shm.buf, offset=events_offset)
+        if create:
+            self.head[0] = 0
+            self.tail[0] = 0
+            self.status[()] = 0
+
+    def __getstate__(self):
+        return {'name': self.name, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], create=False, dtype=state['dtype']) #processes started with 'spawn' attach to the same segment
+
+    def put(self, events):
+
+        """ Function: Push events (producer side). Never blocks: events that do not fit are dropped and counted
+            Arguments: self, events: list of event tuples, packed bytes or array of the ring dtype
+            returns: number of events written """
+        if isinstance(events, (bytes, bytearray)):
+            events = np.frombuffer(events, dtype=self.dtype)
+        elif not isinstance(events, np.ndarray):
+            events = np.array([tuple(e) for e in events], dtype=self.dtype)
+        n = len(events)
+        if n == 0:
+            return 0
+        head = int(self.head[0])
+        free = self.capacity - (head - int(self.tail[0]))
+        if n > free:
+            self.status['dropped'] += n - free
+            events = events[:free]
+            n = free
+        start = head & self.mask
+        first = min(n, self.capacity - start)
+        self.events[start:start + first] = events[:first]
+        self.events[:n - first] = events[first:]
+        self.head[0] = head + n #publish after the records are written
+        self.status['events'] += n
+        self.status['last_event_time'] = time.monotonic()
+        return n
+
+    def pop(self, max_events=None):
+
+        """ Function: Pop all (or up to max_events) available events (consumer side)
+            Arguments: self, max_events: limit on the number of events returned
+            returns: note_event_dtype array (a copy), empty if nothing is available """
+        tail = int(self.tail[0])
+        n = int(self.head[0]) - tail
+        if max_events is not None:
+            n = min(n, max_events)
+        if n <= 0:
+            return self.events[:0].copy()
+        start = tail & self.mask
+        first = min(n, self.capacity - start)
+        out = np.concatenate([self.events[start:start + first], self.events[:n - first]])
+        self.tail[0] = tail + n #free the slots only after copying them out
+        lat = time.monotonic() - out['time']
+        self.status['received'] += n
+        self.status['latency_sum'] += float(lat.sum())
+        self.status['latency_max'] = max(float(self.status['latency_max']), float(lat.max()))
+        return out
+
+    def get(self, timeout=None, poll=0.0005):
+
+        """ Function: Queue style blocking pop, so the ring can be used wherever a multiprocessing.Queue was
+            Arguments: self, timeout: seconds to wait for events (None waits forever), poll: seconds between checks
+            returns: note_event_dtype array with at least one event, raises queue.Empty on timeout """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            out = self.pop()
+            if len(out):
+                return out
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Empty
+            time.sleep(poll)
+
+    def qsize(self):
+        return int(self.head[0]) - int(self.tail[0])
+
+    def frameDone(self):
+
+        """ Function: Count one processed frame in the shared status block (producer side)
+            Arguments: self
+            returns: None """
+        self.status['frames'] += 1
+
+    def stats(self):
+        received = int(self.status['received'])
+        return {'frames': int(self.status['frames']),
+                'events': int(self.status['events']),
+                'received': received,
+                'dropped': int(self.status['dropped']),
+                'backlog': self.qsize(),
+                'latency_ms_mean': float(self.status['latency_sum']) / received * 1000 if received else 0.0,
+                'latency_ms_max': float(self.status['latency_max']) * 1000}
+
+    def close(self):
+
+        """ Function: Detach from the segment, and remove it if this process created it
+            Arguments: self
+            returns: None """
+        del self.head, self.tail, self.status, self.events #release the views before closing the buffer
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def stress_producer(name, total, batch):
+    ring = eventRing(name, create=False)
+    sent = 0
+    notes = np.arange(batch)
+    while sent < total:
+        n = min(batch, total - sent)
+        events = np.empty(n, dtype=note_event_dtype)
+        events['kind'] = 1
+        events['note'] = (sent + notes[:n]) % 256 #sequence check on the consumer side
+        events['velocity'] = 100
+        events['time'] = time.monotonic()
+        written = 0
+        while written < n: #the stress test waits for free space instead of dropping events
+            free = ring.capacity - ring.qsize()
+            written += ring.put(events[written:written + free])
+            if written < n:
+                time.sleep(0)
+        sent += n
+    ring.close()
+
+
+def stress_test(total=2000000, batch=64, capacity=65536):
+
+    """ Function: Push events from a producer process to this process through the ring and check every one arrives in order
+            Arguments: total: number of events, batch: events per put(), capacity: ring size
+            returns: dict with throughput, latency and error counts """
+    ring = eventRing(capacity=capacity)
+    producer = multiprocessing.Process(target=stress_producer, args=(ring.name, total, batch))
+    t0 = time.perf_counter()
+    producer.start()
+    received = 0; errors = 0
+    while received < total:
+        try:
+            events = ring.get(timeout=10)
+        except queue.Empty:
+            break
+        expected = (received + np.arange(len(events))) % 256
+        errors += int(np.count_nonzero(events['note'] != expected))
+        received += len(events)
+    elapsed = time.perf_counter() - t0
+    producer.join()
+    result = dict(ring.stats(), total=total, errors=errors, seconds=elapsed, events_per_s=received / elapsed)
+    ring.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stress test of the shared memory event ring between two processes')
+    parser.add_argument('--events', type=int, default=2000000)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--capacity', type=int, default=65536)
+    args = parser.parse_args()
+    result = stress_test(args.events, args.batch, args.capacity)
+    print(result)
+    sys.exit(0 if result['errors'] == 0 and result['received'] == args.events else 1)
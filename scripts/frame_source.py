@@ -0,0 +1,353 @@
+# Frame sources and a threaded frame grabber used by Virtual_Piano.py
+import requests
+import cv2
+import numpy as np
+import threading
+import time
+import os
+import sys
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.bmp') #file types picked up by replaySource when given an image directory
+jpeg_start = b'\xff\xd8'; jpeg_end = b'\xff\xd9' #JPEG start/end of image markers used to split the MJPEG stream
+
+
+class httpSnapshotSource():
+    def __init__(self, url, timeout=2.0):
+        self.url = url #IP Webcam snapshot url, usually http://<phone-ip>:8080/shot.jpg
+        self.timeout = timeout
+        self.encoded = True #frames returned by read() still need to be decoded
+        self.session = requests.Session() #persistent session so every frame reuses the same keep-alive connection
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+    def read(self):
+
+        """ Function: Fetch one JPEG snapshot from the server over the pooled connection
+            Arguments: self
+            returns: buffer of encoded image bytes, or None if the request failed """
+        try:
+            resp = self.session.get(self.url, timeout=self.timeout)
+        except requests.RequestException:
+            return None
+        if resp.status_code != 200:
+            return None
+        return np.frombuffer(resp.content, dtype=np.uint8)
+
+    def close(self):
+        self.session.close()
+
+
+class mjpegStreamSource():
+    def __init__(self, url, timeout=5.0, chunk_size=16384):
+        self.url = url #IP Webcam MJPEG url, usually http://<phone-ip>:8080/video
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.encoded = True
+        self.session = requests.Session()
+        self.resp = None
+        self.chunks = None
+        self.buffer = bytearray()
+
+    def connect(self):
+
+        """ Function: (Re)open the streaming connection
+            Arguments: self
+            returns: None """
+        if self.resp is not None:
+            self.resp.close()
+        self.buffer = bytearray()
+        self.resp = self.session.get(self.url, stream=True, timeout=self.timeout)
+        self.chunks = self.resp.iter_content(chunk_size=self.chunk_size)
+
+    def read(self):
+
+        """ Function: Read bytes from the stream until one complete JPEG is available
+            Arguments: self
+            returns: buffer of encoded image bytes, or None if the stream broke (it is reopened on the next call) """
+        try:
+            if self.chunks is None:
+                self.connect()
+            while True:
+                start = self.buffer.find(jpeg_start)
+                if start != -1:
+                    end = self.buffer.find(jpeg_end, start + 2)
+                    if end != -1:
+                        jpg = np.frombuffer(bytes(self.buffer[start:end + 2]), dtype=np.uint8)
+                        del self.buffer[:end + 2]
+                        return jpg
+                elif len(self.buffer) > 1:
+                    del self.buffer[:-1] #no start marker yet, keep only a possible half marker
+                self.buffer += next(self.chunks)
+        except (requests.RequestException, StopIteration):
+            self.chunks = None
+            return None
+
+    def close(self):
+        if self.resp is not None:
+            self.resp.close()
+        self.session.close()
+
+
+class videoCaptureSource():
+    def __init__(self, device=0):
+        self.device = device #webcam index or any path/url understood by cv2.VideoCapture
+        self.encoded = False #VideoCapture hands back decoded frames
+        self.cap = cv2.VideoCapture(device)
+
+    def read(self):
+        ok, img = self.cap.read()
+        if not ok:
+            return None
+        return img
+
+    def close(self):
+        self.cap.release()
+
+
+class replaySource():
+    def __init__(self, path, loop=True, fps=None):
+        self.path = path #video file or directory of images to replay
+        self.loop = loop #restart from the first frame once the recording ends
+        self.fps = fps #if given, frames are paced to this rate like a real camera would be
+        self.last_time = 0
+        self.finished = False
+        if os.path.isdir(path):
+            self.files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(image_extensions))
+            self.position = 0
+            self.cap = None
+            self.encoded = True #image files are returned as raw bytes so decode time is measured like for a camera
+        else:
+            self.files = None
+            self.cap = cv2.VideoCapture(path)
+            self.encoded = False
+
+    def read(self):
+
+        """ Function: Return the next recorded frame
+            Arguments: self
+            returns: encoded bytes (image directory) or decoded image (video file), None once a non looping replay ends """
+        if self.fps:
+            wait = self.last_time + 1.0 / self.fps - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_time = time.time()
+        if self.files is not None:
+            if self.position >= len(self.files):
+                if not self.loop or len(self.files) == 0:
+                    self.finished = True
+                    return None
+                self.position = 0
+            with open(self.files[self.position], 'rb') as f:
+                data = np.frombuffer(f.read(), dtype=np.uint8)
+            self.position += 1
+            return data
+        ok, img = self.cap.read()
+        if not ok and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, img = self.cap.read()
+        if not ok:
+            self.finished = True
+            return None
+        return img
+
+    def close(self):
+        if self.cap is not None:
+            self.cap.release()
+
+
+def open_source(spec, **kwargs):
+
+    """ Function: Build a frame source from a url, device index, video file or image directory
+            Arguments: spec: 'http://.../shot.jpg', 'http://.../video', an int/digit string for a webcam,
+                             or a path to a video file / image directory
+                       kwargs: passed on to the source constructor
+            returns: frame source object """
+    if isinstance(spec, int) or (isinstance(spec, str) and spec.isdigit()):
+        return videoCaptureSource(int(spec))
+    if spec.startswith('http://') or spec.startswith('https://'):
+        if spec.rstrip('/').endswith('/video'):
+            return mjpegStreamSource(spec, **kwargs)
+        if spec.endswith('.jpg'):
+            return httpSnapshotSource(spec, **kwargs)
+        return videoCaptureSource(spec)
+    return replaySource(spec, **kwargs)
+
+
+class frameGrabber():
+    def __init__(self, source, width=640, slots=3):
+        self.source = source
+        self.width = width #frames are resized to this width keeping the aspect ratio (same as imutils.resize)
+        self.slots = max(3, slots) #ring size, 3 is enough for one slot being written, one published and one being read
+        self.ring = None #preallocated frame buffers, created once the frame size is known
+        self.info = [None] * self.slots #latency info for the frame stored in each slot
+        self.latest = -1 #slot holding the newest complete frame
+        self.reading = -1 #slot currently handed to the consumer
+        self.seq = 0 #sequence number of the newest frame
+        self.read_seq = 0 #sequence number of the last frame returned to the consumer
+        self.dropped = 0 #frames decoded but never returned because a newer one arrived
+        self.failures = 0 #failed fetches/decodes
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='frameGrabber', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        self.source.close()
+
+    def allocate(self, img):
+
+        """ Function: (Re)allocate the ring buffer for the size of the incoming frames
+            Arguments: self, img: first decoded frame of a stream
+            returns: None """
+        h, w = img.shape[:2]
+        out_h = int(h * self.width / float(w))
+        shape = (out_h, self.width) + img.shape[2:]
+        with self.cond:
+            self.ring = [np.empty(shape, dtype=img.dtype) for i in range(self.slots)]
+            self.latest = -1
+            self.reading = -1
+
+    def run(self):
+
+        """ Function: Producer loop: fetch, decode and resize frames into the ring buffer until stopped
+            Arguments: self
+            returns: None """
+        while self.running:
+            t0 = time.perf_counter()
+            data = self.source.read()
+            t1 = time.perf_counter()
+            if data is None:
+                self.failures += 1
+                if getattr(self.source, 'finished', False):
+                    self.running = False
+                    with self.cond:
+                        self.cond.notify_all()
+                    break
+                time.sleep(0.01) #back off a little on network errors instead of spinning
+                continue
+            img = cv2.imdecode(data, cv2.IMREAD_COLOR) if self.source.encoded else data
+            if img is None:
+                self.failures += 1
+                continue
+            out_h = int(img.shape[0] * self.width / float(img.shape[1]))
+            if self.ring is None or self.ring[0].shape[:2] != (out_h, self.width) or self.ring[0].shape[2:] != img.shape[2:]:
+                self.allocate(img)
+            with self.cond:
+                slot = next(i for i in range(self.slots) if i != self.latest and i != self.reading)
+            cv2.resize(img, (self.width, out_h), dst=self.ring[slot], interpolation=cv2.INTER_AREA)
+            t2 = time.perf_counter()
+            with self.cond:
+                if self.latest != -1 and self.info[self.latest]['seq'] > self.read_seq:
+                    self.dropped += 1 #the previous frame was never consumed
+                self.seq += 1
+                self.info[slot] = {'seq': self.seq, 'timestamp': time.monotonic(), 'fetch_ms': (t1 - t0) * 1000, 'decode_ms': (t2 - t1) * 1000}
+                self.latest = slot
+                self.cond.notify_all()
+
+    def ready(self):
+
+        """ Function: True when a frame newer than the last returned one is waiting, without taking it
+            Arguments: self
+            returns: bool """
+        with self.cond:
+            return self.latest != -1 and self.info[self.latest]['seq'] > self.read_seq
+
+    def read(self, timeout=None):
+
+        """ Function: Return the most recent frame, waiting for one newer than the last returned frame
+            Arguments: self, timeout: seconds to wait for a new frame (None waits forever)
+            returns: img: newest frame (a view into the ring, valid until the next read() call) or None on timeout/end
+                     info: dict with seq, timestamp (time.monotonic() when the frame was ready), fetch_ms and decode_ms of the frame """
+        with self.cond:
+            if not self.cond.wait_for(lambda: (self.latest != -1 and self.info[self.latest]['seq'] > self.read_seq) or not self.running, timeout):
+                return None, None
+            if self.latest == -1 or self.info[self.latest]['seq'] <= self.read_seq:
+                return None, None
+            self.reading = self.latest
+            info = self.info[self.reading]
+            self.read_seq = info['seq']
+            return self.ring[self.reading], info
+
+
+class replayRequestHandler(BaseHTTPRequestHandler):
+
+    """ Minimal stand-in for the IP Webcam app: serves /shot.jpg and the /video MJPEG stream from a replay source """
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/shot.jpg'):
+            jpg = server.next_jpeg()
+            if jpg is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(jpg)))
+            self.end_headers()
+            self.wfile.write(jpg)
+        elif self.path.startswith('/video'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            self.end_headers()
+            try:
+                while True:
+                    jpg = server.next_jpeg()
+                    if jpg is None:
+                        break
+                    self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpg)).encode() + b'\r\n\r\n' + jpg + b'\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_replay_server(source, port=8080, host='127.0.0.1'):
+
+    """ Function: Build an http server imitating the IP Webcam app from a local replay source, for offline testing
+            Arguments: source: frame source to replay (usually replaySource)
+                       port, host: address to listen on (port 0 picks a free port)
+            returns: server: ThreadingHTTPServer, call serve_forever() (for example in a thread) and shutdown() """
+    server = ThreadingHTTPServer((host, port), replayRequestHandler)
+    lock = threading.Lock()
+
+    def next_jpeg():
+        with lock:
+            data = source.read()
+        if data is None:
+            return None
+        if source.encoded:
+            return data.tobytes()
+        ok, jpg = cv2.imencode('.jpg', data)
+        return jpg.tobytes() if ok else None
+
+    server.next_jpeg = next_jpeg
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a recorded video or image directory like the IP Webcam app')
+    parser.add_argument('path', help='video file or image directory to replay')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fps', type=float, default=None, help='pace frames to this rate')
+    args = parser.parse_args()
+    server = make_replay_server(replaySource(args.path, loop=True, fps=args.fps), args.port, '0.0.0.0')
+    print("Serving", args.path, "on port", args.port, "(/shot.jpg and /video)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit()
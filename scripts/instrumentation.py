@@ -0,0 +1,153 @@
+# Lightweight per stage timers and counters replacing the per frame print() calls of Virtual_Piano.py
+import numpy as np
+import contextlib
+import json
+import time
+import sys
+import argparse
+
+null_context = contextlib.nullcontext() #shared no-op context handed out when instrumentation is disabled
+
+
+class stageContext():
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.t0 = 0.0
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.record(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+class metricsRecorder():
+    def __init__(self, enabled=True, capacity=1024, trace_every=0, summary_interval=0.0, dump_path=None):
+
+        """ Function: Per stage timings in preallocated ring buffers plus counters and gauges
+            Arguments: enabled: if False every call returns immediately (near zero overhead)
+                       capacity: timings kept per stage
+                       trace_every: print the trace() messages of one frame out of this many (0 = trace off)
+                       summary_interval: seconds between summaries printed by frameDone() (0 = never)
+                       dump_path: JSON file the summary is also written to
+            returns: None """
+        self.enabled = enabled
+        self.capacity = capacity
+        self.trace_every = trace_every
+        self.summary_interval = summary_interval
+        self.dump_path = dump_path
+        self.timings = {} #stage -> ring buffer of durations in seconds
+        self.positions = {} #stage -> total number of recorded durations
+        self.contexts = {} #stage -> reusable stageContext
+        self.counters = {} #name -> running total
+        self.gauges = {} #name -> last value
+        self.frames = 0
+        self.last_summary = time.monotonic()
+
+    def stage(self, name):
+
+        """ Function: Context manager timing one stage: with metrics.stage('inference'): ...
+            Arguments: self, name: stage name
+            returns: context manager """
+        if not self.enabled:
+            return null_context
+        ctx = self.contexts.get(name)
+        if ctx is None:
+            ctx = self.contexts[name] = stageContext(self, name)
+        return ctx
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        buf = self.timings.get(name)
+        if buf is None:
+            buf = self.timings[name] = np.zeros(self.capacity)
+            self.positions[name] = 0
+        pos = self.positions[name]
+        buf[pos % self.capacity] = seconds
+        self.positions[name] = pos + 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def trace(self, *args):
+
+        """ Function: print() replacement for the hot path, only prints on sampled frames when trace mode is on
+            Arguments: self, args: what print() would get
+            returns: None """
+        if self.enabled and self.trace_every and self.frames % self.trace_every == 0:
+            print(*args)
+
+    def frameDone(self):
+
+        """ Function: Count a frame and print/dump a summary when summary_interval has passed
+            Arguments: self
+            returns: None """
+        if not self.enabled:
+            return
+        self.frames += 1
+        if self.summary_interval and time.monotonic() - self.last_summary >= self.summary_interval:
+            self.last_summary = time.monotonic()
+            summary = self.summary()
+            print(self.formatSummary(summary))
+            if self.dump_path:
+                with open(self.dump_path, 'w') as f:
+                    json.dump(summary, f, indent=2)
+
+    def summary(self):
+
+        """ Function: Statistics of the recorded timings, counters and gauges
+            Arguments: self
+            returns: dict """
+        stages = {}
+        for name, buf in self.timings.items():
+            ms = buf[:min(self.positions[name], self.capacity)] * 1000
+            stages[name] = {'calls': self.positions[name], 'mean_ms': float(ms.mean()),
+                            'p50_ms': float(np.percentile(ms, 50)), 'p95_ms': float(np.percentile(ms, 95)), 'max_ms': float(ms.max())}
+        return {'frames': self.frames, 'stages': stages, 'counters': dict(self.counters), 'gauges': dict(self.gauges), 'time': time.time()}
+
+    def formatSummary(self, summary):
+        stages = ' '.join('%s=%.1fms' % (name, s['p50_ms']) for name, s in summary['stages'].items())
+        counters = ' '.join('%s=%s' % item for item in list(summary['counters'].items()) + list(summary['gauges'].items()))
+        return "[metrics] frames=%d %s %s" % (summary['frames'], stages, counters)
+
+
+def overhead_check(calls=200000):
+
+    """ Function: Measure the cost of a frame worth of instrumentation calls, enabled and disabled
+            Arguments: calls: number of simulated frames
+            returns: dict with nanoseconds per frame for a bare loop, disabled and enabled instrumentation """
+    results = {}
+    for label, recorder in (('bare', None), ('disabled', metricsRecorder(enabled=False)), ('enabled', metricsRecorder(enabled=True))):
+        t0 = time.perf_counter()
+        for i in range(calls):
+            if recorder is None:
+                continue
+            with recorder.stage('inference'):
+                pass
+            recorder.count('presses', 2)
+            recorder.gauge('queue_depth', i)
+            recorder.trace('frame', i)
+            recorder.frameDone()
+        results[label + '_ns_per_frame'] = (time.perf_counter() - t0) / calls * 1e9
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the per frame overhead of the instrumentation layer')
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--budget-us', type=float, default=2.0, help='max allowed disabled overhead per frame in microseconds')
+    args = parser.parse_args()
+    result = overhead_check(args.frames)
+    print(result)
+    overhead_us = (result['disabled_ns_per_frame'] - result['bare_ns_per_frame']) / 1000
+    print("Disabled overhead per frame: %.3f us (budget %.1f us)" % (overhead_us, args.budget_us))
+    sys.exit(0 if overhead_us <= args.budget_us else 1)
@@ -0,0 +1,79 @@
+# Precomputed piano key lookup table used by find_note() in Virtual_Piano.py
+import numpy as np
+
+
+class keyLookup():
+    def __init__(self, bboxes_black, bboxes_white, black_key_reference, white_key_reference):
+
+        """ Function: Build a dense label map of the keyboard so any (x, y) resolves to a key with one array read
+            Arguments: bboxes_black, bboxes_white: (N,4) arrays of xmin,ymin,xmax,ymax per key (integer valued)
+                       black_key_reference, white_key_reference: note names of the keys, same order as the bboxes
+            returns: None """
+        bboxes_black = np.asarray(bboxes_black, dtype=np.float64).reshape(-1, 4)
+        bboxes_white = np.asarray(bboxes_white, dtype=np.float64).reshape(-1, 4)
+        boxes = np.concatenate([bboxes_black, bboxes_white])
+        if np.any(boxes != np.round(boxes)):
+            raise ValueError("keyLookup needs integer valued key bboxes")
+        boxes = boxes.astype(np.int64)
+        self.n_black = len(bboxes_black)
+        self.notes = list(black_key_reference[:self.n_black]) + list(white_key_reference[:len(bboxes_white)]) #note name per label
+        self.indices = np.concatenate([np.arange(self.n_black), np.arange(len(bboxes_white))]) #key index (within its colour) per label
+        self.colours = ['black'] * self.n_black + ['white'] * len(bboxes_white)
+
+        # The map works on a half pixel grid: even cells are integer coordinates and odd cells the open
+        # interval between two integers, so the strict '<' and '>' of the old per key bbox test are kept exactly.
+        self.x0 = int(boxes[:, 0].min()) if len(boxes) else 0
+        self.y0 = int(boxes[:, 1].min()) if len(boxes) else 0
+        width = int(boxes[:, 2].max()) - self.x0 if len(boxes) else 0
+        height = int(boxes[:, 3].max()) - self.y0 if len(boxes) else 0
+        self.label_map = np.full((2 * height + 1, 2 * width + 1), -1, dtype=np.int16)
+
+        # Paint white keys first and black keys last so black keys win where they overlap white ones (same
+        # priority as the old linear scan). Within a colour keys are painted in reverse so the lowest id wins.
+        order = list(range(len(boxes) - 1, self.n_black - 1, -1)) + list(range(self.n_black - 1, -1, -1))
+        for label in order:
+            xmin, ymin, xmax, ymax = boxes[label]
+            if xmax - xmin < 1 or ymax - ymin < 1:
+                continue #degenerate box, no point is strictly inside it
+            self.label_map[2 * (ymin - self.y0) + 1:2 * (ymax - self.y0), 2 * (xmin - self.x0) + 1:2 * (xmax - self.x0)] = label
+
+    def translate(self, dx, dy):
+
+        """ Function: Follow a keyboard moved by whole pixels without repainting the label map
+            Arguments: self, dx, dy: pixel offsets
+            returns: None """
+        self.x0 += int(dx); self.y0 += int(dy)
+
+    def lookup(self, positions):
+
+        """ Function: Vectorized lookup of many finger tip positions at once
+            Arguments: positions: (N,2) array of x,y pixel coordinates
+            returns: labels: (N,) int array, -1 for a miss, otherwise < n_black for black keys and >= n_black for white keys """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        floor = np.floor(positions)
+        cells = 2 * (floor - [self.x0, self.y0]) + (positions != floor) #integer coords land on even cells, the rest on odd ones
+        cells = np.nan_to_num(cells, nan=-1, posinf=-1, neginf=-1).astype(np.int64)
+        cx = cells[:, 0]; cy = cells[:, 1]
+        inside = (cx >= 0) & (cx < self.label_map.shape[1]) & (cy >= 0) & (cy < self.label_map.shape[0])
+        labels = np.full(len(positions), -1, dtype=np.int64)
+        labels[inside] = self.label_map[cy[inside], cx[inside]]
+        return labels
+
+    def find(self, pos):
+
+        """ Function: Single position version of lookup(), returns the same values as the old find_note()
+            Arguments: pos: x,y pixel coordinates of the tip of finger
+            returns: note: note name ('Wrong Press' on a miss)
+                     index: index of the pressed key (100 on a miss)
+                     color: 'black', 'white' ('None' on a miss) """
+        label = self.lookup(pos)[0]
+        if label < 0:
+            return 'Wrong Press', 100, 'None'
+        return self.notes[label], int(self.indices[label]), self.colours[label]
+
+    def findAll(self, positions):
+
+        """ Function: Batch version of find()
+            Arguments: positions: (N,2) array of x,y pixel coordinates
+            returns: list of (note, index, color) tuples, one per position """
+        return [('Wrong Press', 100, 'None') if label < 0 else (self.notes[label], int(self.indices[label]), self.colours[label]) for label in self.lookup(positions)]
@@ -0,0 +1,162 @@
+# Data driven piano keyboard layout: key table, geometry and the lookup/render caches derived from it
+import numpy as np
+import time
+import sys
+import argparse
+from key_lookup import keyLookup
+from keyboard_renderer import keyboardRenderer
+
+pitch_names = ['c', 'c-', 'd', 'd-', 'e', 'f', 'f-', 'g', 'g-', 'a', 'a-', 'b'] #note names per pitch class, '-' marks the sharp (same as the sample files)
+black_pitches = [1, 3, 6, 8, 10] #pitch classes of the black keys
+keyboard_ranges = {25: (48, 72), 49: (36, 84), 61: (36, 96), 76: (28, 103), 88: (21, 108)} #keys -> (lowest, highest) MIDI number of common keyboards
+midi_base = 21 #MIDI number of note id 0 (a0). Note ids are the same for every range, so samples and events never need remapping
+note_count = 88
+
+key_dtype = np.dtype([('name', 'U4'),    #note name, also the name of its sample file ('a-0', 'c8', ...)
+                      ('midi', np.uint8), #MIDI note number
+                      ('note', np.int16), #note id: midi - midi_base, the position in the 88 key note table and sample bank
+                      ('black', np.bool_),
+                      ('index', np.int16), #position of the key among the keys of its colour
+                      ('x0', np.int32), ('y0', np.int32), ('x1', np.int32), ('y1', np.int32)]) #key rectangle in frame pixels
+
+
+def note_name(midi):
+    return pitch_names[midi % 12] + str(midi // 12 - 1)
+
+
+def note_names():
+
+    """ Function: Names of all 88 notes by note id, used to map note ids to sample files
+            Arguments: none
+            returns: list of note names """
+    return [note_name(midi_base + i) for i in range(note_count)]
+
+
+class keyboardLayout():
+    def __init__(self, keys=88, x=40, y=250, scale=1.0, white_size=(10, 80), black_size=(5, 40), midi_range=None):
+
+        """ Function: Generate the keys of a keyboard of any size and place them on the frame
+            Arguments: keys: number of keys, one of keyboard_ranges (25, 49, 61, 76, 88), always a range of the 88 key piano
+                       x, y: top left pixel coordinates of the keyboard
+                       scale: size relative to white_size and black_size
+                       white_size, black_size: (width, height) in pixels of the keys at scale 1
+                       midi_range: (lowest, highest) MIDI number, overrides keys for custom ranges
+            returns: None """
+        self.x = int(x); self.y = int(y); self.scale = float(scale)
+        self.white_size = white_size; self.black_size = black_size
+        self.lookup = None #keyLookup of the current geometry
+        self.renderer = None #keyboardRenderer of the current geometry
+        self.rebuild_ms = 0.0 #time spent by the last layout change
+        self.setRange(keys, midi_range)
+
+    def setRange(self, keys=88, midi_range=None):
+
+        """ Function: (Re)build the key table for another range, then the geometry and caches
+            Arguments: self, keys: number of keys (see keyboard_ranges), midi_range: custom (lowest, highest) MIDI numbers
+            returns: self """
+        t0 = time.perf_counter()
+        low, high = midi_range if midi_range is not None else keyboard_ranges[keys]
+        if low < midi_base or high >= midi_base + note_count or low > high:
+            raise ValueError("keyboard range %s-%s is outside the 88 piano keys" % (low, high))
+        midi = np.arange(low, high + 1)
+        self.keys = np.zeros(len(midi), dtype=key_dtype) #one record per key in pitch order
+        self.keys['midi'] = midi
+        self.keys['note'] = midi - midi_base
+        self.keys['name'] = [note_name(m) for m in midi]
+        self.keys['black'] = np.isin(midi % 12, black_pitches)
+        black = self.keys['black']
+        self.keys['index'][~black] = np.arange(np.count_nonzero(~black))
+        self.keys['index'][black] = np.arange(np.count_nonzero(black))
+        self.white_keys = np.flatnonzero(~black) #position in the key table of every white key, in key index order
+        self.black_keys = np.flatnonzero(black)
+        self.white_ids = self.keys['note'][self.white_keys] #note id of every white key, in key index order
+        self.black_ids = self.keys['note'][self.black_keys]
+        self.left_white = (np.cumsum(~black) - 1)[black] #white key to the left of every black key
+        self.place(build=False)
+        self.buildCaches()
+        self.rebuild_ms = (time.perf_counter() - t0) * 1000
+        return self
+
+    def place(self, x=None, y=None, scale=None, build=True):
+
+        """ Function: Move and/or scale the keyboard. A pure move only shifts the cached lookup and overlay,
+                      a scale change recomputes the geometry and rebuilds them
+            Arguments: self, x, y: new top left pixel coordinates, scale: new size
+                       build: update the caches (False when the caller rebuilds them itself)
+            returns: self """
+        t0 = time.perf_counter()
+        dx = 0 if x is None else int(x) - self.x
+        dy = 0 if y is None else int(y) - self.y
+        rescale = scale is not None and float(scale) != self.scale
+        self.x += dx; self.y += dy
+        if scale is not None:
+            self.scale = float(scale)
+        w = int(round(self.white_size[0] * self.scale)); h = int(round(self.white_size[1] * self.scale))
+        bw = int(round(self.black_size[0] * self.scale)); bh = int(round(self.black_size[1] * self.scale))
+        keys = self.keys; black = keys['black']
+        white_x = self.x + np.arange(len(self.white_keys)) * w
+        keys['x0'][~black] = white_x; keys['x1'][~black] = white_x + w
+        keys['y0'] = self.y
+        keys['y1'][~black] = self.y + h
+        black_x = int(self.x + w - bw / 2.0) + self.left_white * w #centred on the right edge of the white key on its left
+        keys['x0'][black] = black_x; keys['x1'][black] = black_x + bw
+        keys['y1'][black] = self.y + bh
+        if build:
+            if rescale or self.lookup is None:
+                self.buildCaches()
+            elif dx or dy:
+                self.lookup.translate(dx, dy)
+                self.renderer.translate(dx, dy)
+            self.rebuild_ms = (time.perf_counter() - t0) * 1000
+        return self
+
+    def bboxes(self, black=False):
+
+        """ Function: Key rectangles of one colour
+            Arguments: self, black: black keys instead of white ones
+            returns: (N,4) float array of xmin,ymin,xmax,ymax in key index order """
+        keys = self.keys[self.black_keys if black else self.white_keys]
+        return np.stack([keys['x0'], keys['y0'], keys['x1'], keys['y1']], axis=1).astype(np.float64)
+
+    def names(self, black=None):
+
+        """ Function: Note names of all keys (pitch order) or of the keys of one colour (key index order)
+            Arguments: self, black: None for all keys, True/False for black/white keys
+            returns: list of note names """
+        if black is None:
+            return self.keys['name'].tolist()
+        return self.keys['name'][self.black_keys if black else self.white_keys].tolist()
+
+    def buildCaches(self):
+
+        """ Function: Build the key lookup table and the pre-rendered overlay from the key table
+            Arguments: self
+            returns: None """
+        bboxes_white = self.bboxes(False); bboxes_black = self.bboxes(True)
+        self.lookup = keyLookup(bboxes_black, bboxes_white, self.names(True), self.names(False))
+        self.renderer = keyboardRenderer(bboxes_white, bboxes_black)
+
+    def noteIds(self, labels):
+
+        """ Function: Note ids of keyLookup labels
+            Arguments: self, labels: array from lookup.lookup(), -1 for a miss
+            returns: int array of note ids, -1 for a miss """
+        labels = np.asarray(labels)
+        ids = np.concatenate([self.black_ids, self.white_ids]) #keyLookup labels list black keys first
+        return np.where(labels >= 0, ids[np.maximum(labels, 0)], -1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time layout changes of the virtual keyboard')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    for keys in sorted(keyboard_ranges):
+        layout = keyboardLayout(keys)
+        times = {'range': [], 'move': [], 'scale': []}
+        for i in range(args.repeat):
+            layout.setRange(keys); times['range'].append(layout.rebuild_ms)
+            layout.place(40 + i % 7, 250 - i % 5); times['move'].append(layout.rebuild_ms)
+            layout.place(scale=1.0 + (i % 4) * 0.25); times['scale'].append(layout.rebuild_ms)
+        print("%2d keys (%s-%s): %s" % (keys, layout.keys['name'][0], layout.keys['name'][-1],
+              ' '.join('%s %.3f ms' % (name, np.median(t)) for name, t in times.items())))
+    sys.exit()
@@ -0,0 +1,99 @@
+# Pre-rendered piano keyboard overlay used by initialize_visualizer() and visualizer() in Virtual_Piano.py
+import cv2
+import numpy as np
+import collections
+import time
+
+white_highlight = (255, 182, 193) #color of pressed white keys
+black_highlight = (144, 238, 144) #color of pressed black keys
+
+
+class keyboardRenderer():
+    def __init__(self, bboxes_white, bboxes_black, outline=2, opacity=1.0):
+
+        """ Function: Draw the keyboard once into a small overlay image plus mask covering only the keyboard area
+            Arguments: bboxes_white, bboxes_black: (N,4) xmin,ymin,xmax,ymax of the keys in frame pixels
+                       outline: thickness of the white key outlines
+                       opacity: 1.0 pastes the keyboard over the frame, lower values blend it with the frame
+            returns: None """
+        self.bboxes_white = np.asarray(bboxes_white).astype(int)
+        self.bboxes_black = np.asarray(bboxes_black).astype(int)
+        self.opacity = opacity
+        boxes = np.concatenate([self.bboxes_white, self.bboxes_black])
+        pad = outline #outlines are drawn centred on the bbox edges and spill over them
+        self.x0 = int(boxes[:, 0].min()) - pad; self.y0 = int(boxes[:, 1].min()) - pad
+        self.x1 = int(boxes[:, 2].max()) + pad + 1; self.y1 = int(boxes[:, 3].max()) + pad + 1
+        self.overlay = np.zeros((self.y1 - self.y0, self.x1 - self.x0, 3), dtype=np.uint8)
+        mask = np.zeros(self.overlay.shape[:2], dtype=np.uint8)
+        offset = np.array([self.x0, self.y0, self.x0, self.y0])
+        for xmin, ymin, xmax, ymax in self.bboxes_white - offset:
+            cv2.rectangle(self.overlay, (xmin, ymin), (xmax, ymax), [255, 255, 255], outline)
+            cv2.rectangle(mask, (xmin, ymin), (xmax, ymax), 255, outline)
+        for xmin, ymin, xmax, ymax in self.bboxes_black - offset:
+            cv2.rectangle(self.overlay, (xmin, ymin), (xmax, ymax), [0, 0, 0], -1)
+            cv2.rectangle(mask, (xmin, ymin), (xmax, ymax), 255, -1)
+        self.mask = mask > 0 #alpha mask of the overlay
+        self.render_times = collections.deque(maxlen=300) #seconds spent in compose()+highlight() for recent frames
+        self.started = None
+
+    def translate(self, dx, dy):
+
+        """ Function: Move the keyboard by whole pixels, the overlay and mask are reused as they are
+            Arguments: self, dx, dy: pixel offsets
+            returns: None """
+        dx = int(dx); dy = int(dy)
+        self.x0 += dx; self.x1 += dx; self.y0 += dy; self.y1 += dy
+        self.bboxes_white = self.bboxes_white + [dx, dy, dx, dy]
+        self.bboxes_black = self.bboxes_black + [dx, dy, dx, dy]
+
+    def compose(self, img):
+
+        """ Function: Paste the pre-rendered keyboard on a frame in place, one masked copy over the keyboard area
+            Arguments: self, img: BGR frame
+            returns: img """
+        self.started = time.perf_counter()
+        h, w = img.shape[:2]
+        x0 = max(self.x0, 0); y0 = max(self.y0, 0); x1 = min(self.x1, w); y1 = min(self.y1, h)
+        if x1 <= x0 or y1 <= y0:
+            return img #keyboard entirely outside the frame
+        roi = img[y0:y1, x0:x1]
+        overlay = self.overlay[y0 - self.y0:y1 - self.y0, x0 - self.x0:x1 - self.x0]
+        mask = self.mask[y0 - self.y0:y1 - self.y0, x0 - self.x0:x1 - self.x0]
+        if self.opacity >= 1.0:
+            np.copyto(roi, overlay, where=mask[:, :, None])
+        else:
+            blended = cv2.addWeighted(overlay, self.opacity, roi, 1.0 - self.opacity, 0)
+            np.copyto(roi, blended, where=mask[:, :, None])
+        return img
+
+    def highlight(self, img, key_index_array):
+
+        """ Function: Redraw only the pressed keys (dirty regions) on a composed frame
+            Arguments: self, img: frame returned by compose()
+                       key_index_array: list of [key_index, color] of the pressed keys
+            returns: img """
+        for key_index, color in key_index_array:
+            if color == 'white':
+                xmin, ymin, xmax, ymax = self.bboxes_white[key_index]
+                cv2.rectangle(img, (int(xmin), int(ymin)), (int(xmax), int(ymax)), white_highlight, -1)
+            elif color == 'black':
+                xmin, ymin, xmax, ymax = self.bboxes_black[key_index]
+                cv2.rectangle(img, (int(xmin), int(ymin)), (int(xmax), int(ymax)), black_highlight, -1)
+        if self.started is not None:
+            self.render_times.append(time.perf_counter() - self.started)
+            self.started = None
+        return img
+
+    def render(self, img, key_index_array):
+
+        """ Function: compose() followed by highlight()
+            Arguments: self, img: BGR frame (modified in place), key_index_array: pressed keys
+            returns: img """
+        return self.highlight(self.compose(img), key_index_array)
+
+    def renderTime(self):
+
+        """ Function: Average render time of the recent frames
+            Arguments: self
+            returns: milliseconds """
+        return float(np.mean(self.render_times) * 1000) if self.render_times else 0.0
@@ -0,0 +1,95 @@
+# One Euro smoothing and short horizon prediction of hand landmarks, for all hands at once
+import numpy as np
+from press_detector import tip_index
+
+
+def smoothing_factor(cutoff, dt):
+    tau = 1.0 / (2 * np.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class landmarkFilter():
+    def __init__(self, min_cutoff=1.0, beta=0.01, d_cutoff=1.0, prediction=0.05, max_jump=80, max_hands=4):
+
+        """ Function: One Euro filter on every landmark of every hand: heavy smoothing while a hand is still,
+                      little lag while it moves fast. Also tracks landmark velocity for prediction and note loudness
+            Arguments: min_cutoff: cutoff frequency (Hz) when a landmark is still, lower = smoother
+                       beta: how fast the cutoff rises with speed (per pixel/s), higher = less lag on fast moves
+                       d_cutoff: cutoff frequency (Hz) of the velocity estimate
+                       prediction: seconds ahead predict() extrapolates by default
+                       max_jump: a hand whose wrist moved more than this many pixels in one frame is restarted
+                                 (hands are matched by detection order, which mediapipe sometimes swaps)
+                       max_hands: initial number of hand slots
+            returns: None """
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.prediction = prediction
+        self.max_jump = max_jump
+        self.x = np.zeros((max_hands, 21, 2)) #filtered positions per hand slot
+        self.dx = np.zeros((max_hands, 21, 2)) #filtered velocity in pixels per second
+        self.hands = 0 #hand slots in use after the last frame
+        self.last_time = None
+
+    def reset(self):
+        self.hands = 0
+        self.last_time = None
+
+    def settleFrames(self, dt, tolerance=1e-6):
+
+        """ Function: Frames after which the filter has forgotten its starting state, i.e. two filters started from
+                      different states agree to within tolerance (relative to their initial difference). Fast moves
+                      raise the cutoff and settle sooner, so this is the worst case of a still hand
+            Arguments: self, dt: seconds between frames, tolerance: remaining fraction of the initial difference
+            returns: int number of frames """
+        keep = 1 - smoothing_factor(min(self.min_cutoff, self.d_cutoff), dt) #fraction of the old state kept every frame
+        return int(np.ceil(np.log(tolerance) / np.log(keep)))
+
+    def filter(self, hands, timestamp):
+
+        """ Function: Smooth one frame of landmarks
+            Arguments: self, hands: (H,21,2) landmark pixel coordinates from handDetector.findPositions()
+                       timestamp: capture time of the frame in seconds
+            returns: (H,21,2) float array of filtered landmarks """
+        hands = np.asarray(hands, dtype=np.float64).reshape(-1, 21, 2)
+        count = len(hands)
+        if count > len(self.x):
+            self.x = np.concatenate([self.x, np.zeros((count - len(self.x), 21, 2))])
+            self.dx = np.concatenate([self.dx, np.zeros((count - len(self.dx), 21, 2))])
+        dt = 1.0 / 30 if self.last_time is None else max(timestamp - self.last_time, 1e-3)
+        self.last_time = timestamp
+        x = self.x[:count]; dx = self.dx[:count]
+        fresh = np.arange(count) >= self.hands #hands that were not there in the previous frame
+        fresh |= np.linalg.norm(hands[:, 0] - x[:, 0], axis=-1) > self.max_jump
+        raw_dx = (hands - x) / dt
+        a_d = smoothing_factor(self.d_cutoff, dt)
+        dx[:] = np.where(fresh[:, None, None], 0.0, a_d * raw_dx + (1 - a_d) * dx)
+        a = smoothing_factor(self.min_cutoff + self.beta * np.linalg.norm(dx, axis=-1, keepdims=True), dt)
+        x[:] = np.where(fresh[:, None, None], hands, a * hands + (1 - a) * x)
+        self.hands = count
+        return x.copy()
+
+    def predict(self, horizon=None):
+
+        """ Function: Extrapolate the filtered landmarks along their velocity
+            Arguments: self, horizon: seconds ahead (default: self.prediction)
+            returns: (H,21,2) predicted landmarks of the hands of the last frame """
+        horizon = self.prediction if horizon is None else horizon
+        return self.x[:self.hands] + self.dx[:self.hands] * horizon
+
+    def tipSpeed(self):
+
+        """ Function: Downward speed of every finger tip (image y grows downwards, so positive = moving onto the key)
+            Arguments: self
+            returns: (H,5) pixels per second """
+        return self.dx[:self.hands, tip_index, 1]
+
+
+def press_velocity(speed, min_speed=50.0, max_speed=800.0, min_velocity=30, max_velocity=127):
+
+    """ Function: Map finger tip speed at the moment of a press to a note velocity (loudness)
+            Arguments: speed: downward speed(s) in pixels per second
+                       min_speed, max_speed: speeds mapped to min_velocity and max_velocity
+            returns: int velocity array of the same shape """
+    t = np.clip((np.asarray(speed, dtype=np.float64) - min_speed) / float(max_speed - min_speed), 0.0, 1.0)
+    return np.round(min_velocity + t * (max_velocity - min_velocity)).astype(int)
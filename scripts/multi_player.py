@@ -0,0 +1,435 @@
+# Several cameras and players served at once: a shared pool of hand inference processes with fair per source scheduling,
+# per player keyboards and note trackers, and one audio process mixing the notes of all players
+import cv2
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import collections
+import queue
+import signal
+import json
+import time
+import os
+import sys
+import argparse
+import Virtual_Piano as vp
+from frame_source import frameGrabber, open_source
+from keyboard_layout import keyboardLayout
+from note_tracker import noteTracker
+from press_detector import threshold_vector
+from event_ring import eventRing
+from audio_engine import player_event_dtype, NOTE_ON
+
+
+class frameSlots():
+    def __init__(self, shape, slots=1, name=None, create=True):
+
+        """ Function: Frame buffers in shared memory, so frames reach the inference processes without being pickled
+            Arguments: shape: (h,w,3) frame shape, slots: frames of one source that can be in flight at once
+                       name: segment to attach to (create=False), create: create a new segment
+            returns: None """
+        self.shape = tuple(shape)
+        self.slots = slots
+        size = int(np.prod(self.shape)) * slots
+        self.shm = shared_memory.SharedMemory(create=True, size=size) if create else shared_memory.SharedMemory(name=name)
+        self.owner = create
+        self.name = self.shm.name
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.free = list(range(slots)) #slots not in flight (creator side)
+
+    def close(self):
+        del self.frames #release the view before closing the buffer
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def inference_worker(worker, tasks, results, roi=False):
+
+    """ Function: Hand inference process of the shared pool. Keeps one handDetector per source it has served,
+                  since MediaPipe tracks the hands of a camera from one frame to the next
+            Arguments: worker: index of this worker, tasks: queue of (source, seq, slot, segment name, slots shape, keyboard band), None stops it
+                       results: queue the (worker, source, seq, slot, landmarks, handedness, inference ms, error) results go to
+                       roi: run inference on a crop around the previous hands (see handDetector)
+            returns: None """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C reaches the scheduler, which finishes the frames in flight and then stops the workers
+    detectors = {}
+    buffers = {} #attached frameSlots per source
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        source, seq, slot, name, shape, band = task
+        if source not in buffers or buffers[source].name != name: #a source reallocates its slots when its frame size changes
+            if source in buffers:
+                buffers[source].close()
+            buffers[source] = frameSlots(shape[1:], shape[0], name, create=False)
+        img = buffers[source].frames[slot]
+        t0 = time.perf_counter()
+        try:
+            if source not in detectors:
+                detectors[source] = vp.handDetector(roi=roi, keyboard_band=band)
+            detector = detectors[source]
+            detector.findHands(img, draw=False)
+            landmarks = detector.findPositions(img); handedness = detector.handedness(); error = None
+        except Exception as e:
+            landmarks = np.zeros((0, 21, 2), dtype=int); handedness = []; error = repr(e)
+        results.put((worker, source, seq, slot, landmarks, handedness, (time.perf_counter() - t0) * 1000, error))
+    for buffer in buffers.values():
+        buffer.close()
+
+
+class playerSource():
+    def __init__(self, index, spec, name=None, keys=None, x=None, y=None, scale=None, weight=1.0, fps=None):
+
+        """ Function: One camera and the player in front of it: own keyboard, note tracker and landmark filter
+            Arguments: index: player number, carried by its note events, spec: camera url, webcam index, video file or image directory
+                       name: player name, keys/x/y/scale: keyboard of this player (default: the global keyboard settings)
+                       weight: share of the inference pool this source gets when the pool is saturated, relative to the others
+                       fps: pace video files and image directories to this rate, like a camera (None: as fast as they decode)
+            returns: None """
+        self.index = index
+        self.spec = spec
+        self.name = name or 'player%d' % index
+        self.weight = float(weight)
+        self.fps = fps
+        self.layout = keyboardLayout(keys or vp.keyboard_keys, vp.start_x if x is None else x, vp.start_y if y is None else y,
+                                     vp.keyboard_scale if scale is None else scale,
+                                     (vp.white_key_width, vp.white_key_height), (vp.black_key_width, vp.black_key_height))
+        bboxes = self.layout.bboxes(black=False)
+        self.band = (float(bboxes[:, 1].min()), float(bboxes[:, 3].max())) #keyboard rows, kept inside the inference crop
+        self.tracker = noteTracker(len(vp.key_reference), vp.press_debounce_frames, vp.release_debounce_frames, vp.min_hold_frames, vp.release_threshold_scale)
+        self.smoother = vp.make_landmark_filter()
+        self.grabber = None
+        self.slots = None
+        self.inflight = collections.deque() #(seq, capture timestamp) of the frames dispatched and not handled yet, in capture order
+        self.done = {} #results that came back before an earlier frame of this source
+        self.worker = None #worker that served the last frame, preferred for the next one
+        self.dispatched = 0; self.completed = 0; self.notes = 0; self.errors = 0
+        self.last_error = None #message of the last failed inference
+        self.latencies = collections.deque(maxlen=1000) #ms from frame capture to its notes
+        self.inference_ms = collections.deque(maxlen=1000)
+        self.workers_used = collections.Counter()
+        self.frame = None #last rendered frame, for display
+
+    def start(self):
+        source = open_source(self.spec, fps=self.fps) if os.path.exists(str(self.spec)) else open_source(self.spec)
+        self.grabber = frameGrabber(source, vp.frame_width).start()
+        return self
+
+    def stop(self):
+        try:
+            if self.grabber is not None:
+                self.grabber.stop()
+        finally:
+            if self.slots is not None:
+                self.slots.close()
+                self.slots = None
+
+    def finished(self):
+        return not self.grabber.running and not self.grabber.ready() and not self.inflight
+
+
+class multiPlayer():
+    def __init__(self, players, workers=2, ring=None, max_inflight=1, roi=None, display=False, context=None):
+
+        """ Function: Serve several players with one pool of inference processes. The scheduler hands the newest frame of
+                      the least served source (relative to its weight) to an idle worker, preferring the worker that
+                      served that source last; results are put back in capture order per source before note detection
+            Arguments: players: list of playerSource, workers: inference processes
+                       ring: eventRing of player_event_dtype the note events of all players are pushed to (None: not played)
+                       max_inflight: frames of one source in the pool at once. 1 keeps every source on one frame at a time
+                                     (lowest latency); more lets a single source use several workers
+                       roi: run inference on crops around the hands (default: roi_tracking), display: show every player's frames
+                       context: multiprocessing context the workers are started from (default: the global start method)
+            returns: None """
+        self.players = players
+        self.workers = workers
+        self.ring = ring
+        self.max_inflight = max(1, max_inflight)
+        self.roi = vp.roi_tracking if roi is None else roi
+        self.display = display
+        self.context = context or multiprocessing
+        self.thresholds = threshold_vector(vp.dist_threshold_param)
+        self.tasks = []; self.processes = []
+        self.results = None
+        self.idle = [] #workers without a task
+        self.busy_ms = np.zeros(workers) #inference time per worker
+        self.start_time = None
+
+    def start(self):
+        resource_tracker.ensure_running() #workers share this process's tracker, so their attached frame slots are not reported as leaked
+        self.results = self.context.Queue()
+        for w in range(self.workers):
+            tasks = self.context.Queue()
+            process = self.context.Process(target=inference_worker, args=(w, tasks, self.results, self.roi), daemon=True)
+            process.start()
+            self.tasks.append(tasks); self.processes.append(process)
+        self.idle = list(range(self.workers))
+        for player in self.players:
+            player.start()
+        self.start_time = time.monotonic()
+        return self
+
+    def pick(self):
+
+        """ Function: Next source to hand a frame to the pool: a new frame must be waiting, the source must have room in
+                      flight, and among those the one with the fewest frames dispatched per unit of weight goes first
+            Arguments: self
+            returns: playerSource or None """
+        ready = [p for p in self.players if len(p.inflight) < self.max_inflight and p.grabber.ready()]
+        if not ready:
+            return None
+        return min(ready, key=lambda p: (p.dispatched / p.weight, p.index))
+
+    def dispatch(self):
+
+        """ Function: Hand waiting frames to idle workers until either runs out
+            Arguments: self
+            returns: number of frames dispatched """
+        count = 0
+        while self.idle:
+            player = self.pick()
+            if player is None:
+                break
+            img, info = player.grabber.read(timeout=0)
+            if img is None:
+                continue
+            if player.slots is None or player.slots.shape != img.shape:
+                if player.inflight:
+                    continue #the frame size changed, wait until the old slots are back before reallocating them
+                if player.slots is not None:
+                    player.slots.close()
+                player.slots = frameSlots(img.shape, self.max_inflight)
+            slot = player.slots.free.pop()
+            player.slots.frames[slot] = img #the grabber reuses its buffer on the next read
+            worker = player.worker if player.worker in self.idle else self.idle[0]
+            self.idle.remove(worker)
+            self.tasks[worker].put((player.index, info['seq'], slot, player.slots.name, (player.slots.slots,) + player.slots.shape, player.band))
+            player.inflight.append((info['seq'], info['timestamp']))
+            player.worker = worker
+            player.dispatched += 1
+            count += 1
+        return count
+
+    def collect(self, timeout=0.002):
+
+        """ Function: Take the finished results off the result queue and handle the ones that are next in line for their source
+            Arguments: self, timeout: seconds to wait for the first result
+            returns: number of results taken """
+        count = 0
+        try:
+            result = self.results.get(timeout=timeout)
+            while True:
+                worker, source, seq, slot, landmarks, handedness, inference_ms, error = result
+                self.idle.append(worker)
+                self.busy_ms[worker] += inference_ms
+                player = self.players[source]
+                player.done[seq] = result
+                player.workers_used[worker] += 1
+                while player.inflight and player.inflight[0][0] in player.done:
+                    seq, timestamp = player.inflight.popleft()
+                    self.handle(player, player.done.pop(seq), timestamp)
+                count += 1
+                result = self.results.get_nowait()
+        except queue.Empty:
+            pass
+        return count
+
+    def handle(self, player, result, timestamp):
+
+        """ Function: Note detection of one frame on the player's keyboard, events to the mixing audio process
+            Arguments: self, player: playerSource, result: inference result of the frame, timestamp: its capture time
+            returns: None """
+        worker, source, seq, slot, landmarks, handedness, inference_ms, error = result
+        detect, coordinates, keys, events = vp.detect_notes(landmarks, timestamp, player.tracker, self.thresholds, player.smoother, handedness, player.layout)
+        if self.ring is not None:
+            if events:
+                self.ring.put([tuple(event) + (player.index,) for event in events])
+            self.ring.frameDone()
+        if self.display:
+            player.frame = player.layout.renderer.render(player.slots.frames[slot].copy(), keys)
+        player.slots.free.append(slot)
+        player.completed += 1
+        player.notes += sum(1 for event in events if event[0] == NOTE_ON)
+        if error is not None:
+            player.errors += 1; player.last_error = error
+        player.latencies.append((time.monotonic() - timestamp) * 1000)
+        player.inference_ms.append(inference_ms)
+
+    def run(self, seconds=None, max_frames=None, poll=0.002):
+
+        """ Function: Scheduling loop: dispatch waiting frames, collect results, until the time or frame limit is reached,
+                      every source has ended, or it is interrupted
+            Arguments: self, seconds: run time limit, max_frames: stop once every source has completed this many frames
+                       poll: max seconds to wait for a result before looking for new frames again
+            returns: stats() """
+        try:
+            while True:
+                if seconds is not None and time.monotonic() - self.start_time >= seconds:
+                    break
+                if max_frames is not None and all(p.completed >= max_frames for p in self.players):
+                    break
+                if all(p.finished() for p in self.players):
+                    break
+                self.dispatch()
+                self.collect(poll)
+                if self.display:
+                    for player in self.players:
+                        if player.frame is not None:
+                            cv2.imshow(player.name, player.frame); player.frame = None
+                    cv2.waitKey(1)
+        except KeyboardInterrupt:
+            print("Stopped, finishing the frames in flight")
+        deadline = time.monotonic() + 5
+        while any(p.inflight for p in self.players) and time.monotonic() < deadline:
+            self.collect(0.05)
+        return self.stats()
+
+    def stop(self):
+        try:
+            for tasks in self.tasks:
+                tasks.put(None)
+            for process in self.processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+        finally:
+            for player in self.players: #frees the shared memory frame slots
+                player.stop()
+
+    def stats(self):
+
+        """ Function: Throughput and latency per source, worker utilization and how evenly the pool was shared
+            Arguments: self
+            returns: dict """
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        sources = {}
+        for p in self.players:
+            lat = np.array(p.latencies)
+            sources[p.name] = {'frames': p.completed, 'fps': p.completed / elapsed, 'dropped': p.grabber.dropped if p.grabber else 0,
+                               'latency_ms_p50': float(np.percentile(lat, 50)) if len(lat) else 0.0,
+                               'latency_ms_p95': float(np.percentile(lat, 95)) if len(lat) else 0.0,
+                               'inference_ms': float(np.mean(p.inference_ms)) if p.inference_ms else 0.0,
+                               'notes': p.notes, 'errors': p.errors, 'last_error': p.last_error, 'workers_used': len(p.workers_used)}
+        share = np.array([p.completed / p.weight for p in self.players if p.grabber is not None and p.grabber.dropped], dtype=np.float64)
+        fairness = float(share.sum() ** 2 / (len(share) * (share ** 2).sum())) if share.any() else 1.0 #Jain's index over the sources the pool held back, 1 = shared by weight
+        return {'sources': sources, 'seconds': elapsed, 'fps': sum(p.completed for p in self.players) / elapsed,
+                'worker_utilization': (self.busy_ms / 1000 / elapsed).round(3).tolist(), 'fairness': fairness}
+
+
+def make_players(specs, fps=None):
+
+    """ Function: Players from camera specs or player dicts ({'source': ..., 'name', 'keys', 'x', 'y', 'scale', 'weight'})
+            Arguments: specs: list of camera specs and/or dicts, fps: pacing of file and directory sources
+            returns: list of playerSource """
+    players = []
+    for i, spec in enumerate(specs):
+        spec = dict(spec) if isinstance(spec, dict) else {'source': spec}
+        players.append(playerSource(i, spec.pop('source'), fps=fps, **spec))
+    return players
+
+
+def run_players(specs, workers=2, seconds=None, max_inflight=1, display=True, audio=True, fps=None):
+
+    """ Function: Multi player mode of the piano: all sources share the inference pool, all players share one audio process
+            Arguments: specs: camera specs or player dicts (see make_players), workers: inference processes
+                       seconds: stop after this long (None runs until interrupted or every source ends)
+                       max_inflight: see multiPlayer, display: one window per player, audio: start the mixing audio process
+                       fps: pacing of file and directory sources
+            returns: stats() of the run """
+    if not vp.key_reference:
+        vp.piano_key_initializer()
+    players = make_players(specs, fps)
+    ring = eventRing(capacity=vp.event_ring_capacity, dtype=player_event_dtype) if audio else None
+    audio_process = None
+    if audio:
+        audio_process = multiprocessing.Process(target=vp.play_music, args=(ring, [p.name for p in players]), daemon=True)
+        audio_process.start()
+    pool = multiPlayer(players, workers, ring, max_inflight, display=display).start()
+    try:
+        stats = pool.run(seconds)
+    finally:
+        try:
+            pool.stop()
+        finally:
+            if audio_process is not None:
+                try:
+                    if audio_process.is_alive(): #it is gone already when it failed to start, for example without music_dir
+                        os.kill(audio_process.pid, signal.SIGINT) #like Ctrl+C, the audio process prints its stats and exits (SDL swallows SIGTERM)
+                        audio_process.join(timeout=5)
+                        if audio_process.is_alive():
+                            audio_process.kill(); audio_process.join()
+                    else:
+                        print("Audio process exited early with code", audio_process.exitcode)
+                    print("Event ring stats:", ring.stats())
+                finally:
+                    ring.close()
+    print_stats(stats)
+    return stats
+
+
+def print_stats(stats):
+    for name, s in stats['sources'].items():
+        print("%-10s %6.1f fps  latency p50 %6.1f ms p95 %6.1f ms  inference %5.1f ms  dropped %d  notes %d  errors %d" %
+              (name, s['fps'], s['latency_ms_p50'], s['latency_ms_p95'], s['inference_ms'], s['dropped'], s['notes'], s['errors']))
+    print("total %.1f fps, worker utilization %s, fairness %.3f" % (stats['fps'], stats['worker_utilization'], stats['fairness']))
+
+
+def scaling_report(specs, worker_counts, seconds=10.0, max_inflight=1, fps=30.0):
+
+    """ Function: Run the sources without display or audio, adding one source at a time, for every worker count,
+                  to see how per source fps and latency hold up as sources and cores are added
+            Arguments: specs: camera specs (local replays of video files or image directories for repeatable runs)
+                       worker_counts: list of pool sizes, seconds: run time per configuration
+                       max_inflight: see multiPlayer, fps: pacing of the replays (camera like), 0 for as fast as possible
+            returns: list of dicts (workers, sources, stats) """
+    if not vp.key_reference:
+        vp.piano_key_initializer()
+    rows = []
+    for workers in worker_counts:
+        for n in range(1, len(specs) + 1):
+            pool = multiPlayer(make_players(specs[:n], fps or None), workers, None, max_inflight).start()
+            try:
+                stats = pool.run(seconds)
+            finally:
+                pool.stop()
+            fps_values = [s['fps'] for s in stats['sources'].values()]
+            latency = [s['latency_ms_p95'] for s in stats['sources'].values()]
+            errors = sum(s['errors'] for s in stats['sources'].values())
+            print("%d workers %2d sources: total %6.1f fps, per source %5.1f-%5.1f fps, p95 latency up to %6.1f ms, fairness %.3f, utilization %s%s" %
+                  (workers, n, stats['fps'], min(fps_values), max(fps_values), max(latency), stats['fairness'], stats['worker_utilization'],
+                   ", %d inference errors" % errors if errors else ""))
+            rows.append({'workers': workers, 'sources': n, 'stats': stats})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve several cameras/players at once with a shared hand inference pool and one mixing audio process')
+    parser.add_argument('sources', nargs='*', help='camera urls, webcam indices, video files or image directories, one player each')
+    parser.add_argument('--players', default=None, help='JSON file with a list of players: {"source": ..., "name", "keys", "x", "y", "scale", "weight"}')
+    parser.add_argument('--workers', type=int, nargs='+', default=[vp.inference_workers], help='inference processes (several values with --scaling)')
+    parser.add_argument('--inflight', type=int, default=1, help='frames of one source in the pool at once')
+    parser.add_argument('--seconds', type=float, default=None, help='stop after this many seconds')
+    parser.add_argument('--fps', type=float, default=30.0, help='pace video file and image directory sources like a camera (0: as fast as possible)')
+    parser.add_argument('--scaling', action='store_true', help='report fps and latency as sources are added, for each --workers value (no display or audio)')
+    parser.add_argument('--headless', action='store_true', help='no windows')
+    parser.add_argument('--no-audio', action='store_true', help='do not start the audio process')
+    parser.add_argument('--output', default=None, help='write the stats to this JSON file')
+    args = parser.parse_args()
+    specs = list(args.sources)
+    if args.players:
+        with open(args.players) as f:
+            specs += json.load(f)
+    if not specs:
+        parser.error('no sources given')
+    vp.piano_key_initializer()
+    vp.load_calibration()
+    if args.scaling:
+        result = scaling_report(specs, args.workers, args.seconds or 10.0, args.inflight, args.fps)
+    else:
+        result = run_players(specs, args.workers[0], args.seconds, args.inflight, not args.headless, not args.no_audio, args.fps or None)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    sys.exit()
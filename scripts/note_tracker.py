@@ -0,0 +1,84 @@
+# Per key note state machine turning per frame press masks into note-on/note-off edge events
+import numpy as np
+from audio_engine import note_on, note_off
+
+
+class noteTracker():
+    def __init__(self, num_notes=88, press_frames=1, release_frames=2, min_hold_frames=0, release_scale=1.15, max_hands=4):
+
+        """ Function: Debounce and hysteresis on top of the raw per frame press detection
+            Arguments: num_notes: number of keys (note ids 0..num_notes-1)
+                       press_frames: frames a key must be seen pressed in a row before its note-on is sent
+                       release_frames: frames a key must be seen released in a row before its note-off is sent
+                       min_hold_frames: minimum number of frames a note stays on once triggered
+                       release_scale: a pressing finger is only released once its distance exceeds threshold*release_scale
+                                      (press uses threshold*1.0), so a finger hovering around the threshold does not flicker
+                       max_hands: hands tracked for finger hysteresis (hands are matched by detection order)
+            returns: None """
+        self.num_notes = num_notes
+        self.press_frames = max(1, press_frames)
+        self.release_frames = max(1, release_frames)
+        self.min_hold_frames = min_hold_frames
+        self.release_scale = release_scale
+        self.finger_pressed = np.zeros((max_hands, 5), dtype=bool) #finger state after hysteresis, per hand slot
+        self.active = np.zeros(num_notes, dtype=bool) #notes currently on (note-on sent, no note-off yet)
+        self.seen_count = np.zeros(num_notes, dtype=np.int64) #consecutive frames the key was pressed
+        self.missing_count = np.zeros(num_notes, dtype=np.int64) #consecutive frames the key was not pressed
+        self.held_frames = np.zeros(num_notes, dtype=np.int64) #frames since the note-on
+        self.events_sent = 0
+        self.frames = 0
+
+    def fingerMask(self, distances, thresholds):
+
+        """ Function: Press mask with hysteresis: press below threshold, release only above threshold*release_scale
+            Arguments: self, distances: (H,5) finger distances from press_detector.finger_distances()
+                       thresholds: (5,) or (H,5) press thresholds
+            returns: (H,5) int mask like press_detector.detect_presses() """
+        distances = np.asarray(distances).reshape(-1, 5)
+        hands = len(distances)
+        if hands > len(self.finger_pressed):
+            self.finger_pressed = np.concatenate([self.finger_pressed, np.zeros((hands - len(self.finger_pressed), 5), dtype=bool)])
+        prev = self.finger_pressed[:hands]
+        pressed = np.where(prev, distances < thresholds * self.release_scale, distances < thresholds)
+        self.finger_pressed[:hands] = pressed
+        self.finger_pressed[hands:] = False #hands that disappeared release their fingers
+        return pressed.astype(int)
+
+    def update(self, note_ids, timestamp=None, velocity=100):
+
+        """ Function: Advance the per key state machine by one frame
+            Arguments: self, note_ids: note ids of the keys pressed in this frame
+                       timestamp: time of the frame
+                       velocity: velocity of new note-on events, one value for all or one per entry of note_ids
+                                 (the loudest finger wins when several press the same key)
+            returns: list of note-on/note-off events, empty when nothing changed """
+        note_ids = np.asarray(list(note_ids), dtype=np.int64)
+        pressed = np.zeros(self.num_notes, dtype=bool)
+        pressed[note_ids] = True
+        if not np.isscalar(velocity):
+            velocities = np.zeros(self.num_notes, dtype=np.int64)
+            np.maximum.at(velocities, note_ids, np.asarray(velocity, dtype=np.int64))
+            velocity = velocities
+        self.frames += 1
+        self.seen_count = np.where(pressed, self.seen_count + 1, 0)
+        self.missing_count = np.where(pressed, 0, self.missing_count + 1)
+        self.held_frames[self.active] += 1
+        starting = ~self.active & (self.seen_count >= self.press_frames)
+        stopping = self.active & (self.missing_count >= self.release_frames) & (self.held_frames >= self.min_hold_frames)
+        self.active[starting] = True
+        self.active[stopping] = False
+        self.held_frames[starting] = 0
+        events = [note_on(n, velocity if np.isscalar(velocity) else velocity[n], timestamp) for n in np.flatnonzero(starting)] + [note_off(n, timestamp) for n in np.flatnonzero(stopping)]
+        self.events_sent += len(events)
+        return events
+
+    def releaseAll(self, timestamp=None):
+
+        """ Function: Note-off for every active note (for example when tracking stops)
+            Arguments: self, timestamp: time of the events
+            returns: list of note-off events """
+        events = [note_off(n, timestamp) for n in np.flatnonzero(self.active)]
+        self.active[:] = False
+        self.seen_count[:] = 0
+        self.events_sent += len(events)
+        return events
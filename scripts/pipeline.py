@@ -0,0 +1,186 @@
+# Multi-stage threaded frame pipeline with bounded drop-oldest queues between the stages
+import collections
+import threading
+import time
+
+end_of_stream = object() #returned by a source function when there are no more frames
+
+
+class dropOldestQueue():
+    def __init__(self, maxsize=2, drop_oldest=True):
+
+        """ Function: Bounded queue that never blocks the producer: when full the oldest item is dropped
+            Arguments: maxsize: number of items kept
+                       drop_oldest: if False put() waits for space instead (lossless, for batch processing)
+            returns: None """
+        self.items = collections.deque()
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        with self.cond:
+            if not self.drop_oldest:
+                self.cond.wait_for(lambda: len(self.items) < self.maxsize or self.closed)
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+
+        """ Function: Wait for the next item
+            Arguments: self, timeout: seconds to wait (None waits forever)
+            returns: item, or None on timeout or once the queue is closed and empty """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            item = self.items.popleft() if self.items else None
+            self.cond.notify_all() #wake a producer waiting for space
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        return len(self.items)
+
+
+class pipelineStage():
+    def __init__(self, name, fn, inbox, outbox, metrics=None):
+
+        """ Function: One worker thread taking packets from inbox, running fn and passing the result to outbox
+            Arguments: name: stage name
+                       fn: function packet -> packet (None drops the packet); for the source stage fn takes no argument
+                       inbox: dropOldestQueue to read from, None for the source stage
+                       outbox: dropOldestQueue to write to
+                       metrics: optional metricsRecorder receiving the stage timings
+            returns: None """
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.metrics = metrics
+        self.busy = 0.0 #seconds spent inside fn
+        self.processed = 0
+        self.last_seq = -1
+        self.out_of_order = 0 #packets arriving with a lower sequence number than the previous one
+        self.error = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='stage-' + self.name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            if self.inbox is not None:
+                packet = self.inbox.get(timeout=0.1)
+                if packet is None:
+                    if self.inbox.closed:
+                        break
+                    continue
+                if packet['seq'] < self.last_seq:
+                    self.out_of_order += 1
+                self.last_seq = packet['seq']
+            t0 = time.perf_counter()
+            try:
+                result = self.fn(packet) if self.inbox is not None else self.fn()
+            except Exception as e: #keep the error for stats() and stop the pipeline instead of dying silently
+                self.error = e
+                break
+            elapsed = time.perf_counter() - t0
+            self.busy += elapsed
+            if self.metrics is not None:
+                self.metrics.record(self.name, elapsed)
+            if result is end_of_stream:
+                break
+            if result is None:
+                continue
+            self.processed += 1
+            self.outbox.put(result)
+        self.running = False
+        self.outbox.close()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+
+
+class framePipeline():
+    def __init__(self, source, stages, queue_size=2, metrics=None, lossless=False):
+
+        """ Function: Chain of stages, each in its own thread, so throughput is set by the slowest stage
+            Arguments: source: function returning the next packet (a dict with at least 'seq'), None if there is none yet,
+                               or end_of_stream once the input is exhausted
+                       stages: list of (name, fn) with fn: packet -> packet or None to drop it
+                       queue_size: capacity of the drop-oldest queues between stages
+                       metrics: optional metricsRecorder receiving per stage timings
+                       lossless: stages wait for each other instead of dropping the oldest packets (batch processing)
+            returns: None """
+        self.queues = [dropOldestQueue(queue_size, not lossless) for i in range(len(stages) + 1)]
+        self.stages = [pipelineStage('source', source, None, self.queues[0], metrics)]
+        for i, (name, fn) in enumerate(stages):
+            self.stages.append(pipelineStage(name, fn, self.queues[i], self.queues[i + 1], metrics))
+        self.output = self.queues[-1] #packets that went through every stage
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def get(self, timeout=None):
+
+        """ Function: Next fully processed packet
+            Arguments: self, timeout: seconds to wait
+            returns: packet, or None on timeout or once the pipeline has finished """
+        return self.output.get(timeout)
+
+    def finished(self):
+        return self.output.closed and self.output.qsize() == 0
+
+    def failure(self):
+
+        """ Function: First stage that stopped on an exception, which ends the pipeline before its source is exhausted
+            Arguments: self
+            returns: (stage name, exception), or None if no stage failed """
+        for stage in self.stages:
+            if stage.error is not None:
+                return stage.name, stage.error
+        return None
+
+    def stop(self):
+        for stage in self.stages:
+            stage.running = False
+        for q in self.queues:
+            q.close()
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+
+        """ Function: Per stage utilization (busy time / wall time), throughput, dropped packets and queue backlog
+            Arguments: self
+            returns: dict stage name -> statistics """
+        elapsed = max(time.perf_counter() - self.started, 1e-9) if self.started else 1e-9
+        out = {}
+        for stage in self.stages:
+            out[stage.name] = {'utilization': stage.busy / elapsed,
+                               'processed': stage.processed,
+                               'fps': stage.processed / elapsed,
+                               'mean_ms': stage.busy / max(stage.processed, 1) * 1000,
+                               'backlog': stage.outbox.qsize(),
+                               'dropped': stage.outbox.dropped,
+                               'out_of_order': stage.out_of_order,
+                               'error': repr(stage.error) if stage.error else None}
+        return out
@@ -0,0 +1,94 @@
+# Vectorized key press detection for all detected hands at once
+import numpy as np
+
+finger_names = ['thumb', 'index', 'middle', 'ring', 'little'] #finger order used by all press masks
+press_landmarks = np.array([[2, 3, 4], [6, 7, 8], [10, 11, 12], [14, 15, 16], [18, 19, 20]]) #three landmarks per finger whose triangle shrinks on a press
+tip_index = press_landmarks[:, 2] #tip landmark of every finger, same as tip_landmarks in Virtual_Piano.py
+
+
+def threshold_vector(dist_threshold_param):
+
+    """ Function: Turn the per finger threshold dict into a vector in finger_names order
+            Arguments: dist_threshold_param: dict finger name -> threshold
+            returns: (5,) float array """
+    return np.array([dist_threshold_param[finger] for finger in finger_names], dtype=np.float64)
+
+
+def finger_distances(hands):
+
+    """ Function: Perimeter of the landmark triangle of every finger of every hand (in units of 10 pixels, like dist_threshold_param)
+            Arguments: hands: (H,21,2) array of landmark pixel coordinates
+            returns: (H,5) array of distances """
+    pts = np.asarray(hands).reshape(-1, 21, 2)[:, press_landmarks] / 10 #(H,5,3,2)
+    p1 = pts[:, :, 0]; p2 = pts[:, :, 1]; p3 = pts[:, :, 2]
+    return np.linalg.norm(p1 - p2, axis=-1) + np.linalg.norm(p3 - p2, axis=-1) + np.linalg.norm(p1 - p3, axis=-1)
+
+
+def palm_size(hands):
+
+    """ Function: Wrist to middle finger knuckle length of every hand (in units of 10 pixels, like finger_distances())
+            Arguments: hands: (H,21,2) array of landmark pixel coordinates
+            returns: (H,) array """
+    hands = np.asarray(hands).reshape(-1, 21, 2)
+    return np.linalg.norm(hands[:, 0] - hands[:, 9], axis=-1) / 10
+
+
+def normalized_distances(hands, units='pixels', frame_width=640):
+
+    """ Function: Finger distances in the units a threshold profile was calibrated in
+            Arguments: hands: (H,21,2) array of landmark pixel coordinates
+                       units: 'pixels' (units of 10 pixels of a frame_width wide frame, as dist_threshold_param) or
+                              'palm' (relative to the palm size, independent of resolution and distance to the camera)
+                       frame_width: width of the frame the landmarks come from, pixel distances are scaled to 640 wide frames
+            returns: (H,5) array of distances """
+    distances = finger_distances(hands)
+    if units == 'palm':
+        return distances / np.maximum(palm_size(hands), 1e-6)[:, None]
+    return distances * (640.0 / frame_width) if frame_width != 640 else distances
+
+
+def detect_presses(hands, thresholds, units='pixels', frame_width=640):
+
+    """ Function: Batched version of finger_detect_and_compute() for any number of hands
+            Arguments: hands: (H,21,2) array of landmark pixel coordinates
+                       thresholds: (5,) per finger thresholds (see threshold_vector) or (H,5) per hand thresholds
+                       units, frame_width: units the thresholds are in (see normalized_distances)
+            returns: detect: (H,5) int array, 1 where a key press is detected
+                     coordinates: (H,5,2) pixel coordinates of the pressing finger tips, 0 for the other fingers """
+    hands = np.asarray(hands).reshape(-1, 21, 2)
+    detect = (normalized_distances(hands, units, frame_width) < thresholds).astype(int)
+    coordinates = np.where(detect[:, :, None] != 0, hands[:, tip_index], 0).astype(np.float64)
+    return detect, coordinates
+
+
+def pressed_positions(detect, coordinates):
+
+    """ Function: Finger tip coordinates of all presses, finger by finger across hands (thumb of every hand first)
+            Arguments: detect: (H,5) press mask, coordinates: (H,5,2) tip coordinates
+            returns: (N,2) array of positions """
+    return np.asarray(coordinates).transpose(1, 0, 2)[np.asarray(detect).T != 0]
+
+
+def hysteresis_masks(distances, thresholds, release_scale, valid=None, state=None):
+
+    """ Function: Press masks of a whole sequence with the same press/release hysteresis as noteTracker.fingerMask(),
+                  without a loop over frames: a finger is pressed from the last frame it went below the threshold
+                  until the first frame it goes above threshold*release_scale (or its hand disappears)
+            Arguments: distances: (T,...,5) finger distances, thresholds: thresholds broadcastable against distances
+                       (for example (C,1,5) to evaluate C candidates at once, with distances of shape (T,1,H,5))
+                       release_scale: release threshold relative to the press threshold
+                       valid: optional bool mask of present hands, broadcastable against distances
+                       state: optional mask of the fingers pressed before the first frame
+            returns: (T,...) bool masks """
+    below = distances < thresholds
+    above = distances >= thresholds * release_scale
+    if valid is not None:
+        below = below & valid
+        above = above | ~valid
+    frames = np.arange(len(below), dtype=np.int32).reshape((-1,) + (1,) * (below.ndim - 1))
+    last_press = np.maximum.accumulate(np.where(below, frames, -1), axis=0) #latest frame that set the finger pressed
+    last_release = np.maximum.accumulate(np.where(above, frames, -1), axis=0) #latest frame that released it
+    masks = last_press > last_release #pressing wins over releasing in the same frame (only possible with release_scale < 1)
+    if state is not None: #fingers neither set nor released yet keep their state
+        masks |= (last_release < 0) & np.asarray(state, dtype=bool)
+    return masks
@@ -0,0 +1,198 @@
+# Preloaded piano sample bank used by the audio process in Virtual_Piano.py
+import pygame
+import pygame.mixer
+import pygame.sndarray
+import numpy as np
+import collections
+import os
+import sys
+import time
+import argparse
+
+
+def resolve_samples(sample_dir, note_names):
+
+    """ Function: Match every note name to its sample file, once at startup instead of listing the directory per key press
+            Arguments: sample_dir: directory with the 88 piano key samples
+                       note_names: note names in key order ('a0', 'a-0', 'b0', 'c1' ...)
+            returns: paths: list of file paths (None where no file matched) in the same order as note_names """
+    files = sorted(f for f in os.listdir(sample_dir) if not f.startswith('.'))
+    paths = []
+    for note in note_names:
+        fname = next((f for f in files if note in f), None) #same substring rule as the old find_music_list()
+        paths.append(os.path.join(sample_dir, fname) if fname else None)
+    return paths
+
+
+class sampleBank():
+    def __init__(self, sample_dir, note_names, lazy=False, max_bytes=None, cache_file=None):
+
+        """ Function: Resolve and decode the piano samples
+            Arguments: sample_dir: directory with the piano key samples
+                       note_names: note names in key order, the position in this list is the note id
+                       lazy: decode samples on first use instead of at startup
+                       max_bytes: memory cap for decoded samples when lazy (least recently used ones are evicted)
+                       cache_file: path of a .npy PCM cache; it is created if missing and then memory mapped, so
+                                   several processes can attach to the same decoded samples without copying
+                                   (the Sounds are still built from it at startup unless lazy)
+            returns: None """
+        t0 = time.perf_counter()
+        if not pygame.mixer.get_init():
+            pygame.mixer.init()
+        self.frequency, self.format, self.channels = pygame.mixer.get_init()
+        self.note_names = list(note_names)
+        self.note_id = {note: i for i, note in enumerate(self.note_names)} #note name -> note id
+        self.paths = resolve_samples(sample_dir, self.note_names)
+        self.lazy = lazy
+        self.max_bytes = max_bytes
+        self.sounds = collections.OrderedDict() #note id -> pygame Sound, in least recently used order
+        self.sound_bytes = 0
+        self.pcm = None #memory mapped PCM of all notes when a cache file is used
+        self.offsets = None
+        self.trigger_times = collections.deque(maxlen=1000) #latency of the last play() calls in seconds
+        for note, path in zip(self.note_names, self.paths):
+            if path is None:
+                print("No sample found for note", note)
+        if cache_file:
+            self.attach(cache_file)
+        if not lazy: #build every Sound now, so a first key press never copies PCM on the audio path
+            for note_id in range(len(self.note_names)):
+                self.sound(note_id)
+        self.startup_time = time.perf_counter() - t0
+
+    def sourceKey(self):
+
+        """ Function: Identity of the sample files the cache was decoded from: path, size and modification time of the
+                      file of every note, so replacing or editing a sample (or pointing to another directory) rebuilds the cache
+            Arguments: self
+            returns: (notes, 3) string array of path, size and mtime in nanoseconds ('' for notes without a sample) """
+        key = []
+        for path in self.paths:
+            if path is None:
+                key.append(('', '', ''))
+            else:
+                st = os.stat(path)
+                key.append((os.path.abspath(path), str(st.st_size), str(st.st_mtime_ns)))
+        return np.array(key, dtype=str).reshape(-1, 3)
+
+    def attach(self, cache_file):
+
+        """ Function: Memory map the PCM cache file, building it first if it is missing or stale
+            Arguments: self, cache_file: path of the .npy cache
+            returns: None """
+        index_file = cache_file + '.index.npz'
+        source = self.sourceKey()
+        if os.path.exists(cache_file) and os.path.exists(index_file):
+            index = np.load(index_file)
+            if (int(index['frequency']) == self.frequency and int(index['channels']) == self.channels and list(index['notes']) == self.note_names
+                    and 'sources' in index.files and np.array_equal(index['sources'], source)):
+                self.offsets = index['offsets']
+                self.pcm = np.load(cache_file, mmap_mode='r')
+                return
+        chunks = [self.decode(note_id) for note_id in range(len(self.note_names))]
+        lengths = [len(c) for c in chunks]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        pcm = np.lib.format.open_memmap(cache_file, mode='w+', dtype=np.int16, shape=(int(self.offsets[-1]), self.channels))
+        for note_id, chunk in enumerate(chunks):
+            pcm[self.offsets[note_id]:self.offsets[note_id + 1]] = chunk
+        pcm.flush()
+        del pcm
+        np.savez(index_file, offsets=self.offsets, frequency=self.frequency, channels=self.channels, notes=np.array(self.note_names), sources=source)
+        self.pcm = np.load(cache_file, mmap_mode='r')
+
+    def decode(self, note_id):
+
+        """ Function: Decode one sample file to PCM in the mixer format
+            Arguments: self, note_id: position of the note in note_names
+            returns: (frames, channels) int16 array, empty if the note has no sample """
+        path = self.paths[note_id]
+        if path is None:
+            return np.zeros((0, self.channels), dtype=np.int16)
+        pcm = pygame.sndarray.array(pygame.mixer.Sound(path))
+        return pcm.reshape(len(pcm), -1).astype(np.int16, copy=False)
+
+    def sound(self, note_id):
+
+        """ Function: Return the pygame Sound of a note, decoding (or building it from the PCM cache) if needed
+            Arguments: self, note_id: position of the note in note_names
+            returns: pygame.mixer.Sound, or None if the note has no sample """
+        snd = self.sounds.get(note_id)
+        if snd is not None:
+            self.sounds.move_to_end(note_id)
+            return snd
+        if self.paths[note_id] is None:
+            return None
+        if self.pcm is not None:
+            snd = pygame.sndarray.make_sound(np.ascontiguousarray(self.samples(note_id)).squeeze())
+        else:
+            snd = pygame.mixer.Sound(self.paths[note_id])
+        self.sounds[note_id] = snd
+        self.sound_bytes += pygame.sndarray.samples(snd).nbytes
+        if self.max_bytes:
+            while self.sound_bytes > self.max_bytes and len(self.sounds) > 1:
+                old_id, old = self.sounds.popitem(last=False)
+                self.sound_bytes -= pygame.sndarray.samples(old).nbytes
+        return snd
+
+    def samples(self, note_id):
+
+        """ Function: PCM data of a note without copying (a view of the cache file or of the loaded Sound)
+            Arguments: self, note_id: position of the note in note_names
+            returns: (frames, channels) int16 array """
+        if self.pcm is not None:
+            return self.pcm[self.offsets[note_id]:self.offsets[note_id + 1]]
+        snd = self.sound(note_id)
+        if snd is None:
+            return np.zeros((0, self.channels), dtype=np.int16)
+        pcm = pygame.sndarray.samples(snd)
+        return pcm.reshape(len(pcm), -1)
+
+    def play(self, note_id, channel=None):
+
+        """ Function: Play a note by id
+            Arguments: self, note_id: position of the note in note_names
+                       channel: mixer channel number to use, any free channel if None
+            returns: pygame Channel playing the note (None if nothing was played) """
+        t0 = time.perf_counter()
+        snd = self.sound(note_id)
+        if snd is None:
+            return None
+        if channel is None:
+            chan = snd.play()
+        else:
+            chan = pygame.mixer.Channel(channel)
+            chan.play(snd)
+        self.trigger_times.append(time.perf_counter() - t0)
+        return chan
+
+    def stats(self):
+
+        """ Function: Report startup time, memory use and trigger latency of the bank
+            Arguments: self
+            returns: dict of statistics """
+        times = np.array(self.trigger_times) * 1000
+        return {'startup_s': self.startup_time,
+                'loaded_notes': len(self.sounds),
+                'resident_bytes': int(self.sound_bytes),
+                'mapped_bytes': int(self.pcm.nbytes) if self.pcm is not None else 0,
+                'triggers': len(times),
+                'trigger_ms_p50': float(np.percentile(times, 50)) if len(times) else 0.0,
+                'trigger_ms_max': float(times.max()) if len(times) else 0.0}
+
+
+if __name__ == "__main__":
+    from Virtual_Piano import key_reference, piano_key_initializer, music_dir
+    parser = argparse.ArgumentParser(description='Load the piano sample bank and report startup time, memory and trigger latency')
+    parser.add_argument('--dir', default=music_dir, help='directory with the 88 piano key samples')
+    parser.add_argument('--lazy', action='store_true')
+    parser.add_argument('--max-mb', type=float, default=None)
+    parser.add_argument('--cache', default=None, help='memory mapped PCM cache file (.npy)')
+    args = parser.parse_args()
+    piano_key_initializer()
+    pygame.mixer.init()
+    pygame.mixer.set_num_channels(10)
+    bank = sampleBank(args.dir, key_reference, lazy=args.lazy, max_bytes=args.max_mb and args.max_mb * 1e6, cache_file=args.cache)
+    for note_id in range(len(key_reference)):
+        bank.play(note_id, note_id % 10)
+    print(bank.stats())
+    sys.exit()
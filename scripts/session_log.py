@@ -0,0 +1,335 @@
+# Append-only recording of per frame hand landmarks, press masks and note events, and fast replay without MediaPipe
+import numpy as np
+import contextlib
+import json
+import time
+import os
+import sys
+import argparse
+from audio_engine import note_event_dtype, NOTE_ON
+
+event_log_dtype = np.dtype([('frame', np.uint64)] + [(name, note_event_dtype[name]) for name in note_event_dtype.names]) #note event plus the frame that emitted it
+frames_file = 'frames.bin'; events_file = 'events.bin'; meta_file = 'session.json'
+labels_file = 'labels.npy' #optional ground truth press masks (frames,max_hands,5) used by calibrate.py
+
+
+def frame_dtype(max_hands=4):
+
+    """ Function: Fixed size record of one frame, so a session file can be memory mapped and indexed directly
+            Arguments: max_hands: hands stored per frame (extra hands are not recorded)
+            returns: numpy dtype """
+    return np.dtype([('seq', np.uint64),                          #frame sequence number from the grabber
+                     ('time', np.float64),                        #capture time of the frame (time.monotonic())
+                     ('hands', np.uint8),                         #number of valid hands in the arrays below
+                     ('handedness', np.uint8, (max_hands,)),      #0 left, 1 right, 255 unknown
+                     ('detect', np.uint8, (max_hands, 5)),        #press mask after hysteresis
+                     ('landmarks', np.int16, (max_hands, 21, 2))]) #raw landmark pixel coordinates from handDetector.findPositions()
+
+
+class sessionRecorder():
+    def __init__(self, path, max_hands=4, meta=None):
+
+        """ Function: Open (or continue) a session directory. Frames and events are appended as raw records, a session
+                      cut short by a crash stays readable up to its last complete record
+            Arguments: path: session directory
+                       max_hands: hands stored per frame
+                       meta: dict of settings saved with the session (thresholds, keyboard placement, ...)
+            returns: None """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        meta_path = os.path.join(path, meta_file)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                max_hands = json.load(f)['max_hands'] #appending keeps the record layout of the existing session
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(dict(meta or {}, max_hands=max_hands, created=time.time()), f, indent=2)
+        self.max_hands = max_hands
+        self.record = np.zeros((), dtype=frame_dtype(max_hands)) #reused for every frame
+        self.frames = open(os.path.join(path, frames_file), 'ab')
+        self.events = open(os.path.join(path, events_file), 'ab')
+        self.count = 0
+
+    def write(self, seq, timestamp, landmarks, handedness, detect, events):
+
+        """ Function: Append one frame and the note events it produced
+            Arguments: self, seq, timestamp: frame sequence number and capture time
+                       landmarks: (hands,21,2) raw landmarks, handedness: list of 0/1 per hand (may be empty)
+                       detect: (hands,5) press mask, events: note events of the frame
+            returns: None """
+        hands = min(len(landmarks), self.max_hands)
+        r = self.record
+        r['seq'] = seq; r['time'] = timestamp; r['hands'] = hands
+        r['handedness'] = 255; r['detect'] = 0; r['landmarks'] = 0
+        if hands:
+            r['landmarks'][:hands] = np.asarray(landmarks)[:hands]
+            r['detect'][:hands] = np.asarray(detect)[:hands]
+            handedness = list(handedness)[:hands]
+            r['handedness'][:len(handedness)] = handedness
+        self.frames.write(r.tobytes())
+        if len(events):
+            log = np.zeros(len(events), dtype=event_log_dtype)
+            log['frame'] = seq
+            for name, column in zip(note_event_dtype.names, zip(*events)):
+                log[name] = column
+            self.events.write(log.tobytes())
+        self.count += 1
+
+    def flush(self):
+        self.frames.flush(); self.events.flush()
+
+    def close(self):
+        self.frames.close(); self.events.close()
+
+
+class sessionReader():
+    def __init__(self, path):
+
+        """ Function: Memory map a recorded session, nothing is read until it is accessed
+            Arguments: path: session directory written by sessionRecorder
+            returns: None """
+        self.path = path
+        with open(os.path.join(path, meta_file)) as f:
+            self.meta = json.load(f)
+        self.frames = self.mapFile(frames_file, frame_dtype(self.meta['max_hands']))
+        self.events = self.mapFile(events_file, event_log_dtype)
+
+    def mapFile(self, name, dtype):
+        path = os.path.join(self.path, name)
+        count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0 #ignore a partly written last record
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def landmarks(self, i):
+
+        """ Function: Landmarks of one frame in the shape handDetector.findPositions() returns
+            Arguments: self, i: frame index
+            returns: (hands,21,2) int array """
+        frame = self.frames[i]
+        return np.asarray(frame['landmarks'][:frame['hands']], dtype=np.int64)
+
+    def seek(self, timestamp):
+
+        """ Function: Index of the first frame captured at or after a time
+            Arguments: self, timestamp: time in the session clock (see frames['time'])
+            returns: frame index """
+        return int(np.searchsorted(self.frames['time'], timestamp))
+
+    def labels(self):
+
+        """ Function: Ground truth press masks of the session, if it has been labelled
+            Arguments: self
+            returns: (frames,max_hands,5) bool array (memory mapped), or None """
+        path = os.path.join(self.path, labels_file)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')[:len(self.frames)]
+
+    def duration(self):
+        return float(self.frames['time'][-1] - self.frames['time'][0]) if len(self.frames) > 1 else 0.0
+
+
+def prepare_keyboard(meta):
+
+    """ Function: Put the keyboard where it was when the session was recorded
+            Arguments: meta: session metadata
+            returns: None """
+    import Virtual_Piano as vp
+    if vp.keyboard_layout is None:
+        vp.piano_key_initializer()
+    keyboard = meta.get('keyboard', {})
+    vp.place_keyboard(keyboard.get('x', vp.start_x), keyboard.get('y', vp.start_y), keyboard.get('scale', vp.keyboard_scale), keyboard.get('keys', vp.keyboard_keys))
+
+
+filter_settings = ('smoothing_min_cutoff', 'smoothing_beta', 'prediction_horizon', 'velocity_sensitive', 'press_speed_range', 'note_velocity') #Virtual_Piano globals taken from the session when it has them
+
+
+@contextlib.contextmanager
+def recorded_settings(meta, dist_threshold_param=None):
+
+    """ Function: Context manager switching Virtual_Piano to the keyboard, thresholds, frame width, landmark filter and
+                  velocity settings a session was recorded with, and back to the previous settings on exit
+            Arguments: meta: session metadata, dist_threshold_param: per finger thresholds used instead of the recorded ones
+            returns: context manager """
+    import Virtual_Piano as vp
+    saved = {'thresholds': vp.dist_threshold_param, 'units': vp.threshold_units, 'per_hand': vp.hand_threshold_param}
+    keyboard = (vp.start_x, vp.start_y, vp.keyboard_scale, vp.keyboard_keys)
+    frame_width = vp.frame_width
+    filters = {name: getattr(vp, name) for name in filter_settings}
+    try:
+        prepare_keyboard(meta)
+        vp.apply_calibration({'thresholds': dist_threshold_param or meta.get('dist_threshold_param', vp.dist_threshold_param),
+                              'units': meta.get('threshold_units', 'pixels'),
+                              'per_hand': None if dist_threshold_param else meta.get('hand_threshold_param')})
+        vp.frame_width = meta.get('frame_width', vp.frame_width)
+        for name in filter_settings:
+            if name in meta: #sessions recorded before these were stored keep the current values
+                setattr(vp, name, tuple(meta[name]) if name == 'press_speed_range' else meta[name])
+        yield
+    finally:
+        vp.apply_calibration(saved)
+        vp.frame_width = frame_width
+        for name, value in filters.items():
+            setattr(vp, name, value)
+        if vp.keyboard_layout is not None:
+            vp.place_keyboard(*keyboard)
+
+
+def replay(reader, dist_threshold_param=None, smoothing=None, start=0, stop=None):
+
+    """ Function: Feed a recorded session through press detection, note mapping and the note state machine again,
+                  with the settings it was recorded with (Virtual_Piano's own settings are restored afterwards)
+            Arguments: reader: sessionReader
+                       dist_threshold_param: per finger thresholds dict (default: the ones the session was recorded with)
+                       smoothing: use the landmark filter (default: as recorded)
+                       start, stop: frame range
+            returns: dict with the note events, (frames,hands,5) press masks, and replay speed """
+    import Virtual_Piano as vp
+    from press_detector import threshold_vector
+    from note_tracker import noteTracker
+    meta = reader.meta
+    with recorded_settings(meta, dist_threshold_param):
+        thresholds = threshold_vector(vp.dist_threshold_param)
+        if smoothing is None:
+            smoothing = meta.get('landmark_smoothing', vp.landmark_smoothing)
+        smoother = vp.make_landmark_filter() if smoothing else None
+        tracker = noteTracker(len(vp.key_reference), meta.get('press_debounce_frames', vp.press_debounce_frames), meta.get('release_debounce_frames', vp.release_debounce_frames),
+                              meta.get('min_hold_frames', vp.min_hold_frames), meta.get('release_threshold_scale', vp.release_threshold_scale))
+        stop = len(reader) if stop is None else min(stop, len(reader))
+        frames = reader.frames[start:stop]
+        times = np.asarray(frames['time']); counts = np.asarray(frames['hands']); handedness = np.asarray(frames['handedness'])
+        landmarks = np.asarray(frames['landmarks'], dtype=np.int64) #one read of the whole range from the memory map
+        masks = np.zeros((len(frames), reader.meta['max_hands'], 5), dtype=np.uint8)
+        events = []
+        t0 = time.perf_counter()
+        for i in range(len(frames)):
+            detect, coordinates, keys, frame_events = vp.detect_notes(landmarks[i, :counts[i]], float(times[i]), tracker, thresholds, smoother, handedness[i, :counts[i]].tolist())
+            masks[i, :len(detect)] = detect
+            events += frame_events
+        elapsed = time.perf_counter() - t0
+        recorded = times[-1] - times[0] if len(times) > 1 else 0.0
+    return {'events': events, 'masks': masks, 'frames': len(frames), 'seconds': elapsed,
+            'fps': len(frames) / elapsed if elapsed else 0.0, 'speedup': recorded / elapsed if elapsed else 0.0}
+
+
+def session_distances(reader, units='pixels', start=0, stop=None, smoothing=False):
+
+    """ Function: Finger distances of a range of recorded frames, in the units of a threshold profile
+            Arguments: reader: sessionReader, units: 'pixels' or 'palm', start/stop: frame range
+                       smoothing: the smaller of the filtered and predicted distances, like detect_notes() with the landmark filter on
+            returns: distances (frames,hands,5), valid (frames,hands) mask of present hands,
+                     side (frames,hands) handedness 0 left, 1 right, 2 unknown """
+    import Virtual_Piano as vp
+    from press_detector import normalized_distances
+    frames = reader.frames[start:stop]
+    counts = np.asarray(frames['hands'])
+    landmarks = np.asarray(frames['landmarks'], dtype=np.float64) #(N,H,21,2)
+    n, h = landmarks.shape[:2]
+    width = reader.meta.get('frame_width', 640)
+    if smoothing: #one sequential pass of the filter, shared by all candidates
+        smoother = vp.landmarkFilter(vp.smoothing_min_cutoff, vp.smoothing_beta, prediction=vp.prediction_horizon)
+        times = np.asarray(frames['time'])
+        distances = np.zeros((n, h, 5))
+        for i in range(n):
+            filtered = smoother.filter(landmarks[i, :counts[i]], times[i])
+            distances[i, :counts[i]] = np.minimum(normalized_distances(filtered, units, width), normalized_distances(smoother.predict(), units, width))
+    else:
+        distances = normalized_distances(landmarks.reshape(-1, 21, 2), units, width).reshape(n, h, 5)
+    valid = np.arange(h)[None, :] < counts[:, None] #hands present in the frame
+    side = np.minimum(np.asarray(frames['handedness']), 2).astype(np.int64)
+    return distances, valid, side
+
+
+def threshold_sweep(reader, scales, smoothing=False, min_frames=2):
+
+    """ Function: Evaluate many threshold settings over a whole session at once. Finger distances are computed once and
+                  the press/release hysteresis runs for all candidates, frames and fingers together (see hysteresis_masks())
+            Arguments: reader: sessionReader
+                       scales: list of factors applied to the recorded dist_threshold_param, or of full threshold dicts
+                       smoothing: filter the landmarks first (one pass, shared by all candidates)
+                       min_frames: presses shorter than this count as flicker
+            returns: list with one dict per candidate: presses, flicker presses, pressed fraction of frames,
+                     agreement with the recorded press masks """
+    import Virtual_Piano as vp
+    from press_detector import threshold_vector, hysteresis_masks
+    meta = reader.meta
+    units = meta.get('threshold_units', 'pixels')
+    base = threshold_vector(meta.get('dist_threshold_param', vp.dist_threshold_param))
+    candidates = np.array([base * s if np.isscalar(s) else threshold_vector(s) for s in scales]) #(C,5)
+    distances, valid, side = session_distances(reader, units, smoothing=smoothing)
+    scale = meta.get('release_threshold_scale', vp.release_threshold_scale)
+    masks = hysteresis_masks(distances[:, None], candidates[:, None, :], scale, valid[:, None, :, None]) #(N,C,H,5)
+    n = len(masks)
+    recorded = np.asarray(reader.frames['detect'], dtype=bool)
+    padded = np.concatenate([np.zeros((1,) + masks.shape[1:], bool), masks, np.zeros((1,) + masks.shape[1:], bool)]).astype(np.int8)
+    edges = np.diff(padded, axis=0)
+    results = []
+    for c in range(len(candidates)):
+        onsets = np.argwhere(edges[:, c] == 1); offsets = np.argwhere(edges[:, c] == -1)
+        order_on = np.lexsort((onsets[:, 0], onsets[:, 2], onsets[:, 1])); order_off = np.lexsort((offsets[:, 0], offsets[:, 2], offsets[:, 1]))
+        lengths = offsets[order_off, 0] - onsets[order_on, 0] #onsets and offsets pair up per finger in time order
+        results.append({'thresholds': dict(zip(['thumb', 'index', 'middle', 'ring', 'little'], candidates[c].round(3).tolist())),
+                        'presses': int(len(onsets)), 'flicker_presses': int(np.count_nonzero(lengths < min_frames)),
+                        'pressed_fraction': float(masks[:, c].any(axis=(1, 2)).mean()) if n else 0.0,
+                        'agreement': float((masks[:, c] == recorded).mean()) if n else 0.0})
+    return results
+
+
+def synthetic_session(path, frames=3000, noise=3.0, seed=0):
+
+    """ Function: Write a labelled session of synthetic key presses (see benchmark.synthetic_presses), for trying replay,
+                  sweeps and calibration
+            Arguments: path: session directory, frames: number of frames, noise: landmark jitter in pixels, seed: random seed
+            returns: None """
+    import Virtual_Piano as vp
+    from benchmark import synthetic_presses
+    from press_detector import threshold_vector
+    from note_tracker import noteTracker
+    if vp.keyboard_layout is None:
+        vp.piano_key_initializer()
+    vp.initialize_key_bboxes()
+    landmarks, timestamps, truth = synthetic_presses(frames, noise=noise, seed=seed)
+    recorder = sessionRecorder(path, meta=vp.session_meta())
+    tracker = noteTracker(len(vp.key_reference), vp.press_debounce_frames, vp.release_debounce_frames, vp.min_hold_frames, vp.release_threshold_scale)
+    thresholds = threshold_vector(vp.dist_threshold_param); smoother = vp.make_landmark_filter()
+    for i, (l, t) in enumerate(zip(landmarks, timestamps)):
+        detect, coordinates, keys, events = vp.detect_notes(l, t, tracker, thresholds, smoother)
+        recorder.write(i, t, l, [1] * len(l), detect, events)
+    recorder.close()
+    labels = np.zeros((frames, recorder.max_hands, 5), dtype=bool)
+    labels[:, :truth.shape[1]] = truth
+    np.save(os.path.join(path, labels_file), labels)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a recorded session without MediaPipe, or sweep press thresholds over it')
+    parser.add_argument('session', help='session directory (set session_dir in Virtual_Piano.py to record one)')
+    parser.add_argument('--synthetic', type=int, default=0, help='first write a synthetic session of this many frames')
+    parser.add_argument('--sweep', type=float, nargs='*', default=None, help='threshold scale factors to evaluate, e.g. --sweep 0.8 0.9 1 1.1')
+    parser.add_argument('--smoothing', action='store_true', help='smooth the landmarks before the sweep')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the session this many times (timing)')
+    args = parser.parse_args()
+    if args.synthetic:
+        synthetic_session(args.session, args.synthetic)
+    reader = sessionReader(args.session)
+    print("Session:", len(reader), "frames,", len(reader.events), "recorded events, %.1f s" % reader.duration())
+    if args.sweep is not None:
+        t0 = time.perf_counter()
+        results = threshold_sweep(reader, args.sweep or list(np.linspace(0.7, 1.3, 13)), args.smoothing)
+        elapsed = time.perf_counter() - t0
+        for r in results:
+            print(r)
+        print("Swept %d settings over %d frames in %.3f s" % (len(results), len(reader), elapsed))
+        sys.exit()
+    for i in range(args.repeat):
+        result = replay(reader)
+    recorded = reader.events
+    replayed = np.array([tuple(e) for e in result['events']], dtype=note_event_dtype) if result['events'] else np.zeros(0, note_event_dtype)
+    same = len(recorded) == len(replayed) and all(np.array_equal(recorded[name], replayed[name]) for name in note_event_dtype.names)
+    print("Replayed %d frames at %.0f frames/s (%.0fx real time), %d note-ons, identical to the recording: %s" %
+          (result['frames'], result['fps'], result['speedup'], sum(1 for e in result['events'] if e[0] == NOTE_ON), same))
+    sys.exit(0 if same else 1)
@@ -0,0 +1,14 @@
+# Checks that note events pushed by one process reach another through the shared memory ring complete and in order
+# python3 test_event_ring.py (or pytest test_event_ring.py)
+import event_ring
+
+
+def test_two_process_order():
+    result = event_ring.stress_test(total=50000, batch=64, capacity=1024) #small ring, so it wraps and fills up many times
+    assert result['received'] == result['total'] == 50000, result
+    assert result['errors'] == 0 and result['dropped'] == 0 and result['backlog'] == 0, result
+    print("%d events in order through a %d event ring" % (result['received'], 1024))
+
+
+if __name__ == "__main__":
+    test_two_process_order()
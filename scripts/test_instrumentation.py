@@ -0,0 +1,38 @@
+# Checks that disabled instrumentation is a no-op: nothing is recorded, printed or timed
+# pytest test_instrumentation.py
+import instrumentation
+from instrumentation import metricsRecorder, null_context
+
+
+def frame(recorder, i):
+    with recorder.stage('inference'):
+        pass
+    recorder.record('fetch', 0.001)
+    recorder.count('presses', 2)
+    recorder.gauge('queue_depth', i)
+    recorder.trace('frame', i)
+    recorder.frameDone()
+
+
+def test_disabled_is_a_no_op(monkeypatch, capsys):
+    recorder = metricsRecorder(enabled=False, trace_every=1, summary_interval=1e-9)
+
+    def no_clock():
+        raise AssertionError("disabled instrumentation read the clock")
+    monkeypatch.setattr(instrumentation.time, 'perf_counter', no_clock) #the disabled path must not even time anything
+    monkeypatch.setattr(instrumentation.time, 'monotonic', no_clock)
+    assert recorder.stage('inference') is null_context #shared, nothing allocated per call
+    for i in range(100):
+        frame(recorder, i)
+    assert recorder.frames == 0 and not recorder.timings and not recorder.counters and not recorder.gauges and not recorder.contexts
+    assert capsys.readouterr().out == ''
+
+
+def test_enabled_records():
+    recorder = metricsRecorder(enabled=True, capacity=16)
+    for i in range(40):
+        frame(recorder, i)
+    summary = recorder.summary()
+    assert summary['frames'] == 40 and summary['counters'] == {'presses': 80} and summary['gauges'] == {'queue_depth': 39}
+    assert summary['stages']['inference']['calls'] == 40 and summary['stages']['fetch']['calls'] == 40
+    assert recorder.stage('inference') is recorder.stage('inference') #one reusable timer per stage
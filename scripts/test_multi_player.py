@@ -0,0 +1,200 @@
+# Checks the shared inference pool of multi_player.py: capture order per player, fair sharing and scaling with workers
+# Runs without MediaPipe or a camera. The scheduling checks drive the pool in process with sources that always have a
+# frame waiting and workers that answer in reverse order, so they count frames instead of timing them; one run with real
+# inference processes uses image directory replays and a stub detector that returns synthetic landmarks for each frame
+# python3 test_multi_player.py (or pytest test_multi_player.py)
+import cv2
+import numpy as np
+import multiprocessing
+import tempfile
+import random
+import queue
+import time
+import os
+import pytest
+import Virtual_Piano as vp
+import multi_player
+from event_ring import eventRing
+from audio_engine import player_event_dtype, NOTE_ON, NOTE_OFF
+from benchmark import synthetic_presses
+
+frame_count = 300
+presses = synthetic_presses(frame_count, noise=1.0, seed=5)[0] #pressing keys of the default keyboard
+
+
+def frame_landmarks(seq, band):
+    return presses[seq % frame_count] + [0, int(band[0] - vp.start_y)] #moves the presses onto the player's keyboard
+
+
+class stubDetector():
+    def __init__(self, roi=False, keyboard_band=None):
+        self.band = keyboard_band
+        self.index = 0
+
+    def findHands(self, img, draw=True, imgRGB=None):
+        time.sleep(0.005 * random.uniform(0.5, 1.5)) #uneven, so results come back out of order
+        self.index = int(img[0, 0, 0]) + 256 * int(img[0, 0, 1])
+        return img
+
+    def findPositions(self, img):
+        return frame_landmarks(self.index, self.band)
+
+    def handedness(self):
+        return [1]
+
+
+class stubGrabber():
+    # A camera that always has a new frame waiting, i.e. a saturated pool
+    def __init__(self):
+        self.seq = 0
+        self.running = True
+        self.dropped = 0
+
+    def ready(self):
+        return self.running
+
+    def read(self, timeout=None):
+        self.seq += 1
+        return np.zeros((8, 8, 3), np.uint8), {'seq': self.seq, 'timestamp': self.seq / 30.0}
+
+    def stop(self):
+        self.running = False
+
+
+class taskList(list):
+    def put(self, task):
+        self.append(task)
+
+
+class recordingPool(multi_player.multiPlayer):
+    def handle(self, player, result, timestamp):
+        self.handled.append((player.index, result[2])) #(player, seq) in the order note detection sees them
+        super().handle(player, result, timestamp)
+
+
+@pytest.fixture
+def stub_detector(monkeypatch):
+    monkeypatch.setattr(vp, 'handDetector', stubDetector) #forked inference workers inherit it
+    if not vp.key_reference:
+        vp.piano_key_initializer()
+    vp.initialize_key_bboxes()
+
+
+def simulated_pool(specs, workers, max_inflight=1, ring=None):
+
+    """ Function: Pool driven in this process by step(): no worker processes, stubGrabber sources
+            Arguments: specs: player specs (see make_players), workers, max_inflight, ring: see multiPlayer
+            returns: recordingPool """
+    pool = recordingPool(multi_player.make_players(specs), workers, ring, max_inflight)
+    pool.handled = []
+    for player in pool.players:
+        player.grabber = stubGrabber()
+    pool.tasks = [taskList() for w in range(workers)]
+    pool.results = queue.Queue()
+    pool.idle = list(range(workers))
+    pool.start_time = time.monotonic()
+    return pool
+
+
+def step(pool):
+
+    """ Function: One scheduling round: dispatch, every busy worker finishes its frame (the last worker first), collect
+            Arguments: pool: from simulated_pool()
+            returns: number of frames dispatched """
+    count = pool.dispatch()
+    for worker in reversed(range(pool.workers)):
+        while pool.tasks[worker]:
+            source, seq, slot, name, shape, band = pool.tasks[worker].pop(0)
+            pool.results.put((worker, source, seq, slot, frame_landmarks(seq, band), [1], 1.0, None))
+    pool.collect(0)
+    return count
+
+
+def run_simulated(specs, workers, rounds, max_inflight=1, ring=None):
+    pool = simulated_pool(specs, workers, max_inflight, ring)
+    try:
+        dispatched = [step(pool) for r in range(rounds)]
+    finally:
+        pool.stop()
+    return pool, dispatched
+
+
+def test_events_in_order_per_player(stub_detector):
+    specs = [{'source': 'a'}, {'source': 'b', 'name': 'small', 'keys': 49, 'x': 60, 'y': 200}, {'source': 'c', 'name': 'scaled', 'scale': 1.2}]
+    ring = eventRing(capacity=8192, dtype=player_event_dtype)
+    try:
+        pool, dispatched = run_simulated(specs, 6, 100, max_inflight=3, ring=ring) #two frames of every player per round, the later one done first
+        events = ring.pop()
+    finally:
+        ring.close()
+    notes = []
+    for player, reference in enumerate(multi_player.make_players(specs)): #same players, every frame handled in capture order
+        seqs = [seq for index, seq in pool.handled if index == player]
+        assert seqs == list(range(1, len(seqs) + 1)) and len(seqs) == pool.players[player].dispatched, "player %d frames out of order" % player
+        expected = []
+        for seq in seqs:
+            frame_events = vp.detect_notes(frame_landmarks(seq, reference.band), seq / 30.0, reference.tracker, pool.thresholds,
+                                           reference.smoother, [1], reference.layout)[3]
+            expected += [tuple(event) + (player,) for event in frame_events]
+        mine = events[events['player'] == player]
+        assert np.array_equal(mine, np.array(expected, dtype=player_event_dtype)), "player %d events differ from in order detection" % player
+        assert (mine['kind'] == NOTE_ON).sum() > 2, "player %d played no notes" % player
+        on = set()
+        for kind, note in zip(mine['kind'], mine['note']): #every note-off follows a note-on of the same key
+            if kind == NOTE_ON:
+                assert note not in on; on.add(note)
+            elif kind == NOTE_OFF:
+                assert note in on; on.discard(note)
+        notes.append(set(mine['note'][mine['kind'] == NOTE_ON].tolist()))
+    assert notes[0] != notes[1], "players share one keyboard"
+    print("capture order kept for %d players, notes per player %s" % (len(specs), [len(n) for n in notes]))
+
+
+def test_fairness(stub_detector):
+    pool, dispatched = run_simulated(['a', 'b', 'c'], 1, 300) #one worker for three sources, the pool is saturated
+    equal = [p.completed for p in pool.players]
+    assert equal == [100, 100, 100], equal
+    pool, dispatched = run_simulated(['a', {'source': 'b', 'weight': 2}], 1, 300)
+    weighted = [p.completed for p in pool.players]
+    assert weighted == [100, 200], weighted
+    print("equal sources completed %s frames; weight 2 got %s" % (equal, weighted))
+
+
+def test_scaling_with_workers(stub_detector):
+    for workers in (1, 2, 4):
+        pool, dispatched = run_simulated(['a'] * 4, workers, 50) #4 sources keep up to 4 workers busy
+        assert dispatched == [workers] * 50, (workers, dispatched)
+        assert sum(p.completed for p in pool.players) == 50 * workers
+    pool, dispatched = run_simulated(['a'], 4, 50) #one frame in flight per source leaves 3 workers idle
+    assert dispatched == [1] * 50
+    pool, dispatched = run_simulated(['a'], 4, 50, max_inflight=4)
+    assert dispatched == [4] * 50
+    print("frames per round scale with workers while there are sources to serve")
+
+
+def write_frames(path, frames):
+    for i in range(frames):
+        img = np.zeros((72, 128, 3), np.uint8)
+        img[:, :, 0] = i % 256; img[:, :, 1] = i // 256 #frame index, read back by stubDetector
+        cv2.imwrite(os.path.join(path, '%05d.png' % i), img)
+
+
+def test_inference_processes(stub_detector):
+    with tempfile.TemporaryDirectory() as tmp:
+        write_frames(tmp, frame_count)
+        pool = recordingPool(multi_player.make_players([tmp, tmp], 30.0), 2, None, 2, context=multiprocessing.get_context('fork'))
+        pool.handled = []
+        pool.start()
+        try:
+            stats = pool.run(max_frames=30)
+        finally:
+            pool.stop()
+    for player in range(2):
+        seqs = [seq for index, seq in pool.handled if index == player]
+        assert len(seqs) >= 30 and all(b > a for a, b in zip(seqs, seqs[1:])), "player %d frames out of order" % player
+    assert sum(s['errors'] for s in stats['sources'].values()) == 0, stats
+    assert sum(s['notes'] for s in stats['sources'].values()) > 0, stats
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, '-q', '-s'])
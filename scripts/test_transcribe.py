@@ -0,0 +1,78 @@
+# Checks that splitting a transcription over several workers gives the same MIDI file as a single worker
+# Runs without MediaPipe: the frames only carry their index, a stub detector returns synthetic landmarks for it
+# python3 test_transcribe.py (or pytest test_transcribe.py)
+import cv2
+import numpy as np
+import multiprocessing
+import tempfile
+import os
+import pytest
+import Virtual_Piano as vp
+import transcribe
+from benchmark import synthetic_presses
+
+frame_count = 600 #long enough that every chunk gets its full warm-up with 4 workers
+
+
+class stubDetector():
+    landmarks = None #one (1,21,2) array per frame index, set by write_frames()
+
+    def __init__(self, roi=False, keyboard_band=None):
+        self.index = 0
+
+    def findHands(self, img, draw=True, imgRGB=None):
+        self.index = int(img[0, 0, 0]) + 256 * int(img[0, 0, 1]) #frame index written by write_frames()
+        return img
+
+    def findPositions(self, img):
+        return stubDetector.landmarks[self.index]
+
+    def handedness(self):
+        return [1]
+
+
+def write_frames(path, frames):
+
+    """ Function: Image directory whose frames are plain colours encoding their index, and landmarks for every index of a
+                  hand that sinks onto the keys by a different amount on every press, so the note velocity varies
+            Arguments: path: directory to write to, frames: number of frames
+            returns: None """
+    landmarks = synthetic_presses(frames, noise=2.0, seed=3)[0]
+    gain = np.repeat(np.random.default_rng(3).uniform(1.1, 2.0, frames // 20 + 1), 20) #changes every 20 frames
+    bend = [60 - (hand[0, 8, 1] - hand[0, 5, 1]) for hand in landmarks] #how far the index finger tip moved up (press_landmarks)
+    stubDetector.landmarks = [hand + [0, int(round(g * b))] for hand, g, b in zip(landmarks, gain, bend)] #the hand sinks onto the key
+    for i in range(frames):
+        img = np.zeros((36, 64, 3), np.uint8)
+        img[:, :, 0] = i % 256; img[:, :, 1] = i // 256
+        cv2.imwrite(os.path.join(path, '%05d.png' % i), img)
+
+
+def run(path, out, workers, overlap=None):
+    result = transcribe.transcribe(path, out, workers=workers, overlap=overlap, context=multiprocessing.get_context('fork')) #workers inherit the stub detector
+    with open(out, 'rb') as f:
+        return result, f.read()
+
+
+def test_workers_match_single_worker(monkeypatch):
+    monkeypatch.setattr(vp, 'handDetector', stubDetector)
+    if not vp.key_reference:
+        vp.piano_key_initializer()
+    vp.initialize_key_bboxes()
+    with tempfile.TemporaryDirectory() as tmp:
+        write_frames(tmp, frame_count)
+        single, expected = run(tmp, os.path.join(tmp, 'single.mid'), 1)
+        assert single['processed_frames'] == frame_count and single['warmup_frames'] == 0
+        assert single['notes'] > 5
+        velocities = {e[2] for chunk in [transcribe.transcribe_chunk(tmp, 0, 0, frame_count, 30.0)] for e in chunk['events'] if e[0] == transcribe.NOTE_ON}
+        assert len(velocities) > 1 #the velocity actually depends on the finger speed
+        for workers, overlap in [(3, None), (4, None), (4, 2)]: #a 2 frame warm-up is too short, those chunks carry the state over
+            result, data = run(tmp, os.path.join(tmp, 'split.mid'), workers, overlap)
+            assert result['processed_frames'] == frame_count, result
+            assert result['warmup_frames'] == (workers - 1) * result['overlap'], result
+            assert data == expected, (workers, overlap, result)
+            assert (result['reruns'] == 0) == (overlap is None), result
+        print("MIDI identical with 1, 3 and 4 workers, %d notes, velocities %s" % (single['notes'], sorted(velocities)))
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, '-q', '-s'])
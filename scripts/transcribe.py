@@ -0,0 +1,322 @@
+# Headless batch transcription of a recorded video (or image directory) into a MIDI file and optionally a WAV file
+import cv2
+import numpy as np
+import copy
+import multiprocessing
+import struct
+import time
+import os
+import sys
+import argparse
+import Virtual_Piano as vp
+from frame_source import image_extensions
+from pipeline import framePipeline, end_of_stream
+from press_detector import threshold_vector
+from note_tracker import noteTracker
+from audio_engine import note_off, NOTE_ON, NOTE_OFF
+from keyboard_layout import midi_base
+
+ticks_per_beat = 480
+midi_tempo = 500000 #microseconds per beat (120 bpm), so one second is 960 ticks
+
+
+def frame_files(path):
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(image_extensions))
+
+
+def probe(path, default_fps=30.0):
+
+    """ Function: Number of frames and frame rate of a video file or image directory
+            Arguments: path: video file or image directory, default_fps: rate used for image directories or
+                       videos that do not report one
+            returns: frames, fps """
+    if os.path.isdir(path):
+        return len(frame_files(path)), default_fps
+    cap = cv2.VideoCapture(path)
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or default_fps
+    cap.release()
+    return frames, fps
+
+
+def plan_chunks(frames, workers, overlap, skip=1):
+
+    """ Function: Split a video into one chunk per worker. Each chunk starts decoding `overlap` processed frames early,
+                  so hand tracking and the note state machine are settled by the time its own frames begin
+            Arguments: frames: total frames, workers: number of chunks, overlap: warm-up frames (after frame skip)
+                       skip: frame step
+            returns: list of (warm_start, start, stop) frame indices, all multiples of skip """
+    steps = (frames + skip - 1) // skip
+    bounds = [int(round(steps * i / float(workers))) * skip for i in range(workers + 1)]
+    return [(max(0, bounds[i] - overlap * skip), bounds[i], min(frames, bounds[i + 1])) for i in range(workers) if bounds[i] < bounds[i + 1]]
+
+
+def min_overlap(fps, skip=1, tolerance=1e-9):
+
+    """ Function: Shortest warm-up after which a chunk has the same landmark filter and note state as a run from the
+                  start of the video: the filter has to forget its starting state (see landmarkFilter.settleFrames())
+                  and the debounce and minimum hold counters have to run out. About 110 frames at 30 fps with the default
+                  smoothing settings; a finger that stays inside the press/release hysteresis band can still differ,
+                  which transcribe() catches
+            Arguments: fps: frame rate of the recording, skip: frame step
+                       tolerance: see landmarkFilter.settleFrames(), small enough that velocities of thousands of pixels
+                                  per second agree to well within same_state()'s default atol
+            returns: warm-up in processed frames """
+    smoother = vp.make_landmark_filter()
+    frames = smoother.settleFrames(skip / float(fps), tolerance) if smoother is not None else 0
+    return frames + vp.press_debounce_frames + vp.release_debounce_frames + vp.min_hold_frames
+
+
+def same_state(a, b, atol=1e-6):
+
+    """ Function: Whether two chunk states (see transcribe_chunk()) would produce the same notes from here on:
+                  the note state machines agree on everything that still affects an event and the landmark filters
+                  agree to within atol pixels (pixels per second for the velocity)
+            Arguments: a, b: dicts with 'smoother' (landmarkFilter or None) and 'tracker' (noteTracker)
+            returns: bool """
+    def settled(t):
+        return [t.active, np.minimum(t.seen_count, t.press_frames), np.minimum(t.missing_count, t.release_frames),
+                np.where(t.active, np.minimum(t.held_frames, t.min_hold_frames), 0)]
+    ta, tb = a['tracker'], b['tracker']
+    if not all(np.array_equal(x, y) for x, y in zip(settled(ta), settled(tb))):
+        return False
+    hands = min(len(ta.finger_pressed), len(tb.finger_pressed)) #slots beyond the tracked hands are all released
+    if not np.array_equal(ta.finger_pressed[:hands], tb.finger_pressed[:hands]) or ta.finger_pressed[hands:].any() or tb.finger_pressed[hands:].any():
+        return False
+    sa, sb = a['smoother'], b['smoother']
+    if sa is None or sb is None:
+        return sa is sb
+    return (sa.hands == sb.hands and sa.last_time == sb.last_time and np.allclose(sa.x[:sa.hands], sb.x[:sb.hands], rtol=0, atol=atol)
+            and np.allclose(sa.dx[:sa.hands], sb.dx[:sb.hands], rtol=0, atol=atol))
+
+
+def transcribe_chunk(path, warm_start, start, stop, fps, skip=1, width=None, state=None):
+
+    """ Function: Run hand landmarks, press detection and the note state machine over frames [warm_start, stop)
+                  as fast as possible (lossless pipeline, no display, no sleeps)
+            Arguments: path: video file or image directory, warm_start/start/stop: frame indices from plan_chunks()
+                       fps: frame rate used for the event timestamps, skip: process every skip-th frame
+                       width: frames are resized to this width like frameGrabber does, so the keyboard layout matches (default: frame_width)
+                       state: 'state' of the result of the previous chunk; its landmark filter and note state machine
+                              take over at frame start (the warm-up frames then only warm up hand tracking)
+            returns: dict with the events of frames [start, stop) (timestamps in seconds from the start of the video),
+                     the number of frames and warm-up frames and the seconds spent, and the filter and note state
+                     at frame start ('initial') and after the last frame ('state') """
+    if not vp.key_reference:
+        vp.piano_key_initializer()
+    vp.load_calibration()
+    vp.initialize_key_bboxes()
+    width = width or vp.frame_width
+    detector = vp.handDetector(roi=vp.roi_tracking, keyboard_band=(vp.bboxes_white[:,1].min(), vp.bboxes_white[:,3].max()))
+    tracker = noteTracker(len(vp.key_reference), vp.press_debounce_frames, vp.release_debounce_frames, vp.min_hold_frames, vp.release_threshold_scale)
+    thresholds = threshold_vector(vp.dist_threshold_param)
+    carried = {'smoother': vp.make_landmark_filter(), 'tracker': tracker}
+    initial = []
+    files = frame_files(path) if os.path.isdir(path) else None
+    cap = None
+    if files is None:
+        cap = cv2.VideoCapture(path)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, warm_start)
+    position = {'index': warm_start}
+
+    def source():
+        index = position['index']
+        if index >= stop:
+            return end_of_stream
+        if files is not None:
+            data = np.fromfile(files[index], dtype=np.uint8)
+        else:
+            ok, data = cap.read()
+            for i in range(skip - 1):
+                cap.grab() #skipped frames are never decoded
+            if not ok:
+                return end_of_stream
+        position['index'] = index + skip
+        return {'seq': index, 'timestamp': index / float(fps), 'data': data}
+
+    def preprocess(packet):
+        img = packet.pop('data')
+        if files is not None:
+            img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+        h, w = img.shape[:2]
+        packet['img'] = cv2.resize(img, (width, int(h * width / float(w))), interpolation=cv2.INTER_AREA)
+        packet['rgb'] = cv2.cvtColor(packet['img'], cv2.COLOR_BGR2RGB)
+        return packet
+
+    def inference(packet):
+        detector.findHands(packet['img'], draw=False, imgRGB=packet.pop('rgb'))
+        packet['landmarks'] = detector.findPositions(packet['img'])
+        packet['handedness'] = detector.handedness()
+        del packet['img']
+        return packet
+
+    def detection(packet):
+        if packet['seq'] == start:
+            if state is not None:
+                carried.update(copy.deepcopy(state))
+            initial.append(copy.deepcopy(carried))
+        elif packet['seq'] < start and state is not None:
+            packet['events'] = [] #replaced by the carried state anyway
+            return packet
+        packet['events'] = vp.detect_notes(packet.pop('landmarks'), packet['timestamp'], carried['tracker'], thresholds, carried['smoother'], packet.pop('handedness'))[3]
+        return packet
+
+    t0 = time.perf_counter()
+    pipeline = framePipeline(source, [('preprocess', preprocess), ('inference', inference), ('detection', detection)], queue_size=4, lossless=True).start()
+    events = []; frames = 0; warmup_frames = 0
+    while True:
+        packet = pipeline.get(timeout=1)
+        if packet is None:
+            if pipeline.finished():
+                break
+            continue
+        if packet['seq'] >= start: #events of the warm-up frames belong to the previous chunk
+            frames += 1
+            events.extend(packet['events'])
+        else:
+            warmup_frames += 1
+    pipeline.stop()
+    if cap is not None:
+        cap.release()
+    errors = [s['error'] for s in pipeline.stats().values() if s['error']]
+    return {'start': start, 'stop': stop, 'events': events, 'frames': frames, 'warmup_frames': warmup_frames, 'seconds': time.perf_counter() - t0,
+            'errors': errors, 'initial': initial[0] if initial else None, 'state': carried}
+
+
+def transcribe_chunk_args(args):
+    return transcribe_chunk(*args)
+
+
+def merge_events(chunks, end_time):
+
+    """ Function: Join the events of all chunks into one consistent stream: a note-on for a note that is already on
+                  (or a note-off for one that is off) is dropped, and notes still on at the end are released
+            Arguments: chunks: results of transcribe_chunk(), end_time: time of the final note-offs
+            returns: list of events sorted by time """
+    events = sorted((e for chunk in chunks for e in chunk['events']), key=lambda e: (e[3], e[0] == NOTE_ON))
+    active = {}
+    merged = []
+    for event in events:
+        kind, note = event[0], event[1]
+        if kind == NOTE_ON and not active.get(note):
+            active[note] = True
+            merged.append(event)
+        elif kind == NOTE_OFF and active.get(note):
+            active[note] = False
+            merged.append(event)
+    merged += [note_off(note, end_time) for note, on in sorted(active.items()) if on]
+    return merged
+
+
+def variable_length(value):
+    out = [value & 0x7f]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def write_midi(path, events, channel=0):
+
+    """ Function: Save note events as a standard MIDI file (format 0, one track)
+            Arguments: path: output .mid file, events: (kind, note_id, velocity, seconds) tuples sorted by time
+                       channel: MIDI channel
+            returns: None """
+    ticks_per_second = ticks_per_beat * 1000000.0 / midi_tempo
+    track = b'\x00\xff\x51\x03' + struct.pack('>I', midi_tempo)[1:] #tempo meta event
+    last = 0
+    for kind, note, velocity, timestamp in events:
+        if kind not in (NOTE_ON, NOTE_OFF):
+            continue
+        tick = max(last, int(round(timestamp * ticks_per_second)))
+        status = (0x90 if kind == NOTE_ON else 0x80) | channel
+        track += variable_length(tick - last) + bytes([status, int(note) + midi_base, int(velocity) if kind == NOTE_ON else 0])
+        last = tick
+    track += b'\x00\xff\x2f\x00' #end of track
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, ticks_per_beat))
+        f.write(b'MTrk' + struct.pack('>I', len(track)) + track)
+
+
+def render_wav(path, events, sample_dir, duration=None):
+
+    """ Function: Offline mix of the events with the 88 key samples
+            Arguments: path: output .wav file, events: merged events, sample_dir: piano sample directory
+                       duration: length in seconds (default: last event plus a second)
+            returns: None """
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy') #no sound card needed
+    from sample_bank import sampleBank
+    from audio_engine import audioEngine, write_wav
+    bank = sampleBank(sample_dir, vp.key_reference)
+    engine = audioEngine(bank, polyphony=vp.polyphony, release_ms=vp.release_ms, offline=True)
+    write_wav(path, engine.render(events, duration), bank.frequency)
+
+
+def transcribe(path, midi_path, wav_path=None, sample_dir=None, workers=1, skip=1, overlap=None, fps=None, context=None):
+
+    """ Function: Transcribe a recording into MIDI (and WAV), splitting it over worker processes. The output is the same
+                  as with a single worker: a chunk whose state after the warm-up differs from the state the previous
+                  chunk ended with is run again with that state carried over
+            Arguments: path: video file or image directory, midi_path: output .mid file
+                       wav_path: optional output .wav file, sample_dir: piano samples for the WAV
+                       workers: number of processes, skip: process every skip-th frame
+                       overlap: warm-up frames decoded before every chunk but the first (default: min_overlap())
+                       fps: frame rate of the recording (default: from the video, 30 for image directories)
+                       context: multiprocessing context the workers are started from (default: the global start method)
+            returns: dict with frame counts, throughput and the number of notes """
+    frames, video_fps = probe(path, fps or 30.0)
+    fps = fps or video_fps
+    if not vp.key_reference:
+        vp.piano_key_initializer()
+    if overlap is None:
+        overlap = min_overlap(fps, max(1, skip))
+    chunks = plan_chunks(frames, max(1, workers), overlap, max(1, skip))
+    jobs = [(path, warm_start, start, stop, fps, max(1, skip)) for warm_start, start, stop in chunks]
+    t0 = time.perf_counter()
+    if len(jobs) > 1:
+        with (context or multiprocessing).Pool(len(jobs)) as pool:
+            results = pool.map(transcribe_chunk_args, jobs)
+    else:
+        results = [transcribe_chunk_args(job) for job in jobs]
+    reruns = 0
+    for i in range(1, len(results)):
+        if results[i]['initial'] is not None and not same_state(results[i - 1]['state'], results[i]['initial']):
+            results[i] = transcribe_chunk(*jobs[i], state=results[i - 1]['state']) #warm-up too short for this boundary
+            reruns += 1
+    elapsed = time.perf_counter() - t0
+    for result in results:
+        for error in result['errors']:
+            print("Chunk", result['start'], "-", result['stop'], "failed:", error)
+    duration = frames / float(fps)
+    events = merge_events(results, duration)
+    write_midi(midi_path, events)
+    if wav_path:
+        render_wav(wav_path, events, sample_dir or vp.music_dir, duration + 1.0)
+    processed = sum(r['frames'] for r in results)
+    return {'video_frames': frames, 'processed_frames': processed, 'warmup_frames': sum(r['warmup_frames'] for r in results),
+            'workers': len(jobs), 'overlap': overlap, 'reruns': reruns,
+            'seconds': elapsed, 'fps': processed / elapsed if elapsed else 0.0,
+            'realtime_factor': duration / elapsed if elapsed else 0.0,
+            'chunk_fps': [(r['frames'] + r['warmup_frames']) / r['seconds'] if r['seconds'] else 0.0 for r in results], #warm-up included
+            'notes': sum(1 for e in events if e[0] == NOTE_ON)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Transcribe a recorded virtual piano session into MIDI without a camera or window')
+    parser.add_argument('input', help='video file or image directory')
+    parser.add_argument('--midi', default=None, help='output MIDI file (default: input name with .mid)')
+    parser.add_argument('--wav', default=None, help='also render the notes to this WAV file')
+    parser.add_argument('--samples', default=vp.music_dir, help='piano sample directory used for --wav')
+    parser.add_argument('--workers', type=int, default=1, help='split the video over this many processes')
+    parser.add_argument('--skip', type=int, default=1, help='process every n-th frame only')
+    parser.add_argument('--overlap', type=int, default=None, help='warm-up frames processed before every chunk (default: long enough for the landmark filter and debounce to settle)')
+    parser.add_argument('--fps', type=float, default=None, help='frame rate of the recording (image directories default to 30)')
+    args = parser.parse_args()
+    midi_path = args.midi or os.path.splitext(args.input.rstrip('/'))[0] + '.mid'
+    result = transcribe(args.input, midi_path, args.wav, args.samples, args.workers, args.skip, args.overlap, args.fps)
+    print("Processed %d of %d frames (plus %d warm-up frames) in %.1f s: %.1f frames/s (%.1fx real time) with %d worker(s), %d notes -> %s" %
+          (result['processed_frames'], result['video_frames'], result['warmup_frames'], result['seconds'], result['fps'], result['realtime_factor'], result['workers'], result['notes'], midi_path))
+    if result['reruns']:
+        print("%d chunk(s) were run again with the state of the previous chunk, a longer --overlap than %d avoids that" % (result['reruns'], result['overlap']))
+    sys.exit()